@@ -0,0 +1,355 @@
+# Makes INT8/FP16 ONNX variants of a trained model and measures what each one costs in accuracy
+# and buys in CPU latency and memory, to pick the onnx_model_variant of object_detection.
+# Run it next to data.yaml (same as training.py), once training is done.
+# Extra dependencies: onnx, onnxruntime, onnxconverter-common.
+
+import csv
+import glob
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import time
+
+import cv2
+import numpy as np
+import onnx
+from onnxconverter_common import float16
+from onnxruntime.quantization import (
+    CalibrationDataReader,
+    QuantFormat,
+    QuantType,
+    quantize_dynamic,
+    quantize_static,
+)
+from onnxruntime.quantization.shape_inference import quant_pre_process
+from ultralytics import YOLO
+from ultralytics.data.augment import LetterBox
+from ultralytics.data.utils import check_det_dataset, img2label_paths
+from ultralytics.utils.metrics import ap_per_class
+
+# Shared with src/inference_backends.py, which loads the variants by these file names.
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "../src"))
+from common_utils import get_onnx_model_file_name  # noqa: E402
+
+
+is_front_camera_training = False  # Change it to True if quantizing the front camera model.
+############################# QUANTIZATION PARAMETERS ############################
+if is_front_camera_training:
+    model_file = "best_AUV_sim_front_camera_model.pt"
+else:
+    model_file = "best_AUV_sim_down_camera_model.pt"
+imgsz = [480, 640]  # Same as training.py and onnx_input_size in vision.launch.
+variants = ["int8_dynamic", "int8_static", "fp16"]
+calibration_image_count = 200  # Drawn from the training images.
+latency_image_count = 100  # Drawn from the validation images.
+intra_op_threads = 4  # Same as onnx_intra_op_threads in vision.launch.
+# A variant passes if it loses at most this much mAP50-95 (overall and for every class).
+max_map_drop = 0.01
+max_class_map_drop = 0.03
+# Same thresholds as ultralytics' val.
+val_conf_threshold = 0.001
+val_iou_threshold = 0.7
+random_seed = 0
+##################################################################################
+
+
+def get_image_files(folder):
+    return sorted(
+        f
+        for extension in ("jpg", "jpeg", "png")
+        for f in glob.glob(os.path.join(folder, "*." + extension))
+    )
+
+
+# Same preprocessing as the onnxruntime backend: letterbox, BGR -> RGB, NCHW float in [0, 1].
+def to_blob(image):
+    image = LetterBox(new_shape=imgsz, auto=False)(image=image)
+    return cv2.dnn.blobFromImage(image, 1 / 255.0, swapRB=True)
+
+
+class CalibrationImages(CalibrationDataReader):
+    def __init__(self, image_files, input_name):
+        self.image_files = iter(image_files)
+        self.input_name = input_name
+
+    def get_next(self):
+        image_file = next(self.image_files, None)
+        if image_file is None:
+            return None
+        return {self.input_name: to_blob(cv2.imread(image_file))}
+
+
+def export_fp32():
+    exported_file = YOLO(model_file).export(
+        format="onnx", imgsz=imgsz, dynamic=True, simplify=True
+    )
+    shutil.move(exported_file, get_onnx_model_file_name(model_file, imgsz))
+
+
+def make_variant(variant, calibration_files):
+    fp32_file = get_onnx_model_file_name(model_file, imgsz)
+    variant_file = get_onnx_model_file_name(model_file, imgsz, variant)
+    if variant == "int8_dynamic":
+        quantize_dynamic(fp32_file, variant_file, weight_type=QuantType.QUInt8)
+    elif variant == "int8_static":
+        preprocessed_file = get_onnx_model_file_name(model_file, imgsz, "preprocessed")
+        quant_pre_process(fp32_file, preprocessed_file)
+        input_name = onnx.load(preprocessed_file).graph.input[0].name
+        quantize_static(
+            preprocessed_file,
+            variant_file,
+            CalibrationImages(calibration_files, input_name),
+            quant_format=QuantFormat.QDQ,
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+            per_channel=True,
+        )
+        os.remove(preprocessed_file)
+    elif variant == "fp16":
+        # Inputs and outputs stay float32 so that the backend does not change.
+        model = float16.convert_float_to_float16(onnx.load(fp32_file), keep_io_types=True)
+        onnx.save(model, variant_file)
+    else:
+        raise ValueError("Unknown variant " + variant)
+
+
+# Runs in its own process so that the peak memory is only the model's.
+def measure_latency_and_memory(file, image_files, results):
+    images = [cv2.imread(image_file) for image_file in image_files]
+    if file.endswith(".pt"):
+        model = YOLO(file)
+
+        def predict(image):
+            model.predict(image, imgsz=imgsz, device="cpu", verbose=False)
+
+    else:
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = 1
+        session = onnxruntime.InferenceSession(
+            file, options, providers=["CPUExecutionProvider"]
+        )
+        input_name = session.get_inputs()[0].name
+
+        def predict(image):
+            session.run(None, {input_name: to_blob(image)})
+
+    predict(images[0])  # Warm up.
+    latencies = []
+    for image in images:
+        start_time = time.perf_counter()
+        predict(image)
+        latencies.append((time.perf_counter() - start_time) * 1000)
+    results.put(
+        {
+            "latency_median_ms": float(np.median(latencies)),
+            "latency_p90_ms": float(np.percentile(latencies, 90)),
+            # ru_maxrss is in KB on Linux.
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        }
+    )
+
+
+# Returns a function giving the boxes (N, 6 array of x1, y1, x2, y2, confidence, class id in
+# the image's pixels) predicted by the model at the deployed input size (imgsz).
+def make_predictor(file):
+    import torch
+    from ultralytics.utils import ops
+
+    if file.endswith(".pt"):
+        model = YOLO(file)
+
+        def predict(image):
+            boxes = model.predict(
+                image,
+                imgsz=imgsz,
+                conf=val_conf_threshold,
+                iou=val_iou_threshold,
+                device="cpu",
+                verbose=False,
+            )[0].boxes
+            return boxes.data.numpy()
+
+    else:
+        import onnxruntime
+
+        session = onnxruntime.InferenceSession(file, providers=["CPUExecutionProvider"])
+        input_name = session.get_inputs()[0].name
+
+        def predict(image):
+            output = session.run(None, {input_name: to_blob(image)})[0]
+            boxes = ops.non_max_suppression(
+                torch.from_numpy(output), val_conf_threshold, val_iou_threshold
+            )[0]
+            boxes[:, :4] = ops.scale_boxes(imgsz, boxes[:, :4], image.shape)
+            return boxes.numpy()
+
+    return predict
+
+
+# Labels (N, 5 array of class id, x1, y1, x2, y2 in the image's pixels) of a validation image.
+def read_labels(image_file, image_shape):
+    label_file = img2label_paths([image_file])[0]
+    if not os.path.exists(label_file):
+        return np.zeros((0, 5))
+    labels = np.loadtxt(label_file, ndmin=2)[:, :5]
+    height, width = image_shape[:2]
+    x_center, y_center = labels[:, 1] * width, labels[:, 2] * height
+    w, h = labels[:, 3] * width, labels[:, 4] * height
+    return np.column_stack(
+        (labels[:, 0], x_center - w / 2, y_center - h / 2, x_center + w / 2, y_center + h / 2)
+    )
+
+
+def box_iou(boxes_1, boxes_2):
+    top_left = np.maximum(boxes_1[:, None, :2], boxes_2[None, :, :2])
+    bottom_right = np.minimum(boxes_1[:, None, 2:], boxes_2[None, :, 2:])
+    intersection = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+    area_1 = np.prod(boxes_1[:, 2:] - boxes_1[:, :2], axis=1)
+    area_2 = np.prod(boxes_2[:, 2:] - boxes_2[:, :2], axis=1)
+    return intersection / (area_1[:, None] + area_2[None, :] - intersection + 1e-9)
+
+
+# Whether every prediction is a true positive at the IoU thresholds 0.5:0.95, matched the
+# same way as DetectionValidator.match_predictions of ultralytics.
+def match_predictions(predictions, labels, iou_thresholds):
+    correct = np.zeros((len(predictions), len(iou_thresholds)), dtype=bool)
+    if len(predictions) == 0 or len(labels) == 0:
+        return correct
+    iou = box_iou(labels[:, 1:], predictions[:, :4])
+    iou *= labels[:, :1] == predictions[None, :, 5]
+    for i, iou_threshold in enumerate(iou_thresholds):
+        label_ids, prediction_ids = np.nonzero(iou >= iou_threshold)
+        if len(label_ids) == 0:
+            continue
+        matches = np.column_stack((label_ids, prediction_ids, iou[label_ids, prediction_ids]))
+        matches = matches[matches[:, 2].argsort()[::-1]]
+        matches = matches[np.unique(matches[:, 1], return_index=True)[1]]
+        matches = matches[np.unique(matches[:, 0], return_index=True)[1]]
+        correct[matches[:, 1].astype(int), i] = True
+    return correct
+
+
+# mAP50, mAP50-95 and mAP50-95 of every class (with labels) on the validation images,
+# predicted at the deployed input size: ultralytics' val only takes square sizes for ONNX
+# models, which would not measure the variants as object_detection runs them.
+def measure_accuracy(file, image_files, class_names):
+    predict = make_predictor(file)
+    iou_thresholds = np.linspace(0.5, 0.95, 10)
+    correct, confidences, predicted_classes, label_classes = [], [], [], []
+    for image_file in image_files:
+        image = cv2.imread(image_file)
+        predictions = predict(image)
+        labels = read_labels(image_file, image.shape)
+        correct.append(match_predictions(predictions, labels, iou_thresholds))
+        confidences.append(predictions[:, 4])
+        predicted_classes.append(predictions[:, 5])
+        label_classes.append(labels[:, 0])
+    ap, classes = ap_per_class(
+        np.concatenate(correct),
+        np.concatenate(confidences),
+        np.concatenate(predicted_classes),
+        np.concatenate(label_classes),
+    )[5:7]
+    class_maps = {class_names[int(c)]: float(ap[i].mean()) for i, c in enumerate(classes)}
+    return float(ap[:, 0].mean()), float(ap.mean()), class_maps
+
+
+def evaluate(variant, file, val_files, class_names, latency_files):
+    map50, map50_95, class_maps = measure_accuracy(file, val_files, class_names)
+    result = {
+        "variant": variant,
+        "file_mb": os.path.getsize(file) / 1024**2,
+        "map50": map50,
+        "map50_95": map50_95,
+    }
+    for class_name, class_map in class_maps.items():
+        result["map50_95 " + class_name] = class_map
+
+    results = multiprocessing.get_context("spawn").Queue()
+    process = multiprocessing.get_context("spawn").Process(
+        target=measure_latency_and_memory, args=(file, latency_files, results)
+    )
+    process.start()
+    result.update(results.get())
+    process.join()
+    return result
+
+
+# Marks the variants that lose at most max_map_drop mAP50-95 overall (and max_class_map_drop
+# for every class) compared to the fp32 export.
+def apply_accuracy_gate(results):
+    reference = next(result for result in results if result["variant"] == "fp32")
+    class_keys = [key for key in reference if key.startswith("map50_95 ")]
+    for result in results:
+        result["map_drop"] = reference["map50_95"] - result["map50_95"]
+        worst_class_drop = max(
+            [reference[key] - result[key] for key in class_keys], default=0.0
+        )
+        result["passes_gate"] = (
+            result["map_drop"] <= max_map_drop and worst_class_drop <= max_class_map_drop
+        )
+
+
+def print_table(results):
+    columns = list(results[0].keys())
+    print("| " + " | ".join(columns) + " |")
+    print("|" + "---|" * len(columns))
+    for result in results:
+        values = [
+            "{:.3f}".format(v) if isinstance(v, float) else str(v)
+            for v in result.values()
+        ]
+        print("| " + " | ".join(values) + " |")
+
+
+if __name__ == "__main__":
+    data_yaml_file_absolute_path = os.path.abspath("data.yaml")
+    dataset = check_det_dataset(data_yaml_file_absolute_path)
+    random.seed(random_seed)
+    train_files = get_image_files(dataset["train"])
+    val_files = get_image_files(dataset["val"])
+    calibration_files = random.sample(
+        train_files, min(calibration_image_count, len(train_files))
+    )
+    latency_files = random.sample(val_files, min(latency_image_count, len(val_files)))
+
+    export_fp32()
+    for variant in variants:
+        print("Making the {} variant.".format(variant))
+        make_variant(variant, calibration_files)
+
+    class_names = dataset["names"]
+    results = [evaluate("pt", model_file, val_files, class_names, latency_files)]
+    for variant in ["fp32"] + variants:
+        results.append(
+            evaluate(
+                variant,
+                get_onnx_model_file_name(model_file, imgsz, variant),
+                val_files,
+                class_names,
+                latency_files,
+            )
+        )
+    apply_accuracy_gate(results)
+    print_table(results)
+
+    passing = [r for r in results if r["passes_gate"] and r["variant"] != "pt"]
+    fastest = min(passing, key=lambda result: result["latency_median_ms"])
+    print(
+        "Fastest variant within the accuracy gate: {} ({:.1f}ms, {:.3f} mAP50-95)".format(
+            fastest["variant"], fastest["latency_median_ms"], fastest["map50_95"]
+        )
+    )
+
+    results_file = os.path.splitext(model_file)[0] + "_quantization.csv"
+    with open(results_file, "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=list(results[0].keys()))
+        writer.writeheader()
+        writer.writerows(results)
+    print("Results written to " + results_file)
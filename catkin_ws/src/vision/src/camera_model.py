@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+import threading
+
+import cv2
+import numpy as np
+import rospy
+
+from sensor_msgs.msg import CameraInfo
+
+
+# Direction of every pixel of a camera, in the camera's optical frame (x right, y down,
+# z forward), as a lookup table of unit rays built once per image size. The rays come from
+# the CameraInfo intrinsics and distortion when the camera publishes them, otherwise from
+# the camera's field of view (assuming the angle grows linearly from the center pixel).
+class CameraModel:
+    def __init__(self, camera_info_topic, hfov, vfov, use_camera_info=True):
+        self.hfov = hfov
+        self.vfov = vfov
+        # (K, D, distortion model, width, height) of the last CameraInfo.
+        self.camera_info = None
+        self.lut = None
+        self.lock = threading.Lock()
+        if use_camera_info:
+            self.camera_info_sub = rospy.Subscriber(
+                camera_info_topic, CameraInfo, self.update_camera_info
+            )
+
+    def update_camera_info(self, msg):
+        # Uncalibrated cameras publish a CameraInfo filled with zeros.
+        if msg.K[0] == 0 or msg.width == 0:
+            return
+        camera_info = (
+            tuple(msg.K),
+            tuple(msg.D),
+            msg.distortion_model,
+            msg.width,
+            msg.height,
+        )
+        with self.lock:
+            if camera_info != self.camera_info:
+                self.camera_info = camera_info
+                self.lut = None
+
+    # pixels is an (N, 2) array of pixel coordinates (x, y). Returns their (N, 3) unit rays.
+    def get_rays(self, pixels, image_height, image_width):
+        lut = self.get_lut(image_height, image_width)
+        pixels = np.rint(np.asarray(pixels, dtype=float).reshape(-1, 2)).astype(int)
+        x = np.clip(pixels[:, 0], 0, image_width - 1)
+        y = np.clip(pixels[:, 1], 0, image_height - 1)
+        return lut[y, x]
+
+    def get_lut(self, image_height, image_width):
+        with self.lock:
+            if self.lut is None or self.lut.shape[:2] != (image_height, image_width):
+                if self.camera_info is None:
+                    self.lut = make_fov_lut(image_height, image_width, self.hfov, self.vfov)
+                else:
+                    self.lut = make_camera_info_lut(image_height, image_width, *self.camera_info)
+            return self.lut
+
+
+# Rays of a camera whose angle grows linearly with the distance to the center pixel.
+def make_fov_lut(image_height, image_width, hfov, vfov):
+    x = np.tan(np.radians(hfov * (np.arange(image_width) - image_width / 2) / image_width))
+    y = np.tan(np.radians(vfov * (np.arange(image_height) - image_height / 2) / image_height))
+    rays = np.empty((image_height, image_width, 3), dtype=np.float32)
+    rays[:, :, 0] = x[None, :]
+    rays[:, :, 1] = y[:, None]
+    rays[:, :, 2] = 1
+    return rays / np.linalg.norm(rays, axis=2, keepdims=True)
+
+
+# Rays of a calibrated camera. The intrinsics are scaled if the calibration was done at
+# another resolution than the images.
+def make_camera_info_lut(image_height, image_width, K, D, distortion_model, width, height):
+    K = np.array(K, dtype=float).reshape(3, 3)
+    K[0] *= image_width / width
+    K[1] *= image_height / height
+    # Cameras without distortion can publish no coefficients at all.
+    D = np.array(D, dtype=float) if len(D) > 0 else np.zeros(5)
+    x, y = np.meshgrid(
+        np.arange(image_width, dtype=np.float32), np.arange(image_height, dtype=np.float32)
+    )
+    pixels = np.stack((x, y), axis=-1).reshape(-1, 1, 2)
+    if distortion_model == "equidistant":
+        undistorted = cv2.fisheye.undistortPoints(pixels, K, D[:4])
+    else:
+        undistorted = cv2.undistortPoints(pixels, K, D)
+    rays = np.ones((image_height * image_width, 3), dtype=np.float32)
+    rays[:, :2] = undistorted.reshape(-1, 2)
+    rays /= np.linalg.norm(rays, axis=1, keepdims=True)
+    return rays.reshape(image_height, image_width, 3)
@@ -1,13 +1,28 @@
+import os
+
 import numpy as np
 
-# Given a bounding box and image, returns the image cropped 
-# to the bounding box (to isolate detected objects).
-def crop_to_bbox(image, bbox, copy=True):
+# Pixel bounds (x_min, x_max, y_min, y_max) of a bounding box (x center, y center, w, h).
+def get_bbox_bounds(bbox):
     x_center, y_center, w, h = bbox
     x_min = x_center - w / 2
     y_min = y_center - h / 2
-    x_min, x_max, y_min, y_max = int(x_min), int(x_min + w), int(y_min), int(y_min + h)
+    return int(x_min), int(x_min + w), int(y_min), int(y_min + h)
+
+
+# Given a bounding box and image, returns the image cropped 
+# to the bounding box (to isolate detected objects).
+def crop_to_bbox(image, bbox, copy=True):
+    x_min, x_max, y_min, y_max = get_bbox_bounds(bbox)
     if copy:
         return np.copy(image[y_min:y_max, x_min:x_max])
     else:
-        return image[y_min:y_max, x_min:x_max]
\ No newline at end of file
+        return image[y_min:y_max, x_min:x_max]
+
+
+# File name of the ONNX export of a model (or of one of its variants) for the input size
+# (height, width). Used by inference_backends.py to find the export and by
+# model_pipeline/quantization.py (which runs without ROS) to name the variants.
+def get_onnx_model_file_name(model_file, input_size, variant="fp32"):
+    suffix = "" if variant == "fp32" else "_" + variant
+    return "{}_{}x{}{}.onnx".format(os.path.splitext(model_file)[0], *input_size, suffix)
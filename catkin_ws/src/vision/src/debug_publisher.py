@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+import cv2
+import rospy
+from cv_bridge import CvBridge
+
+from sensor_msgs.msg import CompressedImage, Image
+
+bridge = CvBridge()
+
+
+# Publishes a debug image stream on topic (raw bgr8) and topic/compressed (JPEG, same topic
+# as image_transport so that rqt_image_view can show it over the tether). Images are only
+# encoded for the topics that have subscribers, at most max_rate times per second (0 for no
+# limit). Check is_wanted() before drawing a debug image, so that nothing is drawn either
+# when nobody looks at it.
+class DebugPublisher:
+    def __init__(self, topic, max_rate=None, jpeg_quality=None):
+        if max_rate is None:
+            max_rate = rospy.get_param("debug_image_max_rate", 5)
+        if jpeg_quality is None:
+            jpeg_quality = rospy.get_param("debug_image_jpeg_quality", 80)
+        self.min_interval = 1 / max_rate if max_rate > 0 else 0
+        self.jpeg_quality = jpeg_quality
+        self.last_publish_time = None
+        self.pub = rospy.Publisher(topic, Image, queue_size=1)
+        self.compressed_pub = rospy.Publisher(
+            topic + "/compressed", CompressedImage, queue_size=1
+        )
+
+    def has_subscribers(self):
+        return (
+            self.pub.get_num_connections() > 0
+            or self.compressed_pub.get_num_connections() > 0
+        )
+
+    # Whether the next image would be published: someone is subscribed and the stream is
+    # not over its max. rate.
+    def is_wanted(self):
+        if not self.has_subscribers():
+            return False
+        return (
+            self.last_publish_time is None
+            or (rospy.get_rostime() - self.last_publish_time).to_sec() >= self.min_interval
+        )
+
+    # Publishes the BGR image if it is wanted, returns whether it was.
+    def publish(self, image):
+        if not self.is_wanted():
+            return False
+        self.last_publish_time = rospy.get_rostime()
+        if self.pub.get_num_connections() > 0:
+            msg = bridge.cv2_to_imgmsg(image, "bgr8")
+            msg.header.stamp = self.last_publish_time
+            self.pub.publish(msg)
+        if self.compressed_pub.get_num_connections() > 0:
+            msg = CompressedImage()
+            msg.header.stamp = self.last_publish_time
+            # Same format string as compressed_image_transport.
+            msg.format = "bgr8; jpeg compressed bgr8"
+            msg.data = cv2.imencode(
+                ".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality]
+            )[1].tobytes()
+            self.compressed_pub.publish(msg)
+        return True
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+import json
+import threading
+import time
+from collections import deque
+
+import rospy
+from std_msgs.msg import Float64MultiArray, MultiArrayDimension, String
+
+
+CAMERA_NAMES = ["down_cam", "front_cam"]
+# Number of inference times/starts used for the rolling latency and achieved rate.
+LATENCY_WINDOW = 20
+
+
+# Splits the inference time budget (seconds of inference per second) between the cameras.
+# A camera needs target_rate * latency of the budget to reach its target rate. When the
+# budget is too small for all of them, it is shared proportionally to the priorities, and
+# whatever a camera does not need is given to the others (water filling).
+# Returns the rate (Hz) each camera is allowed to run at.
+def allocate_rates(latencies, target_rates, priorities, budget):
+    demands = [rate * latency for rate, latency in zip(target_rates, latencies)]
+    shares = [0.0] * len(demands)
+    unsatisfied = [i for i, demand in enumerate(demands) if demand > 0]
+    remaining = budget
+    while len(unsatisfied) > 0 and remaining > 1e-9:
+        total_priority = sum(priorities[i] for i in unsatisfied)
+        if total_priority <= 0:
+            break
+        satisfied = []
+        for i in unsatisfied:
+            if demands[i] - shares[i] <= remaining * priorities[i] / total_priority:
+                satisfied.append(i)
+        if len(satisfied) == 0:
+            # Nobody can be fully served, split what is left by priority.
+            for i in unsatisfied:
+                shares[i] += remaining * priorities[i] / total_priority
+            break
+        for i in satisfied:
+            remaining -= demands[i] - shares[i]
+            shares[i] = demands[i]
+            unsatisfied.remove(i)
+    return [
+        min(target_rate, share / latency) if latency > 0 else target_rate
+        for target_rate, share, latency in zip(target_rates, shares, latencies)
+    ]
+
+
+# Decides when each camera's inference worker may run the model next, from the rolling
+# inference latency of each camera's model, the per camera target rates/priorities and
+# the inference time budget. Targets can be changed at runtime by publishing a JSON
+# string to /vision/detection_schedule, e.g.
+#   {"front_cam": {"rate": 0}, "down_cam": {"rate": 10, "priority": 2}, "budget": 0.9}
+# The achieved rates are published on /vision/detection_rates ([down_cam, front_cam] in Hz).
+class DetectionScheduler:
+    def __init__(self):
+        schedule = json.loads(rospy.get_param("object_detection_schedule"))
+        self.budget = rospy.get_param("object_detection_cpu_budget")
+        self.target_rates = [float(schedule[name]["rate"]) for name in CAMERA_NAMES]
+        self.priorities = [float(schedule[name]["priority"]) for name in CAMERA_NAMES]
+
+        self.latencies = [deque(maxlen=LATENCY_WINDOW) for _ in CAMERA_NAMES]
+        self.starts = [deque(maxlen=LATENCY_WINDOW) for _ in CAMERA_NAMES]
+        # Time of the last turn of each camera: a model run or a frame it skipped.
+        self.last_turns = [None for _ in CAMERA_NAMES]
+        self.allowed_rates = list(self.target_rates)
+        self.condition = threading.Condition(threading.RLock())
+
+        self.schedule_sub = rospy.Subscriber(
+            "/vision/detection_schedule", String, self.update_schedule
+        )
+        self.rates_pub = rospy.Publisher(
+            "/vision/detection_rates", Float64MultiArray, queue_size=1
+        )
+        self.rates_timer = rospy.Timer(rospy.Duration(1), self.publish_rates)
+
+    def update_schedule(self, msg):
+        try:
+            schedule = json.loads(msg.data)
+            with self.condition:
+                for i, name in enumerate(CAMERA_NAMES):
+                    if name in schedule:
+                        self.target_rates[i] = float(
+                            schedule[name].get("rate", self.target_rates[i])
+                        )
+                        self.priorities[i] = float(
+                            schedule[name].get("priority", self.priorities[i])
+                        )
+                self.budget = float(schedule.get("budget", self.budget))
+                self.reallocate()
+                # Wake up workers that may be waiting on an old (or disabled) rate.
+                self.condition.notify_all()
+        except (ValueError, TypeError, AttributeError) as e:
+            rospy.logwarn("Invalid detection schedule {}: {}".format(msg.data, e))
+            return
+        rospy.loginfo("Detection schedule updated: {}".format(self.get_schedule()))
+
+    def get_schedule(self):
+        return {
+            name: {"rate": self.target_rates[i], "priority": self.priorities[i]}
+            for i, name in enumerate(CAMERA_NAMES)
+        }
+
+    def get_latency(self, camera_id):
+        latencies = self.latencies[camera_id]
+        if len(latencies) == 0:
+            return 0.0
+        return sum(latencies) / len(latencies)
+
+    def reallocate(self):
+        self.allowed_rates = allocate_rates(
+            [self.get_latency(i) for i in range(len(CAMERA_NAMES))],
+            self.target_rates,
+            self.priorities,
+            self.budget,
+        )
+
+    # Seconds until the camera may run the model again (inf if it is disabled).
+    def time_until_turn(self, camera_id):
+        with self.condition:
+            rate = self.allowed_rates[camera_id]
+            if rate <= 0:
+                return float("inf")
+            if self.last_turns[camera_id] is None:
+                return 0.0
+            return self.last_turns[camera_id] + 1 / rate - time.time()
+
+    # Blocks until the camera may run the model again. Returns False on shutdown.
+    def wait_turn(self, camera_id):
+        with self.condition:
+            while not rospy.is_shutdown():
+                wait = self.time_until_turn(camera_id)
+                if wait <= 0:
+                    return True
+                # Also woken up by schedule updates.
+                self.condition.wait(timeout=min(wait, 0.5))
+        return False
+
+    def start_inference(self, camera_id):
+        with self.condition:
+            self.starts[camera_id].append(time.time())
+            self.last_turns[camera_id] = self.starts[camera_id][-1]
+
+    # Uses the camera's turn without running the model (e.g. on a frame skipped by the motion
+    # gate), which does not count in the achieved rate.
+    def skip_turn(self, camera_id):
+        with self.condition:
+            self.last_turns[camera_id] = time.time()
+
+    def end_inference(self, camera_id, latency):
+        with self.condition:
+            self.latencies[camera_id].append(latency)
+            self.reallocate()
+
+    def get_achieved_rate(self, camera_id):
+        starts = self.starts[camera_id]
+        if len(starts) == 0:
+            return 0.0
+        # Measured up to now, so the rate decays when the camera stops running.
+        return len(starts) / max(time.time() - starts[0], 1e-6)
+
+    def publish_rates(self, _):
+        with self.condition:
+            rates = [self.get_achieved_rate(i) for i in range(len(CAMERA_NAMES))]
+        msg = Float64MultiArray()
+        msg.layout.dim = [
+            MultiArrayDimension(label=",".join(CAMERA_NAMES), size=len(rates), stride=1)
+        ]
+        msg.data = rates
+        self.rates_pub.publish(msg)
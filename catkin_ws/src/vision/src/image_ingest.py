@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+import cv2
+import numpy as np
+
+# Number of channels and conversion to BGR of the encodings the cameras can publish
+# (the down camera publishes bgr8, the ZED bgra8).
+ENCODINGS = {
+    "bgr8": (3, None),
+    "rgb8": (3, cv2.COLOR_RGB2BGR),
+    "bgra8": (4, cv2.COLOR_BGRA2BGR),
+    "rgba8": (4, cv2.COLOR_RGBA2BGR),
+    "mono8": (1, cv2.COLOR_GRAY2BGR),
+}
+
+
+# Read-only view (height, width, channels) of the pixels of a sensor_msgs/Image, the data of
+# the message is not copied. Rows padded to msg.step are handled by the strides of the view.
+def image_view(msg):
+    if msg.encoding not in ENCODINGS:
+        raise ValueError(
+            "Unsupported image encoding {} (expected one of {})".format(
+                msg.encoding, list(ENCODINGS)
+            )
+        )
+    channels, _ = ENCODINGS[msg.encoding]
+    data = np.frombuffer(msg.data, dtype=np.uint8, count=msg.height * msg.step)
+    rows = data.reshape(msg.height, msg.step)[:, : msg.width * channels]
+    return rows.reshape(msg.height, msg.width, channels)
+
+
+# Turns the image messages of one camera into BGR images without allocating per frame:
+# bgr8 images are read-only views of the message, other encodings are converted into a
+# buffer that is reused from frame to frame. The image returned is only valid until the
+# next call, and must not be drawn on (copy it for debug images).
+class ImageIngest:
+    def __init__(self):
+        self.bgr_buffer = None
+
+    def to_bgr(self, msg):
+        image = image_view(msg)
+        _, conversion = ENCODINGS[msg.encoding]
+        if conversion is None:
+            return image
+        if self.bgr_buffer is None or self.bgr_buffer.shape[:2] != image.shape[:2]:
+            self.bgr_buffer = np.empty(image.shape[:2] + (3,), dtype=np.uint8)
+        cv2.cvtColor(image, conversion, dst=self.bgr_buffer)
+        return self.bgr_buffer
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+
+import argparse
+import ast
+import os
+import subprocess
+import sys
+
+import cv2
+import numpy as np
+import rospy
+
+from common_utils import get_onnx_model_file_name
+
+# Every backend returns one box array per image, of shape (N, 6) with one row per box:
+# x center, y center, width, height (in pixels of the input image), confidence, class id.
+BOX_CONF = 4
+BOX_CLS = 5
+
+# Same defaults as ultralytics' predict, boxes below min_prediction_confidence are
+# filtered out later in detection_frame. Backends can be given a lower confidence threshold
+# (e.g. for the uncertain boxes of the cascade).
+CONF_THRESHOLD = 0.25
+IOU_THRESHOLD = 0.7
+MAX_DETECTIONS = 300
+# Offset between the boxes of different classes so that NMS is done per class.
+MAX_WH = 7680
+
+
+# Runs the model with ultralytics (PyTorch), on the GPU when there is one.
+class UltralyticsBackend:
+    def __init__(self, model_file, conf_threshold=CONF_THRESHOLD):
+        # Imported here so that the other backends do not load torch.
+        import torch
+        from ultralytics import YOLO
+
+        self.model = YOLO(model_file)
+        self.conf_threshold = conf_threshold
+        if torch.cuda.is_available():
+            self.device = 0
+            self.model.to(torch.device("cuda"))
+        else:
+            rospy.logwarn("CUDA is not available! YOLO inference will run on CPU.")
+            self.device = "cpu"
+
+    # input_size (height, width) overrides the model's input size, e.g. for small crops.
+    def predict(self, images, verbose=False, input_size=None):
+        kwargs = {} if input_size is None else {"imgsz": list(input_size)}
+        results = self.model.predict(
+            images, device=self.device, verbose=verbose, conf=self.conf_threshold, **kwargs
+        )
+        boxes = [result.boxes.cpu().numpy() for result in results]
+        return [
+            np.column_stack((b.xywh, b.conf, b.cls)).astype(np.float32) for b in boxes
+        ]
+
+
+# Runs the model exported to ONNX with ONNX Runtime on the CPU. The model is exported
+# once (and again whenever the .pt file changes), the export is cached next to it.
+class OnnxRuntimeBackend:
+    def __init__(self, model_file, conf_threshold=CONF_THRESHOLD):
+        import onnxruntime
+
+        input_size = ast.literal_eval(rospy.get_param("onnx_input_size"))
+        # "fp32" (plain export) or a variant made by model_pipeline/quantization.py.
+        variant = rospy.get_param("onnx_model_variant", "fp32")
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = rospy.get_param("onnx_intra_op_threads")
+        options.inter_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(
+            get_onnx_model_file(model_file, input_size, variant),
+            options,
+            providers=["CPUExecutionProvider"],
+        )
+        self.input_name = self.session.get_inputs()[0].name
+        self.input_size = tuple(input_size)
+        self.conf_threshold = conf_threshold
+        # Letterboxed images and input blob by (batch size, height, width), reused between
+        # frames so that preprocessing does not allocate frame sized arrays.
+        self.input_buffers = {}
+
+    def get_input_buffers(self, batch_size, input_h, input_w):
+        key = (batch_size, input_h, input_w)
+        if key not in self.input_buffers:
+            self.input_buffers[key] = (
+                np.empty((batch_size, input_h, input_w, 3), dtype=np.uint8),
+                np.empty((batch_size, 3, input_h, input_w), dtype=np.float32),
+            )
+        return self.input_buffers[key]
+
+    # input_size (height, width) overrides the export's input size, e.g. for small crops
+    # (the export has dynamic axes).
+    def predict(self, images, verbose=False, input_size=None):
+        if isinstance(images, np.ndarray):
+            images = [images]
+        input_h, input_w = self.input_size if input_size is None else input_size
+        padded, blob = self.get_input_buffers(len(images), input_h, input_w)
+        letterboxes = [letterbox(image, out) for image, out in zip(images, padded)]
+        to_blob(padded, blob)
+        outputs = self.session.run(None, {self.input_name: blob})[0]
+        boxes = [
+            decode_predictions(output, image.shape[:2], scale, left, top, self.conf_threshold)
+            for output, image, (scale, left, top) in zip(outputs, images, letterboxes)
+        ]
+        if verbose:
+            print("{} images: {} boxes".format(len(images), [len(b) for b in boxes]))
+        return boxes
+
+
+# Resizes the image to fit out (the model input, of shape (input_h, input_w, 3)) and pads it,
+# same as ultralytics' letterbox. Returns the scale and the left and top padding.
+def letterbox(image, out):
+    h, w = image.shape[:2]
+    input_h, input_w = out.shape[:2]
+    scale = min(input_h / h, input_w / w)
+    new_w, new_h = int(round(w * scale)), int(round(h * scale))
+    top = int(round((input_h - new_h) / 2 - 0.1))
+    left = int(round((input_w - new_w) / 2 - 0.1))
+    out[:top] = 114
+    out[top + new_h :] = 114
+    out[top : top + new_h, :left] = 114
+    out[top : top + new_h, left + new_w :] = 114
+    resized = out[top : top + new_h, left : left + new_w]
+    if (new_w, new_h) != (w, h):
+        cv2.resize(image, (new_w, new_h), dst=resized, interpolation=cv2.INTER_LINEAR)
+    else:
+        resized[:] = image
+    return scale, left, top
+
+
+# BGR NHWC uint8 -> RGB NCHW float32 in [0, 1] (same as cv2.dnn.blobFromImages with
+# swapRB), written into blob.
+def to_blob(images, blob):
+    np.multiply(
+        images[..., ::-1].transpose(0, 3, 1, 2), np.float32(1 / 255.0), out=blob, casting="unsafe"
+    )
+    return blob
+
+
+# Turns the raw output of a YOLOv8 head for one image, of shape (4 + classes, anchors),
+# into a box array in the coordinates of the original image (boxes with a confidence below
+# conf_threshold are dropped).
+def decode_predictions(output, image_shape, scale, left, top, conf_threshold=CONF_THRESHOLD):
+    scores = output[4:]
+    cls = scores.argmax(axis=0)
+    conf = scores[cls, np.arange(scores.shape[1])]
+    keep = conf >= conf_threshold
+    xywh, conf, cls = output[:4, keep].T, conf[keep], cls[keep]
+
+    # Undo the letterbox and clip to the image.
+    image_h, image_w = image_shape
+    xyxy = np.empty_like(xywh)
+    xyxy[:, 0] = np.clip((xywh[:, 0] - xywh[:, 2] / 2 - left) / scale, 0, image_w)
+    xyxy[:, 1] = np.clip((xywh[:, 1] - xywh[:, 3] / 2 - top) / scale, 0, image_h)
+    xyxy[:, 2] = np.clip((xywh[:, 0] + xywh[:, 2] / 2 - left) / scale, 0, image_w)
+    xyxy[:, 3] = np.clip((xywh[:, 1] + xywh[:, 3] / 2 - top) / scale, 0, image_h)
+
+    keep = non_max_suppression(xyxy + cls[:, None] * MAX_WH, conf, IOU_THRESHOLD)
+    xyxy, conf, cls = xyxy[keep], conf[keep], cls[keep]
+    return np.column_stack(
+        (
+            (xyxy[:, 0] + xyxy[:, 2]) / 2,
+            (xyxy[:, 1] + xyxy[:, 3]) / 2,
+            xyxy[:, 2] - xyxy[:, 0],
+            xyxy[:, 3] - xyxy[:, 1],
+            conf,
+            cls,
+        )
+    ).astype(np.float32)
+
+
+# Merges box arrays (e.g. of overlapping crops of the same image), keeping only the most
+# confident box of each object.
+def merge_boxes(boxes):
+    boxes = np.concatenate(boxes)
+    xyxy = np.column_stack(
+        (
+            boxes[:, 0] - boxes[:, 2] / 2,
+            boxes[:, 1] - boxes[:, 3] / 2,
+            boxes[:, 0] + boxes[:, 2] / 2,
+            boxes[:, 1] + boxes[:, 3] / 2,
+        )
+    )
+    keep = non_max_suppression(
+        xyxy + boxes[:, BOX_CLS, None] * MAX_WH, boxes[:, BOX_CONF], IOU_THRESHOLD
+    )
+    return boxes[keep]
+
+
+# Greedy NMS, returns the indices of the boxes (x1, y1, x2, y2) to keep, best first.
+def non_max_suppression(boxes, scores, iou_threshold, max_detections=MAX_DETECTIONS):
+    x1, y1, x2, y2 = boxes.T
+    areas = (x2 - x1) * (y2 - y1)
+    order = scores.argsort()[::-1]
+    keep = []
+    while order.size > 0 and len(keep) < max_detections:
+        i = order[0]
+        keep.append(i)
+        others = order[1:]
+        inter_w = np.maximum(0, np.minimum(x2[i], x2[others]) - np.maximum(x1[i], x1[others]))
+        inter_h = np.maximum(0, np.minimum(y2[i], y2[others]) - np.maximum(y1[i], y1[others]))
+        inter = inter_w * inter_h
+        iou = inter / np.maximum(areas[i] + areas[others] - inter, 1e-9)
+        order = others[iou <= iou_threshold]
+    return np.array(keep, dtype=int)
+
+
+# Returns the cached ONNX export of the model, exporting it first if needed.
+# Quantized variants are not made here, they must be made with model_pipeline/quantization.py.
+def get_onnx_model_file(model_file, input_size, variant="fp32"):
+    if variant != "fp32":
+        onnx_file = get_onnx_model_file_name(model_file, input_size, variant)
+        if not os.path.exists(onnx_file):
+            raise FileNotFoundError(
+                "{} not found, make it with model_pipeline/quantization.py".format(onnx_file)
+            )
+        return onnx_file
+    onnx_file = get_onnx_model_file_name(model_file, input_size)
+    if not os.path.exists(onnx_file) or os.path.getmtime(onnx_file) < os.path.getmtime(
+        model_file
+    ):
+        rospy.loginfo("Exporting {} to ONNX.".format(model_file))
+        # Exported in another process so that torch is never loaded into the node.
+        subprocess.run(
+            [sys.executable, os.path.abspath(__file__), model_file, "--input-size"]
+            + [str(size) for size in input_size],
+            check=True,
+        )
+    return onnx_file
+
+
+def export_onnx_model(model_file, input_size):
+    from ultralytics import YOLO
+
+    exported_file = YOLO(model_file).export(
+        format="onnx", imgsz=list(input_size), dynamic=True, simplify=True
+    )
+    onnx_file = get_onnx_model_file_name(model_file, input_size)
+    os.replace(exported_file, onnx_file)
+    return onnx_file
+
+
+BACKENDS = {"ultralytics": UltralyticsBackend, "onnxruntime": OnnxRuntimeBackend}
+
+
+def load_backend(backend, model_file, conf_threshold=CONF_THRESHOLD):
+    if backend not in BACKENDS:
+        raise ValueError(
+            "Unknown inference backend {} (expected one of {})".format(backend, list(BACKENDS))
+        )
+    return BACKENDS[backend](model_file, conf_threshold)
+
+
+if __name__ == "__main__":
+    # Exports models to ONNX ahead of time, e.g. when building the sim image.
+    parser = argparse.ArgumentParser(description="Export YOLO models to ONNX")
+    parser.add_argument("model_files", nargs="+")
+    parser.add_argument("--input-size", type=int, nargs=2, default=[480, 640], metavar=("H", "W"))
+    args = parser.parse_args()
+    for model_file in args.model_files:
+        print("Exported " + export_onnx_model(model_file, args.input_size))
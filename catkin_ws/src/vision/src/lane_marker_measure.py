@@ -4,10 +4,11 @@ import rospy
 import cv2
 import numpy as np
 import math
+import time
 from cv_bridge import CvBridge
 
 from common_utils import crop_to_bbox
-from sensor_msgs.msg import Image
+from debug_publisher import DebugPublisher
 
 
 ############## Utils Parameters ###############
@@ -15,26 +16,91 @@ LONGEST_DOWNSCALED_SIZE = rospy.get_param("lane_marker_downscaling_size")
 BLUR1_AMT = rospy.get_param("lane_marker_blur_1_amt")
 BLUR2_AMT = rospy.get_param("lane_marker_blur_2_amt")
 COLOR_TOLERANCE = rospy.get_param("lane_marker_color_tolerance")
+# "iterative" runs cv2.HoughLines once per lane marker edge, "clustered" runs it
+# once and clusters its peaks in (rho, theta) space.
+HOUGH_MODE = rospy.get_param("lane_marker_hough_mode", "iterative")
+# "hough" measures headings from the lane marker edges (measure_headings),
+# "moments" from the principal axes of its arms (measure_headings_moments).
+HEADING_ENGINE = rospy.get_param("lane_marker_heading_engine", "hough")
 TESTING = rospy.get_param("testing", False)
 
 HEADING_COLOR = (255, 0, 0)  # Blue
+OVERLAY_COLOR = (0, 255, 0)  # Green
+DILATION_KERNEL_RADIUS = 2  # Same as dilating with a 5x5 kernel.
+MIN_LANE_MARKER_COVERAGE = 0.2  # Min. fraction of the thresholded image that must be black.
+MAX_EDGE_LINES = 4  # One per side of the lane marker.
+HOUGH_THRESHOLD = 25  # Min. number of edge pixels on a line.
+HOUGH_THETA_TOLERANCE = np.pi / 18  # Max. angle between two peaks of the same edge.
+# Max. ratio between the smallest and largest variance of a lane marker's
+# pixels for it to be considered straight.
+MAX_STRAIGHT_VARIANCE_RATIO = 0.02
+# Min. angle between both arms of a lane marker for it to be considered bent.
+MIN_BEND_ANGLE = 20
 bridge = CvBridge()
 
-pub_cropped_image = rospy.Publisher("/vision/down_cam/cropped", Image, queue_size=1)
+pub_cropped_image = DebugPublisher("/vision/down_cam/cropped")
+
+# Set to a dictionary to accumulate the time (seconds) spent in every
+# stage of the lane marker measurement (used for benchmarking).
+stage_times = None
 ###############################################
 
 
-# Checks if color1 similar enough (within tolerance) to color2.
-# Assumes color is in BGR.
-def colors_are_equal(color1, color2):
-    # Make color brightnesses the same (just care about color ratios, 
-    # not brightness/saturation) by making max value 255 in any channel.
-    color1 += min((255, 255, 255) - color1)
-    color2 += min((255, 255, 255) - color2)
-    for i in (0, 1, 2):
-        if max(color1[i], color2[i]) - min(color1[i], color2[i]) > COLOR_TOLERANCE * 255:
-            return False
-    return True
+# Adds the time elapsed since start_time to the given stage (if stage_times
+# is being recorded) and returns the current time (start of the next stage).
+def record_stage_time(stage, start_time):
+    current_time = time.perf_counter()
+    if stage_times is not None:
+        stage_times[stage] = stage_times.get(stage, 0) + current_time - start_time
+    return current_time
+
+
+# Lines (start, end) and contours found while measuring a lane marker, drawn on the debug
+# image by draw_overlay. Kept apart from the debug image so that measurements made in
+# worker processes can send them back to be drawn.
+def new_overlay():
+    return {"lines": [], "contours": []}
+
+
+def draw_overlay(debug_image, overlay):
+    for start, end in overlay["lines"]:
+        cv2.line(debug_image, start, end, OVERLAY_COLOR, 2)
+    if len(overlay["contours"]) > 0:
+        cv2.drawContours(debug_image, overlay["contours"], -1, OVERLAY_COLOR, 2)
+
+
+# Make color brightnesses the same (just care about color ratios,
+# not brightness/saturation) by making max value 255 in any channel.
+# Works on a single BGR color or on a whole BGR image at once.
+def normalize_brightness(colors):
+    return colors + np.min(255 - colors, axis=-1, keepdims=True)
+
+
+# Checks which colors are similar enough (within tolerance) to color.
+# Colors can be a single BGR color or a whole BGR image, returns a
+# boolean (or boolean array with the shape of the image without channels).
+def colors_are_equal(colors, color):
+    colors = np.int16(normalize_brightness(colors))
+    color = np.int16(normalize_brightness(color))
+    return np.all(np.abs(colors - color) <= COLOR_TOLERANCE * 255, axis=-1)
+
+
+# Given a black and white (single channel) image, returns for every pixel
+# the number of dilations of the black pixels (with a square kernel of radius
+# DILATION_KERNEL_RADIUS) needed for that pixel to become black.
+# Dilating k times is the same as keeping every pixel within a chessboard
+# distance of k * DILATION_KERNEL_RADIUS to a black pixel, so a single distance
+# transform replaces any number of cv2.dilate calls.
+def get_dilation_iterations_map(thresh_image):
+    distances = cv2.distanceTransform(thresh_image, cv2.DIST_C, 3)
+    return np.int32(np.ceil(distances / DILATION_KERNEL_RADIUS))
+
+
+# Returns the least number of dilations needed for the black pixels
+# to cover at least min_coverage of the image.
+def get_dilation_iterations_for_coverage(iterations_map, min_coverage):
+    coverage = np.cumsum(np.bincount(iterations_map.ravel())) / iterations_map.size
+    return int(np.argmax(coverage >= min_coverage))
 
 
 # Receives a cv2 image and returns a black and white cv2 image 
@@ -47,6 +113,7 @@ def threshold_red_to_black(
     blur2_publisher=None,
     thresh_publisher=None,
 ):
+    start_time = time.perf_counter()
     if min(image.shape[0], image.shape[1]) > LONGEST_DOWNSCALED_SIZE:
         scaling_factor = LONGEST_DOWNSCALED_SIZE / min(image.shape[0], image.shape[1])
         downscaled_size = (
@@ -56,6 +123,7 @@ def threshold_red_to_black(
     else:
         downscaled_size = (image.shape[1], image.shape[0])
     downscaled = cv2.resize(image, dsize=downscaled_size, interpolation=cv2.INTER_AREA)
+    start_time = record_stage_time("downscale", start_time)
 
     if BLUR1_AMT > 0:
         blurred = cv2.blur(
@@ -67,16 +135,13 @@ def threshold_red_to_black(
         )
     else:
         blurred = downscaled
-    image_b, image_g, image_r = cv2.split(blurred)
+    start_time = record_stage_time("blur", start_time)
     # Normalize colors so that the max color channel in every pixel is 255.
-    max_brightness_increase = np.min(255 - blurred, axis=2)
-    ratio_image = np.uint32(image_r + max_brightness_increase) / (
-        np.uint32(image_g + max_brightness_increase)
-        + np.uint32(image_b + max_brightness_increase)
-        + np.uint32(image_r + max_brightness_increase)
-    )
-    max_i = np.argmax(ratio_image)  # Get largest value in red color channel.
-    max_pixel = blurred[math.floor(max_i / blurred.shape[1])][max_i % blurred.shape[1]]
+    normalized = np.uint32(normalize_brightness(blurred))
+    image_b, image_g, image_r = normalized[:, :, 0], normalized[:, :, 1], normalized[:, :, 2]
+    ratio_image = image_r / (image_g + image_b + image_r)
+    # Get largest value in red color channel.
+    max_pixel = blurred[np.unravel_index(np.argmax(ratio_image), ratio_image.shape)]
     if downscale_publisher != None:
         downscale_publisher.publish(
             bridge.cv2_to_imgmsg(downscaled, "bgr8")
@@ -86,30 +151,19 @@ def threshold_red_to_black(
             bridge.cv2_to_imgmsg(blurred, "bgr8")
         )  # For adjusting values.
 
-    def mask(x):
-        # Return black (0,0,0) if similar to max_red within tolerance.
-        # Otherwise, return white (255,255,255).
-        if colors_are_equal(x, max_pixel):
-            return (0, 0, 0)
-        else:
-            return (255, 255, 255)
-
-    thresh_image = np.uint8(np.zeros(blurred.shape))
-    for r in range(len(blurred)):
-        for p in range(len(blurred[r])):
-            thresh_image[r][p] = mask(blurred[r][p])
-
-    dilation_kernel = np.ones((5, 5), np.uint8)
-    inverted_thresh_image = cv2.bitwise_not(thresh_image)
-    while (
-        np.sum(inverted_thresh_image)
-        / (255 * 3 * inverted_thresh_image.shape[0] * inverted_thresh_image.shape[1])
-        < 0.2
-    ):
-        inverted_thresh_image = cv2.dilate(
-            inverted_thresh_image, dilation_kernel, iterations=1
-        )
-    thresh_image = cv2.bitwise_not(inverted_thresh_image)
+    # Black (0,0,0) where similar to max_pixel within tolerance.
+    # Otherwise, white (255,255,255).
+    thresh_image = np.full(blurred.shape, 255, np.uint8)
+    thresh_image[colors_are_equal(blurred, max_pixel)] = 0
+    start_time = record_stage_time("threshold", start_time)
+
+    # Dilate the black pixels until they cover at least MIN_LANE_MARKER_COVERAGE.
+    iterations_map = get_dilation_iterations_map(thresh_image[:, :, 0])
+    iterations = get_dilation_iterations_for_coverage(
+        iterations_map, MIN_LANE_MARKER_COVERAGE
+    )
+    thresh_image[iterations_map <= iterations] = 0
+    start_time = record_stage_time("dilate", start_time)
 
     if tol_publisher != None:
         tol_publisher.publish(
@@ -121,6 +175,7 @@ def threshold_red_to_black(
         dsize=(int(image.shape[1]), int(image.shape[0])),
         interpolation=cv2.INTER_AREA,
     )
+    start_time = record_stage_time("upscale", start_time)
     if BLUR2_AMT > 0:
         thresh_image = cv2.blur(
             thresh_image,
@@ -133,6 +188,7 @@ def threshold_red_to_black(
         blur2_publisher.publish(
             bridge.cv2_to_imgmsg(thresh_image, "bgr8")
         )  # For adjusting values.
+    start_time = record_stage_time("blur", start_time)
 
     thresh_image = cv2.cvtColor(
         thresh_image, cv2.COLOR_BGR2GRAY
@@ -140,6 +196,7 @@ def threshold_red_to_black(
     ret, thresh_image = cv2.threshold(
         thresh_image, 70, 255, 0
     )  # Convert grayscale to black and white with a threshold.
+    record_stage_time("threshold", start_time)
 
     if thresh_publisher != None:
         thresh_publisher.publish(
@@ -188,14 +245,119 @@ def angle_between_lines(l1, l2):
         return angle_diff
 
 
+# Given a line in polar form (as returned by cv2.HoughLines), returns two
+# points far apart on the line and the line in the form (slope, y intercept).
+def get_line_from_polar(rho, theta):
+    # Compute line coordinates in image using rho and theta.
+    a = np.cos(theta)
+    b = np.sin(theta)
+    x0 = a * rho
+    y0 = b * rho
+    x1 = int(x0 + 3000 * (-b))
+    y1 = int(y0 + 3000 * (a))
+    x2 = int(x0 - 3000 * (-b))
+    y2 = int(y0 - 3000 * (a))
+    # Calculate slope from start and end points of line.
+    if (x2 - x1) == 0:
+        slope = 1000000
+    else:
+        slope = (y2 - y1) / (x2 - x1)
+    # y = mx+b.
+    # Slope is m, intercept is b.
+    # Therefore the slope is b = y-mx for any point on the line.
+    intercept = y1 - slope * x1
+    return (x1, y1), (x2, y2), (slope, intercept)
+
+
+# Returns up to MAX_EDGE_LINES lines (slope, y intercept) found in the edges image
+# by running cv2.HoughLines once per line and removing every line found from
+# the edges image before the next run. The lines are added to the overlay.
+def get_edge_lines_iterative(edges, overlay, debug=False):
+    lines = []
+    while len(lines) < MAX_EDGE_LINES:
+        if debug:
+            cv2.imshow("remaining edges", edges)
+            cv2.waitKey(0)
+        # Find most prominent line in the image.
+        hough_lines = cv2.HoughLines(edges, 1, np.pi / 180, HOUGH_THRESHOLD)
+        if hough_lines is None:
+            break
+        rho, theta = hough_lines[0][0]
+        start, end, line = get_line_from_polar(rho, theta)
+        lines.append(line)
+        # Remove the line from the edges image by drawing the line with
+        # extra thickness. This covers up the line that was detected
+        # (edges are in white, the line is drawn in black).
+        line_thickness = max(int(0.05 * min(edges.shape)), 1)
+        cv2.line(edges, start, end, (0, 0, 0), line_thickness)
+        # Draw the new line we found on top of the original image.
+        overlay["lines"].append((start, end))
+    if debug:
+        cv2.imshow("remaining edges", edges)
+        cv2.waitKey(0)
+    return lines
+
+
+# Returns up to MAX_EDGE_LINES lines (slope, y intercept) found in the edges image
+# with a single cv2.HoughLines run. Its peaks are clustered in (rho, theta) space
+# so that only one line is kept per lane marker edge, and every peak is re-scored
+# using only the edge pixels which are not already covered by a kept line. The votes
+# are approximated (edge pixels less than half a pixel from the line), so the lines are
+# approximately those of get_edge_lines_iterative (test_hough_modes_agree checks the
+# measured headings agree on the test images) without rerunning cv2.HoughLines.
+def get_edge_lines_clustered(edges, overlay):
+    hough_lines = cv2.HoughLines(edges, 1, np.pi / 180, HOUGH_THRESHOLD)
+    if hough_lines is None:
+        return []
+    rhos, thetas = hough_lines[:, 0, 0], hough_lines[:, 0, 1]
+    line_thickness = max(int(0.05 * min(edges.shape)), 1)
+    edge_ys, edge_xs = np.nonzero(edges)
+    # Distance of every edge pixel to every peak's line (one row per peak).
+    distances = (
+        np.outer(np.cos(thetas), edge_xs) + np.outer(np.sin(thetas), edge_ys)
+    ) - rhos[:, None]
+    # Edge pixels which vote for each peak's accumulator cell.
+    votes = np.abs(distances) < 0.5
+    is_uncovered = np.ones(len(edge_xs), dtype=bool)
+    is_candidate = np.ones(len(rhos), dtype=bool)
+    lines = []
+    while len(lines) < MAX_EDGE_LINES:
+        remaining_votes = np.where(is_candidate, np.sum(votes & is_uncovered, axis=1), 0)
+        best_i = np.argmax(remaining_votes)
+        if remaining_votes[best_i] < HOUGH_THRESHOLD:
+            break
+        start, end, line = get_line_from_polar(rhos[best_i], thetas[best_i])
+        lines.append(line)
+        # Draw the new line we found on top of the original image.
+        overlay["lines"].append((start, end))
+        # Edge pixels close to the new line are covered by it.
+        is_uncovered &= np.abs(distances[best_i]) > line_thickness / 2
+        # (rho, theta) and (-rho, theta - pi) are the same line, so compare
+        # every peak to the closest of both representations.
+        theta_diffs = thetas - thetas[best_i]
+        is_wrapped = np.abs(theta_diffs) > np.pi / 2
+        theta_diffs[is_wrapped] -= np.pi * np.sign(theta_diffs[is_wrapped])
+        rho_diffs = np.where(is_wrapped, -rhos, rhos) - rhos[best_i]
+        is_candidate &= (np.abs(rho_diffs) > line_thickness) | (
+            np.abs(theta_diffs) > HOUGH_THETA_TOLERANCE
+        )
+    return lines
+
+
 # Given an image containing a lane marker, returns one slope per lane 
 # marker heading (relative to the image's x/y axis) (i.e, it should return two slopes).
 # Returns lines have the format (l1, l2) where l1 is the heading that is closest to that 
 # of the AUV, and l2 is the heading where the AUV should go should also return center point 
 # of lane marker (or most central point if not completely contained in image)).
-def measure_headings(image, debug=False, debug_image=None):
-    if debug_image is None:
-        debug_image = image
+def measure_headings(image, debug=False, debug_image=None, hough_mode=HOUGH_MODE):
+    overlay = new_overlay()
+    headings = measure_headings_overlay(image, overlay, debug, hough_mode)
+    draw_overlay(image if debug_image is None else debug_image, overlay)
+    return headings
+
+
+# Same as measure_headings, but the edge lines are added to the overlay instead of being drawn.
+def measure_headings_overlay(image, overlay, debug=False, hough_mode=HOUGH_MODE):
     if debug:
         cv2.imshow("original", image)
         cv2.waitKey(0)
@@ -204,53 +366,22 @@ def measure_headings(image, debug=False, debug_image=None):
         cv2.imshow("thresholded/black and white", thresh_image)
         cv2.waitKey(0)
     # Get edges of thresholded image (should get the edges of the lane marker).
+    start_time = time.perf_counter()
     edges = cv2.Canny(thresh_image, 50, 150, apertureSize=3)
-    lines = []
-    # Only want up to 4 slopes (one per side of the lane marker).
-    while len(lines) < 4:
-        if debug:
-            cv2.imshow("remaining edges", edges)
-            cv2.waitKey(0)
-            pass
-        # Find most prominent line in the image.
-        line = cv2.HoughLines(edges, 1, np.pi / 180, 25)
-        # We use a try statement in case no lines are found
-        # when no lines are found a typeerror is thrown.
-        try:
-            for rho, theta in line[0]:
-                # Compute line coordinates in image using rho and theta.
-                a = np.cos(theta)
-                b = np.sin(theta)
-                x0 = a * rho
-                y0 = b * rho
-                x1 = int(x0 + 3000 * (-b))
-                y1 = int(y0 + 3000 * (a))
-                x2 = int(x0 - 3000 * (-b))
-                y2 = int(y0 - 3000 * (a))
-                # Calculate slope from start and end points of line.
-                if (x2 - x1) == 0:
-                    slope = 1000000
-                else:
-                    slope = (y2 - y1) / (x2 - x1)
-                # y = mx+b.
-                # Slope is m, intercept is b.
-                # Therefore the slope is b = y-mx for any point on the line.
-                intercept = y1 - slope * x1
-                lines.append((slope, intercept))
-                # Draw the new line we found on top of the original image.
-                # Remove the line from the edges image by drawing the line with 
-                # extra thickness. This covers up the line that was detected 
-                # (edges are in white, the line is drawn in black).
-                line_thickness = max(int(0.05 * min(edges.shape)), 1)
-                cv2.line(edges, (x1, y1), (x2, y2), (0, 0, 0), line_thickness)
-                cv2.line(debug_image, (x1, y1), (x2, y2), (0, 255, 0), 2)
-        except TypeError:
-            break
-    if debug:
-        cv2.imshow("remaining edges", edges)
-        cv2.waitKey(0)
-        pass
+    start_time = record_stage_time("canny", start_time)
+    if hough_mode == "clustered":
+        lines = get_edge_lines_clustered(edges, overlay)
+    else:
+        lines = get_edge_lines_iterative(edges, overlay, debug)
+    start_time = record_stage_time("hough", start_time)
+    headings = get_headings_from_edge_lines(lines, thresh_image)
+    record_stage_time("center", start_time)
+    return headings
+
 
+# Given the lines on the edges of a lane marker (at most 4) and the thresholded
+# image, returns the headings and center point of the lane marker (see measure_headings).
+def get_headings_from_edge_lines(lines, thresh_image):
     if len(lines) < 2:
         return None, None
     elif len(lines) < 4:
@@ -335,21 +466,18 @@ def measure_headings(image, debug=False, debug_image=None):
             or centerPoint[1] >= thresh_image.shape[0]
         ):
             return None, None
-        avgs = []
-        for slope in finalLines:
-            dilation_kernel = np.ones((5, 5), np.uint8)
-            inverted_thresh_image = cv2.bitwise_not(thresh_image)
-            while (
-                not inverted_thresh_image[int(centerPoint[1])][int(centerPoint[0])] == 255
-            ):
-                inverted_thresh_image = cv2.dilate(
-                    inverted_thresh_image, dilation_kernel, iterations=1
-                )
-            thresh_image = cv2.bitwise_not(inverted_thresh_image)
-            negStepsWithLM = get_step_with_LM(thresh_image, slope, -1, centerPoint)
-            posStepsWithLM = get_step_with_LM(thresh_image, slope, 1, centerPoint)
-            avgs.append([slope, posStepsWithLM, 1])
-            avgs.append([slope, negStepsWithLM, -1])
+        # Dilate the lane marker until the center point is part of it.
+        iterations_map = get_dilation_iterations_map(thresh_image)
+        thresh_image[
+            iterations_map <= iterations_map[int(centerPoint[1])][int(centerPoint[0])]
+        ] = 0
+        # Count lane marker pixels along both directions of both headings.
+        slopes = [finalLines[0], finalLines[0], finalLines[1], finalLines[1]]
+        directions = [1, -1, 1, -1]
+        stepsWithLM = get_steps_with_LM(thresh_image, slopes, directions, centerPoint)
+        avgs = [
+            [slopes[i], stepsWithLM[i], directions[i]] for i in range(len(slopes))
+        ]
         s1 = max(avgs, key=lambda x: x[1])
         avgs.remove(s1)
         s2 = max(avgs, key=lambda x: x[1])
@@ -384,25 +512,169 @@ def measure_headings(image, debug=False, debug_image=None):
         return finalLines, centerPoint
 
 
-def get_step_with_LM(image, slope, direction, center_point, lm_color=0):
-    x, y = center_point
+# For every ray starting at center_point and going along slopes[i] in directions[i]
+# (1 for positive x, -1 for negative x), counts how many of the sampled pixels
+# until the edge of the image are lane marker pixels. All the rays are sampled at once.
+def get_steps_with_LM(image, slopes, directions, center_point, lm_color=0):
     num_steps = 50
-    if abs(slope) > 1: # Slopes that change faster in y than x.
-        step_y = image.shape[0] / (2 * num_steps)
-        if slope < 0:
-            step_y *= -1.0 # Step_y must always have same sign as the slope.
-        step_x = abs(step_y / slope) # Step_x must always be positive.
-    else:
-        step_x = image.shape[1] / (2 * num_steps)
-        step_y = slope * step_x
+    slopes = np.asarray(slopes, dtype=float)
+    directions = np.asarray(directions, dtype=float)
+    # Slopes that change faster in y than x step by a fixed amount in y,
+    # the others by a fixed amount in x.
+    is_steep = np.abs(slopes) > 1
+    step_y_steep = image.shape[0] / (2 * num_steps)
+    step_x_flat = image.shape[1] / (2 * num_steps)
+    with np.errstate(divide="ignore"):
+        # Step_y must always have same sign as the slope, step_x must always be positive.
+        step_y = np.where(
+            is_steep, np.where(slopes < 0, -step_y_steep, step_y_steep), slopes * step_x_flat
+        )
+        step_x = np.where(is_steep, np.abs(step_y_steep / slopes), step_x_flat)
+    # A ray leaves the image after at most 2 * num_steps steps along its main axis.
+    max_samples = 2 * num_steps + 2
+    # Accumulate the steps (instead of multiplying them) so that sample positions
+    # are exactly the same as when stepping one sample at a time.
+    xs = np.empty((len(slopes), max_samples))
+    ys = np.empty((len(slopes), max_samples))
+    xs[:, 0], ys[:, 0] = center_point
+    xs[:, 1:] = (step_x * directions)[:, None]
+    ys[:, 1:] = (step_y * directions)[:, None]
+    xs = np.cumsum(xs, axis=1)
+    ys = np.cumsum(ys, axis=1)
+    # Only count samples until the ray first leaves the image.
+    is_inside = np.logical_and.accumulate(
+        (xs < image.shape[1]) & (ys < image.shape[0]) & (xs > 0) & (ys > 0), axis=1
+    )
+    sampled = image[
+        np.where(is_inside, ys, 0).astype(int), np.where(is_inside, xs, 0).astype(int)
+    ]
+    return np.sum(is_inside & (sampled == lm_color), axis=1)
+
+
+# Returns the mean and the unit vector along the principal axis
+# of an array of points (one (x, y) point per row), as well as the
+# ratio between the smallest and the largest variance of the points.
+def get_principal_axis(points):
+    mean = np.mean(points, axis=0)
+    variances, axes = np.linalg.eigh(np.cov(points - mean, rowvar=False))
+    return mean, axes[:, 1], variances[0] / max(variances[1], 1e-9)
+
+
+# Returns the angle in degrees of a direction in the image.
+# Negated since y starts at top of image.
+def get_direction_angle(direction):
+    return math.degrees(math.atan2(-direction[1], direction[0]))
+
+
+# Returns the distances between points (one (x, y) point per row)
+# and the segment going from start to end.
+def get_distances_to_segment(points, start, end):
+    segment = end - start
+    t = np.clip(np.dot(points - start, segment) / max(np.dot(segment, segment), 1e-9), 0, 1)
+    return np.linalg.norm(points - (start + t[:, None] * segment), axis=1)
 
-    stepsWithLM = 0
-    while x < image.shape[1] and y < image.shape[0] and x > 0 and y > 0:
-        if image[int(y)][int(x)] == lm_color:
-            stepsWithLM += 1
-        x += step_x * direction
-        y += step_y * direction
-    return stepsWithLM
+
+# Same output as measure_headings, but measures the headings from the principal
+# axes (PCA on the pixel positions) of the thresholded lane marker's arms instead
+# of its edges. Does not need the 4 edges of the lane marker to be visible.
+def measure_headings_moments(image, debug_image=None):
+    overlay = new_overlay()
+    headings = measure_headings_moments_overlay(image, overlay)
+    draw_overlay(image if debug_image is None else debug_image, overlay)
+    return headings
+
+
+# Same as measure_headings_moments, but the contour is added to the overlay instead of being drawn.
+def measure_headings_moments_overlay(image, overlay):
+    thresh_image = threshold_red_to_black(image)
+    start_time = time.perf_counter()
+    # Keep the largest lane marker blob.
+    contours, _ = cv2.findContours(
+        np.uint8(thresh_image == 0), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
+    )
+    if len(contours) == 0:
+        return None, None
+    contour = max(contours, key=cv2.contourArea)
+    overlay["contours"].append(contour)
+    blob = np.zeros(thresh_image.shape, np.uint8)
+    cv2.drawContours(blob, [contour], -1, 1, -1)
+    ys, xs = np.nonzero(blob)
+    points = np.column_stack((xs, ys)).astype(float)
+    start_time = record_stage_time("contour", start_time)
+    headings = get_headings_from_blob(points, contour, thresh_image)
+    record_stage_time("pca", start_time)
+    return headings
+
+
+# Given the pixels (one (x, y) point per row) and contour of a lane marker and
+# the thresholded image, returns the headings and center point of the lane marker.
+def get_headings_from_blob(points, contour, thresh_image):
+    if len(points) < 3:
+        return None, None
+
+    mean, axis, variance_ratio = get_principal_axis(points)
+    if variance_ratio < MAX_STRAIGHT_VARIANCE_RATIO:
+        return get_straight_headings(mean, axis)
+
+    # The ends of both arms are the two points of the lane marker furthest apart,
+    # and the bend is the point furthest from the line between both ends.
+    hull = cv2.convexHull(contour)[:, 0, :].astype(float)
+    hull_distances = np.linalg.norm(hull[:, None] - hull[None], axis=2)
+    end1_i, end2_i = np.unravel_index(np.argmax(hull_distances), hull_distances.shape)
+    end1, end2 = hull[end1_i], hull[end2_i]
+    normal = np.array([end1[1] - end2[1], end2[0] - end1[0]])
+    bend = hull[np.argmax(np.abs(np.dot(hull - end1, normal)))]
+    # Every pixel belongs to the arm whose segment is closest.
+    is_arm1 = get_distances_to_segment(points, bend, end1) <= get_distances_to_segment(
+        points, bend, end2
+    )
+    if min(np.sum(is_arm1), np.sum(~is_arm1)) < 3:
+        return get_straight_headings(mean, axis)
+    arm_means, arm_axes = [], []
+    for arm_points in (points[is_arm1], points[~is_arm1]):
+        arm_mean, arm_axis, _ = get_principal_axis(arm_points)
+        arm_means.append(arm_mean)
+        arm_axes.append(arm_axis)
+    # Arms are (almost) aligned, lane marker is straight.
+    if abs(np.cross(arm_axes[0], arm_axes[1])) < math.sin(math.radians(MIN_BEND_ANGLE)):
+        return get_straight_headings(mean, axis)
+    # Center point is the intersection of the axes of both arms.
+    t = np.linalg.solve(
+        np.column_stack((arm_axes[0], -arm_axes[1])), arm_means[1] - arm_means[0]
+    )
+    center = arm_means[0] + t[0] * arm_axes[0]
+    centerPoint = (int(center[0]), int(center[1]))
+    # Headings go from the center point towards each arm.
+    for i in range(2):
+        if np.dot(arm_means[i] - center, arm_axes[i]) < 0:
+            arm_axes[i] = -arm_axes[i]
+    # Order headings the same way measure_headings does, by number of
+    # lane marker pixels along each heading.
+    slopes = [
+        axis[1] / axis[0] if axis[0] != 0 else math.copysign(1000000, axis[1])
+        for axis in arm_axes
+    ]
+    directions = [-1 if axis[0] < 0 else 1 for axis in arm_axes]
+    stepsWithLM = get_steps_with_LM(thresh_image, slopes, directions, centerPoint)
+    if stepsWithLM[1] > stepsWithLM[0]:
+        arm_axes.reverse()
+    finalLines = [get_direction_angle(arm_axes[0]), get_direction_angle(arm_axes[1])]
+    return finalLines, centerPoint
+
+
+# Returns both headings of a straight lane marker (with same format as
+# measure_headings) given its center and the direction of its principal axis.
+def get_straight_headings(center, direction):
+    angle1 = get_direction_angle(direction)
+    if angle1 > 90:
+        angle1 -= 180
+    elif angle1 <= -90:
+        angle1 += 180
+    if angle1 > 0:
+        angle2 = angle1 - 180
+    else:
+        angle2 = angle1 + 180
+    return [angle1, angle2], (int(center[0]), int(center[1]))
 
 
 def visualize_lane_marker(image, debug=True):
@@ -444,25 +716,43 @@ def visualize_lane_marker(image, debug=True):
     cv2.circle(image, center_point, radius=5, color=(255, 0, 0), thickness=-1)
     return image
 
-def measure_lane_marker(image, bbox, debug_image):
-    # Crop image to lane marker.
-    cropped_image = crop_to_bbox(image, bbox)
+# Measures the headings and center point of the lane marker in an image already
+# cropped to the lane marker's bounding box (center point is in the cropped image).
+# Only uses its arguments so it can safely run in a worker process.
+def measure_cropped_lane_marker(cropped_image, debug_image=None, engine=HEADING_ENGINE):
+    if engine == "moments":
+        return measure_headings_moments(cropped_image, debug_image=debug_image)
+    return measure_headings(cropped_image, debug_image=debug_image)
+
+
+# Same as measure_cropped_lane_marker, but returns (headings, center point, overlay) for the
+# caller to draw the overlay on the cropped debug image (worker processes do not have it).
+def measure_cropped_lane_marker_overlay(cropped_image, engine=HEADING_ENGINE):
+    overlay = new_overlay()
+    if engine == "moments":
+        headings, center_point = measure_headings_moments_overlay(cropped_image, overlay)
+    else:
+        headings, center_point = measure_headings_overlay(cropped_image, overlay)
+    return headings, center_point, overlay
+
+
+def publish_cropped_lane_marker(cropped_image):
+    if not TESTING:
+        pub_cropped_image.publish(cropped_image)
+
+
+# Draws the headings measured in the cropped image on the full debug image.
+# Returns the center point in the full image (nothing is drawn if debug_image is None).
+def draw_lane_marker(debug_image, bbox, headings, center_point):
     line_thickness = 2  # in pixels
     line_length = 0.25 * min(
         bbox[2], bbox[3]
     )  # Line will be size of shortest bounding box side.
-    # Measure headings from lane marker.
-    cropped_image_to_pub = bridge.cv2_to_imgmsg(cropped_image, "bgr8")
-    if not TESTING:
-        pub_cropped_image.publish(cropped_image_to_pub)
-    headings, center_point = measure_headings(
-        cropped_image, debug_image = crop_to_bbox(debug_image, bbox, copy=False)
-    )
-    if None in (headings, center_point):
-        return (None, None), (None, None), debug_image
     center_point_x = center_point[0] + bbox[0] - bbox[2] / 2
     center_point_y = center_point[1] + bbox[1] - bbox[3] / 2
     center_point = (int(center_point_x), int(center_point_y))
+    if debug_image is None:
+        return center_point
     for angle in headings:
         # Get angle, line start and line end from heading slope.
         slope = math.tan((angle / -180) * math.pi)
@@ -490,6 +780,22 @@ def measure_lane_marker(image, bbox, debug_image):
             lineType=cv2.LINE_AA,
         )
     cv2.circle(debug_image, center_point, radius=5, color=HEADING_COLOR, thickness=-1)
+    return center_point
+
+
+def measure_lane_marker(image, bbox, debug_image, engine=HEADING_ENGINE):
+    # Crop image to lane marker.
+    cropped_image = crop_to_bbox(image, bbox)
+    publish_cropped_lane_marker(cropped_image)
+    # Measure headings from lane marker.
+    headings, center_point = measure_cropped_lane_marker(
+        cropped_image,
+        debug_image=crop_to_bbox(debug_image, bbox, copy=False),
+        engine=engine,
+    )
+    if None in (headings, center_point):
+        return (None, None), (None, None), debug_image
+    center_point = draw_lane_marker(debug_image, bbox, headings, center_point)
     return headings, center_point, debug_image
 
 
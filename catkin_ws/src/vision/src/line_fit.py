@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+# The line is fitted to at most MAX_POINTS points (picked at random) from HYPOTHESES lines
+# through pairs of these points, so that the time taken does not depend on the number of
+# points. The same seed is used for every fit, so fits of the same points are the same.
+MAX_POINTS = 500
+HYPOTHESES = 100
+SEED = 0
+REFINEMENTS = 2
+# Minimum residual threshold, so that points exactly on a line are inliers despite rounding.
+MIN_RESIDUAL_THRESHOLD = 1e-6
+
+
+# Fits a line v = slope * u + b to the points (N, 2 array of u, v) with RANSAC, then refines
+# it by total least squares over its inliers (points closer to the line than
+# residual_threshold, by default the median absolute deviation of v like sklearn's
+# RANSACRegressor). Returns the slope (inf for a line along v) and the fraction of the points
+# which are inliers of the refined line, or (None, 0) if there are not 2 different points.
+def fit_line_ransac(points, residual_threshold=None):
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    if len(points) < 2:
+        return None, 0.0
+    rng = np.random.default_rng(SEED)
+    if len(points) > MAX_POINTS:
+        points = points[rng.choice(len(points), MAX_POINTS, replace=False)]
+    if residual_threshold is None:
+        residual_threshold = np.median(np.abs(points[:, 1] - np.median(points[:, 1])))
+    residual_threshold = max(residual_threshold, MIN_RESIDUAL_THRESHOLD)
+
+    # Unit normals of the lines through pairs of different points, NaN for pairs of
+    # identical points (which are never the best line).
+    first = rng.integers(len(points), size=HYPOTHESES)
+    second = (first + rng.integers(1, len(points), size=HYPOTHESES)) % len(points)
+    directions = points[second] - points[first]
+    normals = np.column_stack((-directions[:, 1], directions[:, 0]))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        normals /= np.linalg.norm(normals, axis=1, keepdims=True)
+    # Distance of every point (rows) to every line (columns). Lines are scored by the sum of
+    # the squared distances of the points, at most residual_threshold (MSAC), which prefers
+    # the closest of the lines with the same number of inliers.
+    distances = np.abs(points @ normals.T - np.sum(points[first] * normals, axis=1))
+    costs = np.sum(np.minimum(distances, residual_threshold) ** 2, axis=0)
+    if np.isnan(costs).all():
+        return None, 0.0
+    inliers = distances[:, np.nanargmin(costs)] <= residual_threshold
+
+    # Total least squares over the inliers: the line goes through their mean, along the
+    # direction in which they vary the most. Refined again with its own inliers.
+    for _ in range(REFINEMENTS):
+        if np.count_nonzero(inliers) < 2:
+            break
+        mean = points[inliers].mean(axis=0)
+        _, eigenvectors = np.linalg.eigh(np.cov(points[inliers] - mean, rowvar=False))
+        direction = eigenvectors[:, -1]
+        normal = np.array([-direction[1], direction[0]])
+        inliers = np.abs((points - mean) @ normal) <= residual_threshold
+    inlier_ratio = np.mean(inliers)
+    with np.errstate(divide="ignore"):
+        slope = direction[1] / direction[0]
+    return float(slope), float(inlier_ratio)
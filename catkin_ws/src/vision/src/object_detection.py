@@ -2,28 +2,35 @@
 
 import rospy
 import numpy as np
-import torch
 import ast
-from cv_bridge import CvBridge
-from ultralytics import YOLO
+import copy
+import os
+import time
+import multiprocessing
+import threading
+import cv2
 
 from object_detection_utils import *
-from lane_marker_measure import measure_lane_marker
+from common_utils import crop_to_bbox
+from debug_publisher import DebugPublisher
+from detection_scheduler import DetectionScheduler
+from image_ingest import ImageIngest
+from inference_backends import load_backend, merge_boxes, BOX_CONF, BOX_CLS, CONF_THRESHOLD
+from tracker import BoxTracker
+from lane_marker_measure import (
+    measure_cropped_lane_marker,
+    measure_cropped_lane_marker_overlay,
+    publish_cropped_lane_marker,
+    draw_lane_marker,
+    draw_overlay,
+)
 
 from auv_msgs.msg import VisionObject, VisionObjectArray
-from std_msgs.msg import Int32MultiArray
+from std_msgs.msg import Int32MultiArray, String
 from sensor_msgs.msg import Image
 
 
 def is_vision_ready(camera_id):
-    # Only predict if cameras_image_count has not reached DETECT_EVERY yet.
-    global cameras_image_count
-    cameras_image_count[camera_id] += 1
-    if cameras_image_count[camera_id] <= DETECT_EVERY:
-        return False
-    # Reset cameras_image_count.
-    cameras_image_count[camera_id] = 0
-
     states[camera_id].pause()
     current_states = {
         "position": states[camera_id].position,
@@ -36,118 +43,187 @@ def is_vision_ready(camera_id):
             print(current_states)
             states[camera_id].resume()
             return False
-    if camera_id == 1 and states[camera_id].point_cloud is None:
-        print("Point cloud not yet published.")
+    if camera_id == 1 and not states[camera_id].has_point_cloud():
+        print("Depth or camera info not yet published.")
         states[camera_id].resume()
         return False
     return True
 
 
-def detection_frame(image, debug_image, detections, camera_id):
-    # Initialize empty array for object detection frame message.
-    detection_frame_array = []
+# boxes is the box array of the inference backend (one row per box). Filtering, scoring
+# and down camera positions are computed for all the boxes of the frame at once. stamp is
+# the time the frame was taken.
+def detection_frame(image, debug_image, boxes, camera_id, stamp):
+    global centering_track_id
     image_h, image_w, _ = image.shape
-    # Nested for loops get all predictions made by model.
-    for detection in detections:
-        boxes = (
-            detection.boxes.cpu().numpy()
-            if is_cuda_available
-            else detection.boxes.numpy()
+    # Only consider predictions with a confidence of at least MIN_PREDICTION_CONFIDENCE.
+    confident = boxes[:, BOX_CONF] >= MIN_PREDICTION_CONFIDENCE
+    if PRINT_DEBUG_INFO:
+        for conf in boxes[~confident, BOX_CONF]:
+            print("Confidence too low for camera {} ({}%)".format(camera_id, conf * 100))
+    boxes = boxes[confident]
+    # Track ids of the boxes (0 if not tracked).
+    track_ids = np.zeros(len(boxes), dtype=int)
+    if USE_TRACKER:
+        track_ids = trackers[camera_id].update(boxes, stamp.to_sec())
+    labels = [class_names[camera_id][int(cls_id)] for cls_id in boxes[:, BOX_CLS]]
+    if camera_id == 0:
+        # Centering uses the last bbox published for the frame: the last lane marker's if
+        # there is one (published at its measured center, which is not tracked), otherwise
+        # the last other box's. Only that track is published until the next model run.
+        centering_track_id = 0
+        if "Lane Marker" not in labels and len(labels) > 0:
+            centering_track_id = int(track_ids[-1])
+    confidences = boxes[:, BOX_CONF] * calculate_bbox_confidences(
+        boxes[:, :4], image_h, image_w
+    )
+    positions = [(0, 0, 0)] * len(boxes)
+    thetas_z = [None] * len(boxes)
+
+    if camera_id == 0:  # Down camera.
+        # Lane markers are measured in parallel (in the worker processes) while the
+        # other detections are processed, their position is added once that is done.
+        lane_marker_measurements = []
+        for i, label in enumerate(labels):
+            if label == "Lane Marker":
+                bbox = list(boxes[i, :4])
+                lane_marker_measurements.append(
+                    (i, bbox, start_lane_marker_measurement(image, bbox, debug_image))
+                )
+        object_top_z = np.array([DOWN_CAM_OBJECT_TOP_Z.get(label, np.nan) for label in labels])
+        positioned = np.flatnonzero(~np.isnan(object_top_z))
+        object_positions = get_object_positions_down_camera(
+            boxes[positioned, :2], image_h, image_w, object_top_z[positioned]
         )
-        for box in boxes:
-            conf = float(list(box.conf)[0])
-            # Only consider prediction if confidence is at least MIN_PREDICTION_CONFIDENCE.
-            if conf < MIN_PREDICTION_CONFIDENCE:
-                if PRINT_DEBUG_INFO:
-                    print(
-                        "Confidence too low for camera {} ({}%)".format(
-                            camera_id, conf * 100
-                        )
-                    )
-                continue
+        for i, position in zip(positioned, object_positions):
+            positions[i] = position_to_xyz(position)
+    else:  # Forward camera.
+        for i, label in enumerate(labels):
+            bbox = list(boxes[i, :4])
+            if label in ("Octagon Table", "Gate", "Buoy"):
+                positions[i] = get_object_position_front_camera(bbox)
+            if label == "Gate":
+                thetas_z[i], inlier_ratio = measure_angle(bbox)
+                # Points far from the gate's line make its angle (and position) less reliable.
+                confidences[i] *= inlier_ratio
 
-            bbox = list(box.xywh[0])
-            cls_id = int(list(box.cls)[0])
-            global_class_name = class_names[camera_id][cls_id]
-            # Add bbox visualization to image.
+    detection_frame_array = []
+    for i, box in enumerate(boxes):
+        bbox = list(box[:4])
+        # Add bbox visualization to image.
+        if debug_image is not None:
             debug_image = visualize_bbox(
-                debug_image, bbox, global_class_name + " " + str(conf * 100) + "%"
+                debug_image, bbox, labels[i] + " " + str(box[BOX_CONF] * 100) + "%"
             )
+        if camera_id == 0 and labels[i] != "Lane Marker":
+            publish_bbox_centering(bbox, image)
+
+        # Initialize a new detection frame object.
+        detectionFrame = VisionObject()
+        detectionFrame.label = labels[i]
+        detectionFrame.x, detectionFrame.y, detectionFrame.z = positions[i]
+        detectionFrame.theta_z = thetas_z[i]
+        detectionFrame.extra_field = None
+        detectionFrame.confidence = float(confidences[i])
+        detectionFrame.track_id = int(track_ids[i])
+
+        # Add the detection frame to the array.
+        detection_frame_array.append(detectionFrame)
+
+    if camera_id == 0:
+        finish_lane_marker_measurements(
+            lane_marker_measurements, detection_frame_array, image, debug_image
+        )
+    publish_detection_frame(detection_frame_array, camera_id)
 
-            # Initialize a new detection frame object.
-            detectionFrame = VisionObject()
-            pred_obj_x, pred_obj_y, pred_obj_z = 0, 0, 0
-            extra_field, theta_z = None, None
-
-            if camera_id == 0:  # Down camera.
-                if global_class_name == "Lane Marker":
-                    headings, center, debug_image = measure_lane_marker(
-                        image, bbox, debug_image
-                    )
-                    if None not in headings:
-                        bbox = center
-                        heading_auv = [0, 0]
-                        for i in range(2):
-                            offset = (
-                                270 if headings[i] + DOWN_CAM_YAW_OFFSET < -90 else -90
-                            )
-                            heading_auv[i] = (
-                                states[camera_id].theta_z + headings[i] + offset
-                            )
-                        theta_z = heading_auv[0] + DOWN_CAM_YAW_OFFSET
-                        extra_field = heading_auv[1] + DOWN_CAM_YAW_OFFSET
-                    pred_obj_x, pred_obj_y, pred_obj_z = (
-                        get_object_position_down_camera(
-                            bbox[0], bbox[1], image_h, image_w, lane_marker_top_z
-                        )
-                    )
-                elif global_class_name == "Octagon Table":
-                    pred_obj_x, pred_obj_y, pred_obj_z = (
-                        get_object_position_down_camera(
-                            bbox[0], bbox[1], image_h, image_w, octagon_table_top_z
-                        )
-                    )
-                elif global_class_name == "Bin":
-                    pred_obj_x, pred_obj_y, pred_obj_z = (
-                        get_object_position_down_camera(
-                            bbox[0], bbox[1], image_h, image_w, bin_top_z
-                        )
-                    )
-                bbox_message = Int32MultiArray()
-                bbox_message.data = [int(bbox[0]),int(bbox[1]), len(image[0]), len(image)]
-                pub_bbox_centering.publish(bbox_message)
-            else:  # Forward camera.
-                if global_class_name == "Octagon Table":
-                    pred_obj_x, pred_obj_y, pred_obj_z = (
-                        get_object_position_front_camera(bbox)
-                    )
-                elif global_class_name == "Gate":
-                    pred_obj_x, pred_obj_y, pred_obj_z = (
-                        get_object_position_front_camera(bbox)
-                    )
-                    theta_z = measure_angle(bbox)
-                elif global_class_name == "Buoy":
-                    pred_obj_x, pred_obj_y, pred_obj_z = (
-                        get_object_position_front_camera(bbox)
-                    )
 
-            detectionFrame.label = global_class_name
-            detectionFrame.x = pred_obj_x
-            detectionFrame.y = pred_obj_y
-            detectionFrame.z = pred_obj_z
-            detectionFrame.theta_z = theta_z
-            detectionFrame.extra_field = extra_field
-            detectionFrame.confidence = conf * calculate_bbox_confidence(
-                list(box.xywh[0]), image_h, image_w
-            )
+# (x, y, z) of a measured position, or None if it could not be measured (NaN).
+def position_to_xyz(position):
+    if np.isnan(position).any():
+        return None, None, None
+    return tuple(float(coordinate) for coordinate in position)
 
-            # Add the detection frame to the array.
-            detection_frame_array.append(detectionFrame)
 
-    publish_detection_frame(detection_frame_array)
+# Waits for the lane marker measurements (index of the detection, bbox, measurement) of the
+# frame and adds the headings and positions (at the measured center) to the detections.
+def finish_lane_marker_measurements(measurements, detection_frame_array, image, debug_image):
+    if len(measurements) == 0:
+        return
+    image_h, image_w, _ = image.shape
+    centers = []
+    for i, bbox, measurement in measurements:
+        headings, center, overlay = finish_lane_marker_measurement(measurement)
+        if overlay is not None and debug_image is not None:
+            draw_overlay(crop_to_bbox(debug_image, bbox, copy=False), overlay)
+        detectionFrame = detection_frame_array[i]
+        if None not in (headings, center):
+            bbox = draw_lane_marker(debug_image, bbox, headings, center)
+            heading_auv = [0, 0]
+            for j in range(2):
+                offset = 270 if headings[j] + DOWN_CAM_YAW_OFFSET < -90 else -90
+                heading_auv[j] = states[0].theta_z + headings[j] + offset
+            detectionFrame.theta_z = heading_auv[0] + DOWN_CAM_YAW_OFFSET
+            detectionFrame.extra_field = heading_auv[1] + DOWN_CAM_YAW_OFFSET
+        centers.append(bbox[:2])
+        publish_bbox_centering(bbox, image)
+    positions = get_object_positions_down_camera(centers, image_h, image_w, lane_marker_top_z)
+    for (i, _, _), position in zip(measurements, positions):
+        detectionFrame = detection_frame_array[i]
+        detectionFrame.x, detectionFrame.y, detectionFrame.z = position_to_xyz(position)
+
+
+# Starts measuring the headings of the lane marker in bbox. The measurement runs in
+# the lane marker worker pool when there is one, otherwise it is done right away.
+# Returns None (no measurement) while measurements which timed out are still running.
+def start_lane_marker_measurement(image, bbox, debug_image):
+    cropped_image = crop_to_bbox(image, bbox)
+    publish_cropped_lane_marker(cropped_image)
+    if lane_marker_pool is None:
+        if debug_image is not None:
+            debug_image = crop_to_bbox(debug_image, bbox, copy=False)
+        return measure_cropped_lane_marker(cropped_image, debug_image=debug_image)
+    # Measurements which timed out keep running in the pool, new ones would be queued behind
+    # them and time out as well: none are started until they are done.
+    timed_out_lane_marker_measurements[:] = [
+        result for result in timed_out_lane_marker_measurements if not result.ready()
+    ]
+    if len(timed_out_lane_marker_measurements) > 0:
+        return None
+    # The worker returns what it would have drawn, the debug image is drawn on here.
+    return (
+        time.time() + LANE_MARKER_MEASURE_TIMEOUT,
+        lane_marker_pool.apply_async(measure_cropped_lane_marker_overlay, (cropped_image,)),
+    )
 
 
-def publish_detection_frame(detection_frame_array):
+# Returns the headings and center point (in the cropped image) of a measurement
+# started with start_lane_marker_measurement, and the overlay to draw on the cropped
+# debug image (None if it is already drawn). If the measurement took longer than
+# LANE_MARKER_MEASURE_TIMEOUT (or was not started), the lane marker is published without
+# headings.
+def finish_lane_marker_measurement(measurement):
+    if measurement is None:
+        rospy.logwarn("Lane marker workers busy, publishing it without headings.")
+        return None, None, None
+    if lane_marker_pool is None:
+        headings, center = measurement
+        return headings, center, None
+    deadline, result = measurement
+    try:
+        return result.get(timeout=max(0, deadline - time.time()))
+    except multiprocessing.TimeoutError:
+        timed_out_lane_marker_measurements.append(result)
+        rospy.logwarn("Lane marker measurement timed out, publishing it without headings.")
+        return None, None, None
+
+
+def publish_bbox_centering(bbox, image):
+    bbox_message = Int32MultiArray()
+    bbox_message.data = [int(bbox[0]), int(bbox[1]), len(image[0]), len(image)]
+    pub_bbox_centering.publish(bbox_message)
+
+
+def publish_detection_frame(detection_frame_array, camera_id):
     for obj in detection_frame_array:
         obj.x = obj.x if obj.x is not None else NULL_PLACEHOLDER
         obj.theta_z = obj.theta_z if obj.theta_z is not None else NULL_PLACEHOLDER
@@ -156,6 +232,7 @@ def publish_detection_frame(detection_frame_array):
         )
 
     detection_frame_array = clean_detections(detection_frame_array)
+    last_detections[camera_id] = detection_frame_array
 
     if len(detection_frame_array) > 0:
         # Create object detection frame message and publish it.
@@ -164,26 +241,374 @@ def publish_detection_frame(detection_frame_array):
         pub_viewframe_detection.publish(detection_frame_arrayMsg)
 
 
+# Only stores the newest frame of the camera, the inference worker(s) pick
+# it up when the scheduler lets the camera run the model again.
 def vision_cb(raw_image, camera_id):
-    if not is_vision_ready(camera_id):
+    stamp = raw_image.header.stamp
+    if stamp.is_zero():
+        stamp = rospy.get_rostime()
+    with latest_frames_condition:
+        latest_frames[camera_id] = (raw_image, stamp)
+        latest_frames_condition.notify_all()
+    if camera_id == 0 and USE_TRACKER:
+        publish_tracked_bbox_centering(raw_image, stamp)
+
+
+# Publishes the box the last model run of the down camera centered on (see detection_frame),
+# moved to the time of the frame, so that centering gets a bbox on every frame and not only
+# on the frames the model runs on. Nothing is published if it was a lane marker or if its
+# track was not matched on that run.
+def publish_tracked_bbox_centering(raw_image, stamp):
+    if centering_track_id == 0:
+        return
+    bbox = trackers[0].predict_track(centering_track_id, stamp.to_sec())
+    if bbox is None:
         return
+    bbox_message = Int32MultiArray()
+    bbox_message.data = [int(bbox[0]), int(bbox[1]), raw_image.width, raw_image.height]
+    pub_bbox_centering.publish(bbox_message)
+
+
+# Takes the newest frame (raw image, stamp) of the camera. Returns None if there is none or
+# if it is older than MAX_FRAME_AGE (it is then discarded). Call with latest_frames_condition
+# held.
+def take_latest_frame(camera_id):
+    frame = latest_frames[camera_id]
+    latest_frames[camera_id] = None
+    if frame is None:
+        return None
+    age = (rospy.get_rostime() - frame[1]).to_sec()
+    if age > MAX_FRAME_AGE:
+        if PRINT_DEBUG_INFO:
+            print("Discarding frame of camera {} ({:.3f}s old)".format(camera_id, age))
+        return None
+    return frame
+
+
+# Returns the newest frame (raw image, stamp) of the camera once there is one (None on
+# shutdown).
+def wait_for_latest_frame(camera_id):
+    with latest_frames_condition:
+        while not rospy.is_shutdown():
+            latest_frame = take_latest_frame(camera_id)
+            if latest_frame is not None:
+                return latest_frame
+            latest_frames_condition.wait(timeout=0.5)
+    return None
+
+
+def inference_worker(camera_id):
+    while not rospy.is_shutdown():
+        # Wait for the camera's turn first so that the newest frame is used.
+        if not scheduler.wait_turn(camera_id):
+            return
+        latest_frame = wait_for_latest_frame(camera_id)
+        if latest_frame is None:
+            return
+        try:
+            start_time = time.time()
+            frame = prepare_frame(*latest_frame, camera_id)
+            if frame is None:
+                continue
+            detect(frame, camera_id, start_time, get_rois(frame, camera_id))
+        except Exception as e:
+            # Keep the worker alive, the next frame may be fine.
+            rospy.logerr("Object detection failed for camera {}: {}".format(camera_id, e))
+            states[camera_id].resume()
+
+
+# Runs the model on the frame (or on the crops rois of it) and publishes the detections.
+def detect(frame, camera_id, start_time, rois=None):
+    scheduler.start_inference(camera_id)
+    if rois is None:
+        last_full_frame_time[camera_id] = time.time()
+        boxes = model[camera_id].predict([frame[0]], verbose=PRINT_DEBUG_INFO)[0]
+    else:
+        boxes = predict_rois(frame[0], rois, camera_id)
+    boxes = cascade(frame[0], boxes, camera_id)
+    publish_detections(frame, boxes, camera_id)
+    scheduler.end_inference(camera_id, time.time() - start_time)
+
+
+# Returns the crops (x1, y1, x2, y2) around the objects of interest (ROI_CLASSES) tracked in
+# the camera at the time of the frame, padded by ROI_PADDING times their size. Returns None if
+# the model should run on the full frame: nothing of interest is tracked or the last full
+# frame is too old.
+def get_rois(frame, camera_id):
+    if not USE_ROI_INFERENCE:
+        return None
+    if time.time() - last_full_frame_time[camera_id] > ROI_FULL_FRAME_INTERVAL:
+        return None
+    image, _, stamp = frame
+    image_h, image_w = image.shape[:2]
+    rois = []
+    for _, cls_id, box in trackers[camera_id].predict(stamp.to_sec()):
+        if class_names[camera_id][int(cls_id)] not in ROI_CLASSES:
+            continue
+        size = max(max(box[2], box[3]) * (1 + 2 * ROI_PADDING), ROI_MIN_SIZE)
+        x1, y1 = int(max(box[0] - size / 2, 0)), int(max(box[1] - size / 2, 0))
+        x2, y2 = int(min(box[0] + size / 2, image_w)), int(min(box[1] + size / 2, image_h))
+        if x2 > x1 and y2 > y1:
+            rois.append((x1, y1, x2, y2))
+    return rois if len(rois) > 0 else None
+
+
+# Runs the model on the crops of the image and returns the boxes in image coordinates, so
+# that positions (down camera) and point cloud crops (front camera) use the full image.
+def predict_rois(image, rois, camera_id):
+    crops = [image[y1:y2, x1:x2] for x1, y1, x2, y2 in rois]
+    crops_boxes = model[camera_id].predict(
+        crops, verbose=PRINT_DEBUG_INFO, input_size=ROI_INPUT_SIZE
+    )
+    for boxes, (x1, y1, _, _) in zip(crops_boxes, rois):
+        boxes[:, 0] += x1
+        boxes[:, 1] += y1
+    # Crops of objects close to each other overlap, the same object can be in several.
+    return merge_boxes(crops_boxes)
+
 
-    # Convert image to cv2.
-    image = bridge.imgmsg_to_cv2(raw_image, "bgr8")
-    debug_image = np.copy(image)
-    states[camera_id].bgr_image = np.copy(image)
+def is_frame_ready(camera_id):
+    return latest_frames[camera_id] is not None and scheduler.time_until_turn(camera_id) <= 0
 
-    # Run model on image.
-    detections = model[camera_id].predict(
-        image, device=device, verbose=PRINT_DEBUG_INFO
+
+# Whether the camera already has a frame but its turn only comes before the deadline, so
+# that it is worth waiting for to run it in the same batch. Cameras without a frame (e.g.
+# not publishing) or disabled by the scheduler are never waited for.
+def is_frame_coming(camera_id, deadline):
+    return (
+        latest_frames[camera_id] is not None
+        and 0 < scheduler.time_until_turn(camera_id) <= deadline - time.time()
+    )
+
+
+# Waits for a frame of any camera whose turn it is, then gives the other cameras up to
+# BATCH_WINDOW seconds to provide theirs. Returns the frames (raw image, stamp) by camera id.
+def wait_for_batch():
+    frames = {}
+    with latest_frames_condition:
+        while len(frames) == 0 and not rospy.is_shutdown():
+            while not any(is_frame_ready(i) for i in range(2)) and not rospy.is_shutdown():
+                # New frames are notified, turns are not: wake up when the next one starts.
+                latest_frames_condition.wait(
+                    timeout=min(
+                        [0.5]
+                        + [
+                            scheduler.time_until_turn(i)
+                            for i in range(2)
+                            if latest_frames[i] is not None
+                        ]
+                    )
+                )
+            deadline = time.time() + BATCH_WINDOW
+            coming = [i for i in range(2) if is_frame_coming(i, deadline)]
+            while len(coming) > 0:
+                latest_frames_condition.wait(
+                    timeout=min(scheduler.time_until_turn(i) for i in coming)
+                )
+                coming = [i for i in coming if is_frame_coming(i, deadline)]
+            for camera_id in range(2):
+                if is_frame_ready(camera_id):
+                    latest_frame = take_latest_frame(camera_id)
+                    if latest_frame is not None:
+                        frames[camera_id] = latest_frame
+    return frames
+
+
+# Runs each model once per batch of frames instead of once per frame.
+def batch_inference_worker():
+    while not rospy.is_shutdown():
+        frames = {}
+        for camera_id, latest_frame in wait_for_batch().items():
+            try:
+                frame = prepare_frame(*latest_frame, camera_id)
+            except Exception as e:
+                rospy.logerr("Object detection failed for camera {}: {}".format(camera_id, e))
+                states[camera_id].resume()
+                continue
+            if frame is not None:
+                frames[camera_id] = frame
+
+        # Cameras using the same model file share the model, so one forward pass per model.
+        camera_ids_per_model = {}
+        for camera_id in sorted(frames):
+            rois = get_rois(frames[camera_id], camera_id)
+            if rois is None:
+                camera_ids_per_model.setdefault(id(model[camera_id]), []).append(camera_id)
+                continue
+            # Crops are run on their own, batches are only made of full frames.
+            try:
+                detect(frames[camera_id], camera_id, time.time(), rois)
+            except Exception as e:
+                rospy.logerr("Object detection failed for camera {}: {}".format(camera_id, e))
+                states[camera_id].resume()
+        for camera_ids in camera_ids_per_model.values():
+            batch_model = model[camera_ids[0]]
+            images = [frames[camera_id][0] for camera_id in camera_ids]
+            try:
+                if len(images) > 1 and id(batch_model) not in batching_gain_reported:
+                    report_batching_gain(batch_model, images)
+                    batching_gain_reported.add(id(batch_model))
+                start_time = time.time()
+                for camera_id in camera_ids:
+                    scheduler.start_inference(camera_id)
+                    last_full_frame_time[camera_id] = start_time
+                boxes = batch_model.predict(images, verbose=PRINT_DEBUG_INFO)
+                for camera_id, camera_boxes in zip(camera_ids, boxes):
+                    image = frames[camera_id][0]
+                    camera_boxes = cascade(image, camera_boxes, camera_id)
+                    publish_detections(frames[camera_id], camera_boxes, camera_id)
+                # Each camera is charged its share of the batch.
+                latency = (time.time() - start_time) / len(camera_ids)
+                for camera_id in camera_ids:
+                    scheduler.end_inference(camera_id, latency)
+            except Exception as e:
+                rospy.logerr("Object detection failed for cameras {}: {}".format(camera_ids, e))
+                for camera_id in camera_ids:
+                    states[camera_id].resume()
+
+
+# Logs how much faster one batched forward pass is than running the images one by one.
+def report_batching_gain(batch_model, images, repeats=5):
+    # Warm up both paths so that one-off setup is not measured.
+    for image in images:
+        batch_model.predict([image])
+    batch_model.predict(images)
+
+    start_time = time.time()
+    for _ in range(repeats):
+        for image in images:
+            batch_model.predict([image])
+    per_image_time = (time.time() - start_time) / repeats
+    start_time = time.time()
+    for _ in range(repeats):
+        batch_model.predict(images)
+    batched_time = (time.time() - start_time) / repeats
+    rospy.loginfo(
+        "Batched inference of {} images: {:.1f}ms vs {:.1f}ms one by one ({:.2f}x throughput)".format(
+            len(images), batched_time * 1000, per_image_time * 1000, per_image_time / batched_time
+        )
     )
 
-    detection_frame(image, debug_image, detections, camera_id)
 
-    # Convert visualization image to sensor_msg image and
-    # publish it to corresponding cameras visualization topic.
-    debug_image = bridge.cv2_to_imgmsg(debug_image, "bgr8")
-    pubs_visualisation[camera_id].publish(debug_image)
+# Runs the camera's larger cascade model on the frame when the small model is unsure:
+# it found boxes in the uncertain confidence band (between CASCADE_UNCERTAIN_CONFIDENCE
+# and MIN_PREDICTION_CONFIDENCE), or nothing while the AUV is searching for objects.
+# Returns the boxes of the larger model if it was run, otherwise the small model's boxes.
+def cascade(image, boxes, camera_id):
+    if cascade_model is None:
+        return boxes
+    conf = boxes[:, BOX_CONF]
+    reason = None
+    if np.any((conf >= CASCADE_UNCERTAIN_CONFIDENCE) & (conf < MIN_PREDICTION_CONFIDENCE)):
+        reason = "uncertain"
+    elif is_searching and not np.any(conf >= MIN_PREDICTION_CONFIDENCE):
+        reason = "search"
+
+    stats = cascade_stats[camera_id]
+    stats["frames"] += 1
+    if reason is not None:
+        stats[reason] += 1
+        boxes = cascade_model[camera_id].predict([image], verbose=PRINT_DEBUG_INFO)[0]
+    if stats["frames"] == CASCADE_REPORT_INTERVAL:
+        rospy.loginfo(
+            "Camera {} escalated {:.1f}% of the last {} frames ({} uncertain, {} while searching)".format(
+                camera_id,
+                100 * (stats["uncertain"] + stats["search"]) / stats["frames"],
+                stats["frames"],
+                stats["uncertain"],
+                stats["search"],
+            )
+        )
+        cascade_stats[camera_id] = {"frames": 0, "uncertain": 0, "search": 0}
+    return boxes
+
+
+# Keeps track of whether the planner is in a search state, from the mission display.
+def mission_display_cb(msg):
+    global is_searching
+    # Countdowns are also published on the mission display, they do not change the state.
+    if msg.data.startswith("T - ") or msg.data.replace(".", "", 1).lstrip("-").isdigit():
+        return
+    is_searching = msg.data in SEARCH_MISSION_STATES
+
+
+# Tiny grayscale version of the image, compared between frames to detect scene changes.
+def get_thumbnail(image):
+    thumbnail = cv2.resize(image, MOTION_GATE_THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(thumbnail, cv2.COLOR_BGR2GRAY).astype(np.float32)
+
+
+# Whether the model can skip the frame: neither the image nor the AUV's pose changed much
+# since the last frame the model ran on, and that frame is at most MOTION_GATE_MAX_SKIP_INTERVAL
+# seconds old. Otherwise the frame becomes the new reference.
+def is_scene_static(image, camera_id):
+    thumbnail = get_thumbnail(image)
+    position = states[camera_id].position
+    position = np.array([position.x, position.y, position.z])
+    theta_z = states[camera_id].theta_z
+    reference = motion_gate_references[camera_id]
+    if (
+        reference is not None
+        and time.time() - reference["time"] < MOTION_GATE_MAX_SKIP_INTERVAL
+        and np.mean(np.abs(thumbnail - reference["thumbnail"])) < MOTION_GATE_THRESHOLD
+        and np.linalg.norm(position - reference["position"]) < MOTION_GATE_MAX_TRANSLATION
+        and abs((theta_z - reference["theta_z"] + 180) % 360 - 180) < MOTION_GATE_MAX_ROTATION
+    ):
+        return True
+    motion_gate_references[camera_id] = {
+        "time": time.time(),
+        "thumbnail": thumbnail,
+        "position": position,
+        "theta_z": theta_z,
+    }
+    return False
+
+
+# Publishes the camera's last detections again for a frame the model skipped, marked as
+# repeated so that the object map does not count them as new observations.
+def publish_repeated_detections(camera_id):
+    if len(last_detections[camera_id]) == 0:
+        return
+    repeated_detections = []
+    for obj in last_detections[camera_id]:
+        repeated_obj = copy.copy(obj)
+        repeated_obj.repeated = True
+        repeated_detections.append(repeated_obj)
+    detection_frame_arrayMsg = VisionObjectArray()
+    detection_frame_arrayMsg.array = repeated_detections
+    pub_viewframe_detection.publish(detection_frame_arrayMsg)
+
+
+# Converts the frame to cv2 and pauses the camera's state, returns (image, debug_image,
+# stamp) or None if the state needed to process the frame is not available yet. The image is
+# read-only (it is the message's data or a buffer reused by the next frame), debug_image
+# is a copy to draw on, or None if the camera's detection image is not wanted (nobody is
+# subscribed or it was published less than 1 / debug_image_max_rate seconds ago).
+def prepare_frame(raw_image, stamp, camera_id):
+    if not is_vision_ready(camera_id):
+        return None
+    image = ingests[camera_id].to_bgr(raw_image)
+    if USE_MOTION_GATE and is_scene_static(image, camera_id):
+        publish_repeated_detections(camera_id)
+        states[camera_id].resume()
+        # Static frames are only checked at the scheduled rate.
+        scheduler.skip_turn(camera_id)
+        return None
+    debug_image = None
+    if pubs_visualisation[camera_id].is_wanted():
+        debug_image = np.copy(image)
+    # Only read while the state is paused, so the frame does not need to be copied.
+    states[camera_id].bgr_image = image
+    return image, debug_image, stamp
+
+
+def publish_detections(frame, boxes, camera_id):
+    image, debug_image, stamp = frame
+    detection_frame(image, debug_image, boxes, camera_id, stamp)
+
+    # Publish the visualization image to corresponding cameras visualization topic.
+    if debug_image is not None:
+        pubs_visualisation[camera_id].publish(debug_image)
     states[camera_id].resume()
 
 
@@ -202,24 +627,128 @@ if __name__ == "__main__":
     lane_marker_top_z = POOL_DEPTH + LANE_MARKER_HEIGHT
     octagon_table_top_z = POOL_DEPTH + OCTAGON_TABLE_HEIGHT
     bin_top_z = POOL_DEPTH + BIN_HEIGHT
+    # Height of the top of the objects positioned from the down camera's bbox center.
+    DOWN_CAM_OBJECT_TOP_Z = {"Octagon Table": octagon_table_top_z, "Bin": bin_top_z}
     DOWN_CAM_YAW_OFFSET = rospy.get_param("down_cam_yaw_offset")
 
-    # Run the model every _ frames received (to not eat up too much RAM).
-    DETECT_EVERY = rospy.get_param("object_detection_frame_interval")
+    # Max. age (seconds) of a frame when inference starts, older frames are discarded.
+    MAX_FRAME_AGE = rospy.get_param("object_detection_max_frame_age")
+
+    # Lane markers are measured in worker processes so that they do not delay the
+    # other detections (0 workers measures them in the image callback instead).
+    LANE_MARKER_MEASURE_WORKERS = rospy.get_param("lane_marker_measure_workers")
+    # Max. time (seconds) to wait for a lane marker measurement before publishing
+    # the lane marker without headings.
+    LANE_MARKER_MEASURE_TIMEOUT = rospy.get_param("lane_marker_measure_timeout")
+    lane_marker_pool = None
+    # Results of the measurements which timed out, they may still be running in the pool.
+    timed_out_lane_marker_measurements = []
+    if LANE_MARKER_MEASURE_WORKERS > 0:
+        # Not forked from this process, which already runs rospy's threads (a fork could
+        # copy locks they hold): the workers are forked from a fresh forkserver process.
+        lane_marker_pool = multiprocessing.get_context("forkserver").Pool(
+            LANE_MARKER_MEASURE_WORKERS, initializer=cv2.setNumThreads, initargs=(1,)
+        )
+        rospy.on_shutdown(lane_marker_pool.terminate)
 
     DOWN_CAM_MODEL_FILE = rospy.get_param("down_cam_model_file")
     FRONT_CAM_MODEL_FILE = rospy.get_param("front_cam_model_file")
 
-    model = [YOLO(DOWN_CAM_MODEL_FILE), YOLO(FRONT_CAM_MODEL_FILE)]
-
-    is_cuda_available = torch.cuda.is_available()
-    if not is_cuda_available:
-        rospy.logwarn("CUDA is not available! YOLO inference will run on CPU.")
-        device = "cpu"
+    # Max. time (seconds) to wait for the other camera's frame to run both in one batch,
+    # 0 runs every frame on its own in one worker per camera.
+    BATCH_WINDOW = rospy.get_param("object_detection_batch_window")
+
+    # "ultralytics" (PyTorch, on the GPU if there is one) or "onnxruntime" (CPU only).
+    INFERENCE_BACKEND = rospy.get_param("object_detection_backend")
+
+    # Batches are made of the frames of both cameras for one forward pass of a shared
+    # model, cameras with different models gain nothing from waiting for each other.
+    if BATCH_WINDOW > 0 and FRONT_CAM_MODEL_FILE != DOWN_CAM_MODEL_FILE:
+        rospy.logwarn("The cameras use different models, batching is disabled.")
+        BATCH_WINDOW = 0
+
+    # Cascade: when the model is unsure about a frame, it is run again through a larger model.
+    USE_CASCADE = rospy.get_param("object_detection_cascade")
+    # Boxes with a confidence in [CASCADE_UNCERTAIN_CONFIDENCE, MIN_PREDICTION_CONFIDENCE)
+    # make the frame go through the larger model.
+    CASCADE_UNCERTAIN_CONFIDENCE = rospy.get_param("cascade_uncertain_confidence")
+
+    # The backends drop the boxes below CONF_THRESHOLD, the cascade needs the uncertain ones.
+    model_conf_threshold = CONF_THRESHOLD
+    if USE_CASCADE:
+        model_conf_threshold = min(CONF_THRESHOLD, CASCADE_UNCERTAIN_CONFIDENCE)
+    model = [load_backend(INFERENCE_BACKEND, DOWN_CAM_MODEL_FILE, model_conf_threshold)]
+    if BATCH_WINDOW > 0:
+        # Only shared when batching, the per camera workers would use it concurrently.
+        # The class names are still per camera (class_names).
+        model.append(model[0])
     else:
-        device = 0
-        for m in model:
-            m.to(torch.device("cuda"))
+        model.append(
+            load_backend(INFERENCE_BACKEND, FRONT_CAM_MODEL_FILE, model_conf_threshold)
+        )
+
+    # Mission display states in which frames without detections go through the larger model.
+    SEARCH_MISSION_STATES = ast.literal_eval(rospy.get_param("cascade_search_mission_states"))
+    # Number of frames per camera between reports of the escalation rate.
+    CASCADE_REPORT_INTERVAL = 100
+    cascade_model = None
+    if USE_CASCADE:
+        cascade_model_files = [
+            rospy.get_param("down_cam_cascade_model_file"),
+            rospy.get_param("front_cam_cascade_model_file"),
+        ]
+        # No larger models are shipped, they have to be trained and set in vision.launch.
+        for cascade_model_file in cascade_model_files:
+            if not os.path.isfile(cascade_model_file):
+                raise FileNotFoundError(
+                    "Cascade model '{}' not found, object_detection_cascade needs "
+                    "down_cam_cascade_model_file and front_cam_cascade_model_file to be set "
+                    "to larger models".format(cascade_model_file)
+                )
+        cascade_model = [
+            load_backend(INFERENCE_BACKEND, cascade_model_file)
+            for cascade_model_file in cascade_model_files
+        ]
+    cascade_stats = [{"frames": 0, "uncertain": 0, "search": 0} for _ in range(2)]
+    is_searching = False
+
+    # Motion gate: skip the model on frames where the scene did not change (e.g. hovering).
+    USE_MOTION_GATE = rospy.get_param("motion_gate")
+    # Max. mean difference (gray levels) between the thumbnails of two frames of a static scene.
+    MOTION_GATE_THRESHOLD = rospy.get_param("motion_gate_threshold")
+    # Max. AUV movement (meters and degrees) since the last inference for a static scene.
+    MOTION_GATE_MAX_TRANSLATION = rospy.get_param("motion_gate_max_translation")
+    MOTION_GATE_MAX_ROTATION = rospy.get_param("motion_gate_max_rotation")
+    # Max. time (seconds) the model can be skipped, so that the objects are still observed.
+    MOTION_GATE_MAX_SKIP_INTERVAL = rospy.get_param("motion_gate_max_skip_interval")
+    MOTION_GATE_THUMBNAIL_SIZE = (32, 24)
+    motion_gate_references = [None, None]
+    # Last published detections of each camera, published again for the skipped frames.
+    last_detections = [[], []]
+
+    # Associates the boxes of successive model runs and gives them ids that are kept across
+    # runs. Tracks are only updated by model runs (there is no per frame association), in
+    # between they are only extrapolated, for the down camera's bbox centering and the ROIs.
+    USE_TRACKER = rospy.get_param("object_tracking")
+    trackers = [
+        BoxTracker(
+            rospy.get_param("tracker_iou_threshold"), rospy.get_param("tracker_max_age")
+        )
+        for _ in range(2)
+    ]
+    # Track of the down camera box centered on by the last model run, 0 if none.
+    centering_track_id = 0
+
+    # ROI inference: while objects of interest are tracked, run the model on padded crops
+    # around them (which is much cheaper) and only run it on the full frame every
+    # ROI_FULL_FRAME_INTERVAL seconds to find new objects. Needs object_tracking.
+    USE_ROI_INFERENCE = rospy.get_param("roi_inference") and USE_TRACKER
+    ROI_CLASSES = ast.literal_eval(rospy.get_param("roi_classes"))
+    ROI_PADDING = rospy.get_param("roi_padding")
+    ROI_MIN_SIZE = rospy.get_param("roi_min_size")
+    ROI_INPUT_SIZE = ast.literal_eval(rospy.get_param("roi_input_size"))
+    ROI_FULL_FRAME_INTERVAL = rospy.get_param("roi_full_frame_interval")
+    last_full_frame_time = [0, 0]
 
     # One array per camera, name index should be class id.
     class_names = [
@@ -227,22 +756,42 @@ if __name__ == "__main__":
         ast.literal_eval(rospy.get_param("front_cam_class_name_mappings")),
     ]
 
-    # Count for number of images received per camera.
-    cameras_image_count = [0, 0]
+    # Decides how often each camera runs the model from the measured inference times.
+    scheduler = DetectionScheduler()
+    # Newest frame received per camera (and its stamp), None once taken by the inference worker.
+    latest_frames = [None, None]
+    latest_frames_condition = threading.Condition()
+    batching_gain_reported = set()
 
     pubs_visualisation = [
-        rospy.Publisher("/vision/down_cam/detection", Image, queue_size=1),
-        rospy.Publisher("/vision/front_cam/detection", Image, queue_size=1),
+        DebugPublisher("/vision/down_cam/detection"),
+        DebugPublisher("/vision/front_cam/detection"),
     ]
     pub_viewframe_detection = rospy.Publisher(
         "/vision/viewframe_detection", VisionObjectArray, queue_size=1
     )
     pub_bbox_centering = rospy.Publisher("/vision/down_cam/bbox", Int32MultiArray, queue_size=1)
 
-    bridge = CvBridge()
+    # Images are read from the messages without copying them (see image_ingest.py).
+    ingests = [ImageIngest(), ImageIngest()]
 
-    # The int argument is used to index debug publisher, model, class names, and cameras_image_count.
-    rospy.Subscriber("/vision/down_cam/image_raw", Image, vision_cb, 0),
-    rospy.Subscriber("/zed/zed_node/stereo/image_rect_color", Image, vision_cb, 1),
+    rospy.Subscriber("/mission_display", String, mission_display_cb)
+
+    # One inference worker per camera (or one for both when batching), so that detection
+    # latency is at most one inference time no matter how fast the cameras publish.
+    if BATCH_WINDOW > 0:
+        threading.Thread(target=batch_inference_worker, daemon=True).start()
+    else:
+        for camera_id in range(2):
+            threading.Thread(target=inference_worker, args=(camera_id,), daemon=True).start()
+
+    # The int argument is used to index debug publisher, model, class names, and latest_frames.
+    # Only the newest frame matters, so never let frames queue up in rospy.
+    rospy.Subscriber(
+        "/vision/down_cam/image_raw", Image, vision_cb, 0, queue_size=1, buff_size=2**24
+    )
+    rospy.Subscriber(
+        "/zed/zed_node/stereo/image_rect_color", Image, vision_cb, 1, queue_size=1, buff_size=2**24
+    )
 
     rospy.spin()
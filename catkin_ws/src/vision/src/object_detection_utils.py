@@ -4,9 +4,10 @@ import numpy as np
 import math
 import quaternion
 from tf import transformations
-from sklearn.linear_model import RANSACRegressor
 import json
 
+from camera_model import CameraModel
+from line_fit import fit_line_ransac
 from vision_state import VisionState
 
 
@@ -22,24 +23,47 @@ DOWN_CAM_Y_OFFSET = rospy.get_param("down_cam_y_offset")
 DOWN_CAM_Z_OFFSET = rospy.get_param("down_cam_z_offset")
 DOWN_CAM_YAW_OFFSET = rospy.get_param("down_cam_yaw_offset")
 MAX_COUNTS_PER_LABEL = json.loads(rospy.get_param("max_counts_per_label"))
+# Rotation of the down camera in the AUV's frame and position of the camera relative to the AUV.
+_down_cam_yaw_offset = transformations.quaternion_from_euler(0, 0, DOWN_CAM_YAW_OFFSET)
+DOWN_CAM_ROTATION = quaternion.as_rotation_matrix(
+    np.quaternion(
+        _down_cam_yaw_offset[3],
+        _down_cam_yaw_offset[0],
+        _down_cam_yaw_offset[1],
+        _down_cam_yaw_offset[2],
+    )
+)
+DOWN_CAM_OFFSET = np.array([down_cam_x_offset, DOWN_CAM_Y_OFFSET, DOWN_CAM_Z_OFFSET])
+# Rotation from the down camera's optical frame (x right, y down, z forward) to the
+# down camera's frame (x towards the top of the image, y towards its left, z up).
+DOWN_CAM_OPTICAL_ROTATION = np.array([[0, -1, 0], [-1, 0, 0], [0, 0, -1]])
+# Rays of the down camera's pixels, from its CameraInfo or from its FOV if it has none.
+down_camera_model = CameraModel(
+    "/vision/down_cam/camera_info",
+    DOWN_CAM_HFOV,
+    DOWN_CAM_VFOX,
+    rospy.get_param("down_cam_use_camera_info"),
+)
 states = (VisionState(), VisionState())
 ###############################################
 
 
-def calculate_bbox_confidence(bbox, image_height, image_width):
-    x_center, y_center, w, h = bbox
-
-    x_center_offset = ((image_width / 2) - x_center) / image_width  # -0.5 to 0.5.
-    y_center_offset = (y_center - (image_height / 2)) / image_height
-    scaled_w = w / image_width
-    scaled_h = h / image_height
+# bboxes is an (N, 4) array of bounding boxes (x center, y center, width, height).
+# Returns the confidence score of every box, from how centered it is and how close its
+# size is to half the image.
+def calculate_bbox_confidences(bboxes, image_height, image_width):
+    bboxes = np.asarray(bboxes, dtype=float).reshape(-1, 4)
+    x_center_offset = ((image_width / 2) - bboxes[:, 0]) / image_width  # -0.5 to 0.5.
+    y_center_offset = (bboxes[:, 1] - (image_height / 2)) / image_height
+    scaled_w = bboxes[:, 2] / image_width
+    scaled_h = bboxes[:, 3] / image_height
 
     # ideal bounding box has centers at 0
-    x_centering_score = 1 - abs(2 * x_center_offset)
-    y_centering_score = 1 - abs(2 * y_center_offset)
+    x_centering_score = 1 - np.abs(2 * x_center_offset)
+    y_centering_score = 1 - np.abs(2 * y_center_offset)
     # ideal width is half of the image
-    width_score = 1 - (2 * abs(0.5 - scaled_w))
-    height_score = 1 - (2 * abs(0.5 - scaled_h))
+    width_score = 1 - (2 * np.abs(0.5 - scaled_w))
+    height_score = 1 - (2 * np.abs(0.5 - scaled_h))
 
     avg_score = (x_centering_score + y_centering_score + width_score + height_score) / 4
 
@@ -102,89 +126,64 @@ def find_intersection(starting_point, vector, plane_z_pos):
     return starting_point + np.array(vector) * scaling_factor
 
 
-def get_object_position_down_camera(pixel_x, pixel_y, image_height, image_width, z_pos):
+def find_intersections(starting_point, vectors, plane_z_pos):
+    """
+    Same as find_intersection for an (N, 3) array of vectors starting from the same
+    point (plane_z_pos can be one z position per vector). Returns an (N, 3) array,
+    with NaN rows for the vectors that do not intersect their plane.
+    """
+    vectors = np.asarray(vectors, dtype=float).reshape(-1, 3)
+    z_diff = np.asarray(plane_z_pos, dtype=float) - starting_point[2]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scaling_factors = z_diff / vectors[:, 2]
+    scaling_factors[~(scaling_factors >= 0) | ~np.isfinite(scaling_factors)] = np.nan
+    return starting_point + vectors * scaling_factors[:, None]
+
+
+# pixels is an (N, 2) array of pixel coordinates (x, y) in the down camera image.
+# Returns the direction of every pixel in the down camera's frame (z pointing up).
+def get_down_camera_rays(pixels, image_height, image_width):
+    rays = down_camera_model.get_rays(pixels, image_height, image_width)
+    return rays @ DOWN_CAM_OPTICAL_ROTATION.T
+
+
+def get_object_positions_down_camera(pixels, image_height, image_width, z_pos):
     """
-    Given the pixel locations and height and width.
+    Given the pixel locations of objects and the image height and width.
 
     Parameters:
-        pixel_x: x coordinate of the object in the image.
-        pixel_y: y coordinate of the object in the image.
+        pixels: (N, 2) array of the x, y coordinates of the objects in the image
+            (e.g. bbox centers or the points of a contour).
         image_height: height of the image in pixels.
         image_width: width of the image in pixels.
-        z_pos: z position of the object.
+        z_pos: z position of the objects (one for all or one per object).
 
     Returns:
-        x, y, z position in 3D space (not relative to the AUV).
+        (N, 3) array of the x, y, z positions in 3D space (not relative to the AUV),
+        with NaN rows for the objects that could not be measured.
     """
-    # First calculate the relative offset of the object from the center of the
-    # image (i.e. map pixel coordinates to values from -0.5 to 0.5).
-    x_center_offset = ((image_width / 2) - pixel_x) / image_width  # -0.5 to 0.5.
-    y_center_offset = (
-        pixel_y - (image_height / 2)
-    ) / image_height  # Negated since y goes from top to bottom.
-    # Use offset within image and total FOV of camera to find
-    # an angle offset from the angle the camera is facing
-    # assuming FOV increases linearly with distance from center pixel.
-    roll_angle_offset = DOWN_CAM_HFOV * x_center_offset
-    pitch_angle_offset = DOWN_CAM_VFOX * y_center_offset
-
-    x_pos_offset = -math.tan(math.radians(pitch_angle_offset))
-    y_pos_offset = math.tan(math.radians(roll_angle_offset))
-
-    local_direction_to_object = np.array([x_pos_offset, y_pos_offset, -1])
-
-    rotation_offset = transformations.quaternion_from_euler(0, 0, DOWN_CAM_YAW_OFFSET)
-    rotation = states[0].q_auv * np.quaternion(
-        rotation_offset[3], rotation_offset[0], rotation_offset[1], rotation_offset[2]
-    )
-    global_direction_to_object = quaternion.rotate_vectors(
-        rotation, local_direction_to_object
-    )
-
-    # Solve for point that is defined by the intersection of the
-    # direction to the object and it's z position.
-    global_down_cam_offset = quaternion.rotate_vectors(
-        states[0].q_auv,
-        np.array([down_cam_x_offset, DOWN_CAM_Y_OFFSET, DOWN_CAM_Z_OFFSET]),
-    )
-    down_cam_pos = (
-        np.array([states[0].position.x, states[0].position.y, states[0].position.z])
-        + global_down_cam_offset
-    )
-    obj_pos = find_intersection(down_cam_pos, global_direction_to_object, z_pos)
-
-    if (
-        obj_pos is None
-        or np.linalg.norm(
-            obj_pos
-            - np.array(
-                [states[0].position.x, states[0].position.y, states[0].position.z]
-            )
-        )
-        > MAX_DIST_TO_MEASURE
-    ):
-        return None, None, None
-    x = obj_pos[0]
-    y = obj_pos[1]
-    z = z_pos
-    return x, y, z
+    pixels = np.asarray(pixels, dtype=float).reshape(-1, 2)
+    local_directions = get_down_camera_rays(pixels, image_height, image_width)
+    # One rotation matrix for all the objects.
+    auv_rotation = quaternion.as_rotation_matrix(states[0].q_auv)
+    global_directions = local_directions @ (auv_rotation @ DOWN_CAM_ROTATION).T
+
+    # Solve for points that are defined by the intersection of the
+    # directions to the objects and their z positions.
+    auv_pos = np.array([states[0].position.x, states[0].position.y, states[0].position.z])
+    down_cam_pos = auv_pos + auv_rotation @ DOWN_CAM_OFFSET
+    obj_pos = find_intersections(down_cam_pos, global_directions, z_pos)
+    # NaN rows (no intersection) compare as False and stay NaN.
+    obj_pos[np.linalg.norm(obj_pos - auv_pos, axis=1) > MAX_DIST_TO_MEASURE] = np.nan
+    return obj_pos
 
 
 # Given a bounding box, tells you where the main object in the
 # bounding box is in 3D space (world space).
 # Assumes cleaning was correct.
 def get_object_position_front_camera(bbox):
-    point_cloud = states[1].get_point_cloud(bbox)
-    min_lx = np.nanmin(point_cloud[:, :, 0].flatten())
-    min_ly = np.nanmin(point_cloud[:, :, 1].flatten())
-    min_lz = np.nanmin(point_cloud[:, :, 2].flatten())
-    max_lx = np.nanmax(point_cloud[:, :, 0].flatten())
-    max_ly = np.nanmax(point_cloud[:, :, 1].flatten())
-    max_lz = np.nanmax(point_cloud[:, :, 2].flatten())
-
-    lx = (max_lx + min_lx) / 2
-    ly = (max_ly + min_ly) / 2
-    lz = (max_lz + min_lz) / 2
+    object_point_cloud = states[1].get_object_point_cloud(bbox)
+    lx, ly, lz = (object_point_cloud.min + object_point_cloud.max) / 2
 
     global_obj_pos_offset = quaternion.rotate_vectors(
         states[1].q_auv, np.array([lx, ly, lz])
@@ -202,61 +201,46 @@ def get_object_position_front_camera(bbox):
 def measure_angle(bbox):
     """
     Given a bounding box, returns the angle of the object in degrees (only for front cam)
+    and the fraction of its points on the measured line (None and 0 if it has no points)
     """
-    point_cloud = states[1].get_point_cloud(bbox)
-
-    point_cloud_x = point_cloud[
-        :, :, 0
-    ].flatten()  # Collect x, ignore z positions of points.
-    point_cloud_y = point_cloud[
-        :, :, 1
-    ].flatten()  # Collect y, ignore z position of points.
-
-    nan_indices = np.isnan(point_cloud_x) | np.isnan(
-        point_cloud_y
-    )  # Find indices to remove (NaNs).
-
-    filtered_point_cloud_x = point_cloud_x[
-        ~nan_indices
-    ]  # Filter point cloud x so it has no NaNs.
-    filtered_point_cloud_y = point_cloud_y[
-        ~nan_indices
-    ]  # Filter point cloud y so it has no NaNs.
-
-    # Fit a line to the point cloud X/Y with RANSAC (removes outliers).
-    ransac = RANSACRegressor()
-    ransac.fit(-1 * filtered_point_cloud_y.reshape(-1, 1), filtered_point_cloud_x)
-    slope = ransac.estimator_.coef_[0]
+    # Points of the object (no NaNs), same point cloud as for its position.
+    points = states[1].get_object_point_cloud(bbox).points
+
+    # Fit a line x = slope * -y + b to the point cloud X/Y with RANSAC (removes outliers),
+    # ignoring the z positions of points.
+    slope, inlier_ratio = fit_line_ransac(np.column_stack((-points[:, 1], points[:, 0])))
+    if slope is None:
+        return None, inlier_ratio
 
     angle = math.degrees(math.atan(slope))  # Calculate the angle of the fitted line.
 
-    return angle + states[1].theta_z
+    return angle + states[1].theta_z, inlier_ratio
 
 
 # Lots of noise in pool, the idea is for example if the down
 # cam has two detections, it will remove the least confident one.
-# Selects highest confidence detection from duplicates and ignores
-# objects with no position measurement.
+# Keeps the MAX_COUNTS_PER_LABEL most confident detections of every
+# label (the first one on ties) and ignores objects with no position
+# measurement. Detections stay in the same order.
 def clean_detections(detectionFrameArray):
-    label_counts = {}
-    selected_detections = []
-
-    for i in range(len(detectionFrameArray)):
-        obj = detectionFrameArray[i]
-        if None in [obj.x, obj.y, obj.z]:
-            continue
-        if label_counts.get(obj.label, 0) >= MAX_COUNTS_PER_LABEL[obj.label]:
-            candidate_obj_conf = obj.confidence
-            min_conf_i = min(
-                selected_detections, key=lambda x: detectionFrameArray[x].confidence
-            )
-            if detectionFrameArray[min_conf_i].confidence < candidate_obj_conf:
-                selected_detections.remove(min_conf_i)
-                selected_detections.append(i)
-        else:
-            label_counts[obj.label] = label_counts.get(obj.label, 0) + 1
-            selected_detections.append(i)
-
+    detectionFrameArray = [
+        obj for obj in detectionFrameArray if None not in [obj.x, obj.y, obj.z]
+    ]
+    if len(detectionFrameArray) == 0:
+        return []
+    labels = np.array([obj.label for obj in detectionFrameArray])
+    confidences = np.array([obj.confidence for obj in detectionFrameArray])
+    # Sorted by label, then by decreasing confidence (stable, so ties keep their order).
+    order = np.lexsort((-confidences, labels))
+    sorted_labels = labels[order]
+    label_starts = np.flatnonzero(np.r_[True, sorted_labels[1:] != sorted_labels[:-1]])
+    label_sizes = np.diff(np.r_[label_starts, len(order)])
+    # Rank of every detection within its label, 0 being the most confident.
+    ranks = np.arange(len(order)) - np.repeat(label_starts, label_sizes)
+    max_counts = np.array(
+        [MAX_COUNTS_PER_LABEL[label] for label in sorted_labels[label_starts]]
+    )
+    selected_detections = np.sort(order[ranks < np.repeat(max_counts, label_sizes)])
     return [detectionFrameArray[i] for i in selected_detections]
 
 
@@ -20,15 +20,21 @@ def object_detect_cb(msg):
 def add_observation(msg):
     # Loop over every object in the detection_frame array.
     for detection_frame in msg.array:
-        # Find which object this detection pertains to.
-        obj_i = find_closest_object(
-            [
-                detection_frame.label,
-                detection_frame.x,
-                detection_frame.y,
-                detection_frame.z,
-            ]
-        )
+        # Detections published again for frames the model skipped were already added.
+        if detection_frame.repeated:
+            continue
+        # Find which object this detection pertains to, the object it was tracked as
+        # in previous frames if any, otherwise the closest one.
+        obj_i = find_tracked_object(detection_frame.label, detection_frame.track_id)
+        if obj_i == -1:
+            obj_i = find_closest_object(
+                [
+                    detection_frame.label,
+                    detection_frame.x,
+                    detection_frame.y,
+                    detection_frame.z,
+                ]
+            )
         # If it does not pertain to any preexisting object add it to the map.
         if obj_i == -1:
             object_map.append(
@@ -41,8 +47,10 @@ def add_observation(msg):
                     detection_frame.extra_field,
                     1,
                     detection_frame.confidence,
+                    set(),
                 ]
             )
+            obj_i = len(object_map) - 1
         else:
             # Otherwise update the object map with the new observation.
             update_map(
@@ -58,6 +66,19 @@ def add_observation(msg):
                     detection_frame.confidence,
                 ],
             )
+        # Track id 0 means the detection was not tracked.
+        if detection_frame.track_id != 0:
+            object_map[obj_i][8].add(detection_frame.track_id)
+
+
+# Find the object which observations of the track were added to (-1 if none).
+def find_tracked_object(label, track_id):
+    if track_id == 0:
+        return -1
+    for obj_i in range(len(object_map)):
+        if object_map[obj_i][0] == label and track_id in object_map[obj_i][8]:
+            return obj_i
+    return -1
 
 
 # Given an observation, find the object to which it pertains
@@ -68,7 +89,7 @@ def find_closest_object(observation, indexToIgnore=-1):
     close_objs = []
     # Go through every object in map and add to close_objs if close enough.
     for obj_i in range(len(object_map)):
-        obj_label, obj_x, obj_y, obj_z, _, _, _, _ = object_map[obj_i]
+        obj_label, obj_x, obj_y, obj_z = object_map[obj_i][:4]
         if observed_label != obj_label or obj_i == indexToIgnore:
             continue
         # Find distance between object in map and observation.
@@ -114,7 +135,7 @@ def update_map(obj_i, observation):
         observed_extra_field,
         num_new_observations,
         observed_confidence,
-    ) = observation
+    ) = observation[:8]
     (
         label,
         current_x,
@@ -124,7 +145,7 @@ def update_map(obj_i, observation):
         current_extra_field,
         num_observations,
         current_confidence,
-    ) = object_map[obj_i]
+    ) = object_map[obj_i][:8]
 
     if observed_confidence <= 0:
         observed_confidence = 1e-5
@@ -309,7 +330,7 @@ def reduce_map():
     num_objs_deleted = 0
     for i in range(len(object_map)):
         idx = i - num_objs_deleted
-        observed_label, observed_x, observed_y, observed_z, _, _, _, _ = object_map[idx]
+        observed_label, observed_x, observed_y, observed_z = object_map[idx][:4]
         closest_obj = find_closest_object(
             [observed_label, observed_x, observed_y, observed_z], indexToIgnore=idx
         )
@@ -317,7 +338,8 @@ def reduce_map():
             continue
         else:
             update_map(closest_obj, object_map[idx])
-            del object_map[i]
+            object_map[closest_obj][8] |= object_map[idx][8]
+            del object_map[idx]
             num_objs_deleted += 1
 
 
@@ -345,6 +367,8 @@ if __name__ == "__main__":
     rospy.init_node("object_map")
 
     MIN_OBSERVATIONS = rospy.get_param("min_observations_for_mapping")
+    # Each object is [label, x, y, z, theta_z, extra_field, number of observations,
+    # confidence, ids of the object_detection tracks it was observed as].
     object_map = []
 
     NULL_PLACEHOLDER = rospy.get_param("NULL_PLACEHOLDER")
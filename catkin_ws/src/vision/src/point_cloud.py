@@ -2,6 +2,7 @@
 
 import rospy
 import numpy as np
+import cv2
 from cv_bridge import CvBridge
 
 from std_msgs.msg import Header
@@ -21,21 +22,30 @@ def depth_callback(msg):
 
 
 def camera_info_callback(msg):
-    global fx, fy, cx, cy, width, height, x_over_z_map, y_over_z_map
-    # if(y_over_z_map is not None): return
-    fx = msg.K[0]
-    fy = msg.K[4]
-    cx = msg.K[2]
-    cy = msg.K[5]
-
+    global width, height, x_over_z_map, y_over_z_map
     width = msg.width
     height = msg.height
+    x_over_z_map, y_over_z_map = get_back_projection_maps(msg.K, width, height)
+
 
-    u_map = np.tile(np.arange(width), (height, 1)) + 1
-    v_map = np.tile(np.arange(height), (width, 1)).T + 1
+# Maps by (K, width, height), CameraInfo is published at camera rate but rarely changes.
+back_projection_maps = {}
 
-    x_over_z_map = (cx - u_map) / fx
-    y_over_z_map = (cy - v_map) / fy
+
+# Returns x/z and y/z of every pixel of a camera with intrinsics K (the 9 values of
+# CameraInfo.K), as a (1, width) row and a (height, 1) column which broadcast against
+# depth images of the camera (or crops of them, with the same crop of the row and column).
+def get_back_projection_maps(K, width, height):
+    key = (tuple(K), width, height)
+    if key not in back_projection_maps:
+        fx, cx, fy, cy = K[0], K[2], K[4], K[5]
+        x_over_z_map = (cx - (np.arange(width) + 1)) / fx
+        y_over_z_map = (cy - (np.arange(height) + 1)) / fy
+        back_projection_maps[key] = (
+            x_over_z_map.astype(np.float32).reshape(1, width),
+            y_over_z_map.astype(np.float32).reshape(height, 1),
+        )
+    return back_projection_maps[key]
 
 
 def convert_from_uvd(width, height):
@@ -91,18 +101,89 @@ def get_xyz_rgb_image(color, z_map, width, height, x_over_z_map, y_over_z_map):
         return xyz_rgb_image
 
 
-def get_xyz_image(z_map, width, height, x_over_z_map, y_over_z_map):
-    if y_over_z_map is not None:
-        xyz_image = np.zeros((height, width, 3))
+# Point cloud (float32 XYZ image) of a depth image or of a crop of it, x_over_z_map and
+# y_over_z_map being the same crop of the maps of get_back_projection_maps. offset is the
+# position of the camera relative to the AUV.
+def get_xyz_image(depth, x_over_z_map, y_over_z_map, offset, depth_scale_factor=1):
+    z_map = depth.astype(np.float32) / np.float32(depth_scale_factor)
+    xyz_image = np.empty(z_map.shape + (3,), dtype=np.float32)
+    xyz_image[:, :, 0] = z_map + offset[0]
+    xyz_image[:, :, 1] = x_over_z_map * z_map + offset[1]
+    xyz_image[:, :, 2] = y_over_z_map * z_map + offset[2]
+    return xyz_image
+
+
+# Points whose distance (x) is below min_distance or which are not finite are not part of
+# any object. Returns the mask of the valid points.
+def get_valid_points(xyz_image, min_distance):
+    return np.isfinite(xyz_image).all(axis=2) & (xyz_image[:, :, 0] >= min_distance)
+
+
+# Mask of the object closest to the camera in an XYZ image: DBSCAN cluster (with
+# neighborhoods of radius eps) of the closest valid point. None if no point is valid.
+def get_dbscan_mask(xyz_image, min_distance, eps, min_samples=10):
+    # Imported here so that sklearn is only loaded when DBSCAN is used.
+    from sklearn.cluster import DBSCAN
+
+    valid = get_valid_points(xyz_image, min_distance)
+    if not valid.any():
+        return None
+    points = xyz_image.reshape(-1, 3).copy()
+    # Ignored points are moved far away, where they cannot join the object's cluster.
+    points[~valid.flatten()] = 10000
+    closest_point_index = np.argmin(points[:, 0])
+    labels = DBSCAN(eps=eps, min_samples=min_samples).fit_predict(points)
+    return (labels == labels[closest_point_index]).reshape(xyz_image.shape[:2])
+
+
+# Indices of the valid pixels of a distance image, closest first. The closest pixel is
+# almost never noise, the other pixels are only sorted if it is.
+def get_seeds(distance, valid):
+    if not valid.any():
+        return
+    yield np.nanargmin(distance)
+    valid_indices = np.flatnonzero(valid)
+    yield from valid_indices[np.argsort(distance.flat[valid_indices], kind="stable")]
+
+
+# Mask of the object closest to the camera in an XYZ image: region grown from the closest
+# valid point over the 4 or 8 neighbors of every pixel, as long as the distance (x) changes
+# by at most eps between neighbors. Linear in the number of pixels, unlike DBSCAN. Regions
+# of less than min_region_size pixels are noise (like points without min_samples neighbors
+# for DBSCAN), the region is then grown again from the closest point outside of them.
+# None if no point is valid or every region is noise.
+def get_region_growing_mask(xyz_image, min_distance, eps, connectivity=8, min_region_size=10):
+    valid = get_valid_points(xyz_image, min_distance)
+    # NaN is never within eps of a neighbor, ignored points stop the regions.
+    distance = np.where(valid, xyz_image[:, :, 0], np.nan).astype(np.float32)
+    # Filled pixels are 1 for noise and 2 for the region being grown.
+    mask = np.zeros((distance.shape[0] + 2, distance.shape[1] + 2), dtype=np.uint8)
+    flags = connectivity | cv2.FLOODFILL_MASK_ONLY | (2 << 8)
+    for index in get_seeds(distance, valid):
+        seed_y, seed_x = divmod(int(index), distance.shape[1])
+        if mask[seed_y + 1, seed_x + 1] != 0:
+            continue
+        region_size, _, _, (x, y, w, h) = cv2.floodFill(
+            distance, mask, (seed_x, seed_y), 0, eps, eps, flags
+        )
+        if region_size >= min_region_size:
+            return mask[1:-1, 1:-1] == 2
+        region = mask[y + 1 : y + h + 1, x + 1 : x + w + 1]
+        region[region == 2] = 1
+    return None
 
-        x_map = x_over_z_map * z_map
-        y_map = y_over_z_map * z_map
 
-        xyz_image[:, :, 0] = z_map + rospy.get_param("front_cam_x_offset", 0)
-        xyz_image[:, :, 1] = x_map + rospy.get_param("front_cam_y_offset", 0)
-        xyz_image[:, :, 2] = y_map + rospy.get_param("front_cam_z_offset", 0)
+CLEANING_METHODS = {"dbscan": get_dbscan_mask, "region_growing": get_region_growing_mask}
 
-        return xyz_image
+
+def get_cleaning_method(method):
+    if method not in CLEANING_METHODS:
+        raise ValueError(
+            "Unknown point cloud cleaning method {} (expected one of {})".format(
+                method, list(CLEANING_METHODS)
+            )
+        )
+    return CLEANING_METHODS[method]
 
 
 if __name__ == "__main__":
@@ -110,10 +191,6 @@ if __name__ == "__main__":
 
     bridge = CvBridge()
 
-    fx = None
-    fy = None
-    cx = None
-    cy = None
     width = None
     height = None
 
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+import itertools
+import threading
+
+import numpy as np
+
+
+# Track ids are unique across all the trackers of a node, 0 means no track.
+track_ids = itertools.count(1)
+
+# Standard deviation of the measured box (fraction of the box size).
+MEASUREMENT_STD = 0.05
+# Standard deviation of the change of box velocity per second (fraction of the box size).
+VELOCITY_STD = 0.5
+
+
+# Intersection over union of every box of boxes1 with every box of boxes2 (x center,
+# y center, width, height), as a len(boxes1) x len(boxes2) matrix.
+def iou_matrix(boxes1, boxes2):
+    boxes1 = np.asarray(boxes1, dtype=float).reshape(-1, 1, 4)
+    boxes2 = np.asarray(boxes2, dtype=float).reshape(1, -1, 4)
+    inter_w = np.minimum(
+        boxes1[..., 0] + boxes1[..., 2] / 2, boxes2[..., 0] + boxes2[..., 2] / 2
+    ) - np.maximum(boxes1[..., 0] - boxes1[..., 2] / 2, boxes2[..., 0] - boxes2[..., 2] / 2)
+    inter_h = np.minimum(
+        boxes1[..., 1] + boxes1[..., 3] / 2, boxes2[..., 1] + boxes2[..., 3] / 2
+    ) - np.maximum(boxes1[..., 1] - boxes1[..., 3] / 2, boxes2[..., 1] - boxes2[..., 3] / 2)
+    inter = np.maximum(inter_w, 0) * np.maximum(inter_h, 0)
+    union = boxes1[..., 2] * boxes1[..., 3] + boxes2[..., 2] * boxes2[..., 3] - inter
+    return inter / np.maximum(union, 1e-9)
+
+
+# Box followed by a constant velocity Kalman filter, state: x, y, w, h and their velocities.
+class Track:
+    def __init__(self, box, cls, t):
+        self.id = next(track_ids)
+        self.cls = cls
+        self.state = np.concatenate((box[:4], np.zeros(4)))
+        size = max(box[2], box[3])
+        self.covariance = np.diag(
+            np.concatenate(
+                ((MEASUREMENT_STD * size) ** 2 * np.ones(4), (VELOCITY_STD * size) ** 2 * np.ones(4))
+            )
+        )
+        self.time = t
+        self.last_update_time = t
+        self.hits = 1
+
+    # Box moved to time t (by default the time of the state) without changing the filter.
+    def get_box(self, t=None):
+        dt = 0 if t is None else max(t - self.time, 0)
+        return self.state[:4] + dt * self.state[4:]
+
+    def predict(self, t):
+        dt = t - self.time
+        if dt <= 0:
+            return
+        transition = np.eye(8)
+        transition[:4, 4:] = dt * np.eye(4)
+        size = max(self.state[2], self.state[3], 1)
+        noise = np.zeros((8, 8))
+        noise[4:, 4:] = (VELOCITY_STD * size) ** 2 * dt * np.eye(4)
+        self.state = transition @ self.state
+        self.covariance = transition @ self.covariance @ transition.T + noise
+        self.time = t
+
+    def update(self, box, t):
+        self.predict(t)
+        size = max(box[2], box[3], 1)
+        innovation = box[:4] - self.state[:4]
+        innovation_covariance = self.covariance[:4, :4] + (MEASUREMENT_STD * size) ** 2 * np.eye(4)
+        gain = self.covariance[:, :4] @ np.linalg.inv(innovation_covariance)
+        self.state = self.state + gain @ innovation
+        self.covariance = self.covariance - gain @ self.covariance[:4, :]
+        # Boxes cannot have a negative size.
+        self.state[2:4] = np.maximum(self.state[2:4], 1)
+        self.last_update_time = t
+        self.hits += 1
+
+
+# Follows the boxes of one camera between model runs: update() associates the boxes of a
+# model run with the tracks (greedily by IoU, same class only) and predict() extrapolates
+# the tracks to any time in between (with their velocity, the images are not looked at).
+# Thread safe, so it can be predicted from image callbacks.
+class BoxTracker:
+    def __init__(self, iou_threshold=0.3, max_age=1.0):
+        self.iou_threshold = iou_threshold
+        # Seconds without a matching box after which a track is dropped.
+        self.max_age = max_age
+        self.tracks = []
+        # Time of the last update(), the tracks it matched have it as their last_update_time.
+        self.last_update_time = None
+        self.lock = threading.Lock()
+
+    # boxes is a box array of the inference backend (x, y, w, h, confidence, class id).
+    # Returns the track id of every box.
+    def update(self, boxes, t):
+        with self.lock:
+            self.last_update_time = t
+            for track in self.tracks:
+                track.predict(t)
+            ids = np.zeros(len(boxes), dtype=int)
+            matched_boxes, matched_tracks = set(), set()
+            if len(boxes) > 0 and len(self.tracks) > 0:
+                ious = iou_matrix(boxes[:, :4], [track.get_box() for track in self.tracks])
+                ious[boxes[:, 5, None] != np.array([[track.cls for track in self.tracks]])] = 0
+                for box_i, track_i in zip(*np.unravel_index(np.argsort(-ious, axis=None), ious.shape)):
+                    if ious[box_i, track_i] < self.iou_threshold:
+                        break
+                    if box_i in matched_boxes or track_i in matched_tracks:
+                        continue
+                    self.tracks[track_i].update(boxes[box_i], t)
+                    ids[box_i] = self.tracks[track_i].id
+                    matched_boxes.add(box_i)
+                    matched_tracks.add(track_i)
+            for box_i in range(len(boxes)):
+                if box_i not in matched_boxes:
+                    track = Track(boxes[box_i], boxes[box_i, 5], t)
+                    self.tracks.append(track)
+                    ids[box_i] = track.id
+            self.tracks = [
+                track for track in self.tracks if t - track.last_update_time <= self.max_age
+            ]
+            return ids
+
+    # Returns the (track id, class id, box) of every track, moved to time t.
+    def predict(self, t):
+        with self.lock:
+            self.tracks = [
+                track for track in self.tracks if t - track.last_update_time <= self.max_age
+            ]
+            for track in self.tracks:
+                track.predict(t)
+            return [(track.id, track.cls, track.get_box()) for track in self.tracks]
+
+    # Returns the box of the track moved to time t, or None if the last update() did not
+    # match it (the track is coasting) or it was dropped. The track is not changed, so t can
+    # be before the next update().
+    def predict_track(self, track_id, t):
+        with self.lock:
+            for track in self.tracks:
+                if track.id == track_id and track.last_update_time == self.last_update_time:
+                    return track.get_box(t)
+            return None
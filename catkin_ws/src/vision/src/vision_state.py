@@ -2,11 +2,11 @@
 
 import rospy
 import numpy as np
-from sklearn.cluster import DBSCAN
 from cv_bridge import CvBridge
 
-from common_utils import crop_to_bbox
-from point_cloud import get_xyz_image
+from common_utils import crop_to_bbox, get_bbox_bounds
+from debug_publisher import DebugPublisher
+from point_cloud import get_back_projection_maps, get_cleaning_method, get_xyz_image
 
 from auv_msgs.msg import VisionObjectArray
 from std_msgs.msg import Float64
@@ -14,6 +14,21 @@ from geometry_msgs.msg import Pose
 from sensor_msgs.msg import Image, CameraInfo
 
 
+# Cleaned point cloud of a bbox (see VisionState.get_object_point_cloud) and the statistics
+# computed from it. Shared by every user of the bbox in a frame, must not be modified.
+class ObjectPointCloud:
+    def __init__(self, point_cloud):
+        point_cloud.setflags(write=False)
+        self.point_cloud = point_cloud
+        # (N, 3) points of the object.
+        self.points = point_cloud[np.isfinite(point_cloud).all(axis=2)]
+        # Bounds of the object on every axis, NaN if it has no point.
+        if len(self.points) > 0:
+            self.min = self.points.min(axis=0)
+            self.max = self.points.max(axis=0)
+        else:
+            self.min = self.max = np.full(3, np.nan, dtype=point_cloud.dtype)
+
 
 class VisionState:
     def __init__(self):
@@ -22,27 +37,49 @@ class VisionState:
         self.position = None
         self.q_auv = None
         self.theta_z = None
-        self.point_cloud = None
+        # Latest depth image (view of the message), the point cloud is only computed
+        # for the bboxes it is requested for.
+        self.depth = None
+        # Incremented for every new depth image, object_point_clouds only holds the
+        # point clouds of the current one by (depth frame id, bbox).
+        self.depth_frame_id = 0
+        self.object_point_clouds = {}
         # Paused.
         self.position_while_paused = None
         self.theta_z_while_paused = None
         self.q_auv_while_paused = None
-        self.point_cloud_while_paused = None
+        self.depth_while_paused = None
         
         self.bgr_image = None
-        self.depth = None
         self.width = None
         self.height = None
         self.x_over_z_map = None
         self.y_over_z_map = None
 
         self.bridge = CvBridge()
+        self.point_cloud_clean_pub = DebugPublisher("/vision/debug/point_cloud_clean")
 
         self.DEPTH_SCALE_FACTOR = rospy.get_param("depth_map_scale_factor")
+        # Position of the camera relative to the AUV, added to the points.
+        self.camera_offset = np.array(
+            [
+                rospy.get_param("front_cam_x_offset", 0),
+                rospy.get_param("front_cam_y_offset", 0),
+                rospy.get_param("front_cam_z_offset", 0),
+            ],
+            dtype=np.float32,
+        )
 
+        # Maximum distance between two neighboring points for them to be
+        # considered as part of the same object.
         self.eps = rospy.get_param(
             "max_distance_for_point_cloud_fill_cleaning"
         )  
+        # Points closer to the camera are ignored.
+        self.min_distance = rospy.get_param("min_distance_for_valid_point_cloud_point")
+        self.get_object_mask = get_cleaning_method(
+            rospy.get_param("point_cloud_cleaning_method")
+        )
 
         self.pose_sub = rospy.Subscriber("/state/pose", Pose, self.update_pose)
         self.theta_z_sub = rospy.Subscriber(
@@ -79,97 +116,81 @@ class VisionState:
                 msg.orientation.w, msg.orientation.x, msg.orientation.y, msg.orientation.z
             )
 
-    def update_point_cloud(self):
-        if self.is_paused:
-            self.point_cloud_while_paused = np.copy(
-                get_xyz_image(
-                    self.depth,
-                    self.width,
-                    self.height,
-                    self.x_over_z_map,
-                    self.y_over_z_map,
-                )
-            )
-        else:
-            self.point_cloud = np.copy(
-                get_xyz_image(
-                    self.depth,
-                    self.width,
-                    self.height,
-                    self.x_over_z_map,
-                    self.y_over_z_map,
-                )
-            )
+    def has_point_cloud(self):
+        return self.depth is not None and self.x_over_z_map is not None
+
+    # Point cloud (float32 XYZ image) of the pixels in bbox, or of the full image.
+    def get_xyz(self, bbox=None):
+        depth, x_over_z_map, y_over_z_map = self.depth, self.x_over_z_map, self.y_over_z_map
+        if bbox is not None:
+            x_min, x_max, y_min, y_max = get_bbox_bounds(bbox)
+            depth = depth[y_min:y_max, x_min:x_max]
+            x_over_z_map = x_over_z_map[:, x_min:x_max]
+            y_over_z_map = y_over_z_map[y_min:y_max]
+        return get_xyz_image(
+            depth, x_over_z_map, y_over_z_map, self.camera_offset, self.DEPTH_SCALE_FACTOR
+        )
 
+    # Keeps only the object closest to the camera in the point cloud (the other points are
+    # set to NaN).
     def clean_point_cloud(self, point_cloud, bgr):
-        # Find the closest point to the camera.
-        initial_point_cloud_shape = point_cloud.shape
-        point_cloud = point_cloud.reshape(-1, 3)
-        point_cloud[
-            point_cloud[:, 0]
-            < rospy.get_param("min_distance_for_valid_point_cloud_point")
-        ] = 10000  # Ignore depth values which are less than 0.5m.
-        closest_point_index = np.argmin(point_cloud[:, 0])
-
-        # Maximum distance between two samples for them to be 
-        # considered as in the same neighborhood.
-        
-        min_samples = 10  # The number of samples in a neighborhood for a point to be considered as a core point
-
-        # Perform DBSCAN clustering
-        dbscan = DBSCAN(eps=self.eps, min_samples=min_samples)
-        labels = dbscan.fit_predict(point_cloud)
-
-        # Extract the cluster containing the seed point
-        closest_object_label = labels[closest_point_index]
-        object_mask = labels == closest_object_label
-        point_cloud[~object_mask] = np.array([np.nan] * 3)
-
-        point_cloud = point_cloud.reshape(initial_point_cloud_shape)
-        object_mask = object_mask.reshape(initial_point_cloud_shape[0:2])
-
-        if rospy.get_param("debug_point_cloud_cleaning"):
+        object_mask = self.get_object_mask(point_cloud, self.min_distance, self.eps)
+        if object_mask is None:
+            object_mask = np.zeros(point_cloud.shape[:2], dtype=bool)
+        point_cloud[~object_mask] = np.nan
+
+        if (
+            rospy.get_param("debug_point_cloud_cleaning")
+            and self.point_cloud_clean_pub.is_wanted()
+        ):
             debug_image = np.uint8(np.zeros((point_cloud.shape)))
             debug_image[object_mask] = np.array([0, 0, 255])
-            rospy.Publisher(
-                "/vision/debug/point_cloud_clean", Image, queue_size=0
-            ).publish(self.bridge.cv2_to_imgmsg(debug_image, "bgr8"))
+            self.point_cloud_clean_pub.publish(debug_image)
 
         return point_cloud
 
+    # Cleaned point cloud of the object in bbox (or of the closest object in the full image),
+    # only computed once per depth frame and frame processed (between pause and resume) for
+    # every bbox (e.g. for the position and the angle of the gate).
+    def get_object_point_cloud(self, bbox=None):
+        key = (self.depth_frame_id, None if bbox is None else tuple(bbox))
+        if key not in self.object_point_clouds:
+            if bbox is None:
+                # bbox is bounding box: surrounds bounds an object or a specific area of interest in a robot's perception system
+                point_cloud = self.clean_point_cloud(self.get_xyz(), self.bgr_image)
+            else:
+                point_cloud = self.clean_point_cloud(
+                    self.get_xyz(bbox),
+                    # Only the point cloud is modified by the cleaning.
+                    crop_to_bbox(self.bgr_image, bbox, copy=False),
+                )
+            self.object_point_clouds[key] = ObjectPointCloud(point_cloud)
+        return self.object_point_clouds[key]
+
+    # Read-only, see get_object_point_cloud.
     def get_point_cloud(self, bbox=None):
-        if bbox is None:
-            # bbox is bounding box: surrounds bounds an object or a specific area of interest in a robot's perception system
-            return self.clean_point_cloud(
-                np.copy(self.point_cloud), np.copy(self.bgr_image)
-            )
-        else:
-            return self.clean_point_cloud(
-                crop_to_bbox(self.point_cloud, bbox, copy=True),
-                crop_to_bbox(self.bgr_image, bbox, copy=True),
-            )
+        return self.get_object_point_cloud(bbox).point_cloud
+
+    def set_depth(self, depth):
+        self.depth = depth
+        self.depth_frame_id += 1
+        self.object_point_clouds = {}
 
     def update_depth(self, msg):
-        temp = self.bridge.imgmsg_to_cv2(msg)
-        self.depth = temp / self.DEPTH_SCALE_FACTOR
-        self.update_point_cloud()
+        # Not copied nor scaled here, only the crops used by get_point_cloud are.
+        depth = self.bridge.imgmsg_to_cv2(msg)
+        if self.is_paused:
+            self.depth_while_paused = depth
+        else:
+            self.set_depth(depth)
 
     def update_camera_info(self, msg):
-        fx = msg.K[0]
-        fy = msg.K[4]
-        cx = msg.K[2]
-        cy = msg.K[5]
-
         self.width = msg.width
         self.height = msg.height
-
-        u_map = np.tile(np.arange(self.width), (self.height, 1)) + 1
-        v_map = np.tile(np.arange(self.height), (self.width, 1)).T + 1
-
-        self.x_over_z_map = (cx - u_map) / fx
-        self.y_over_z_map = (cy - v_map) / fy
-        if self.depth is not None:
-            self.update_point_cloud()
+        # Row and column vectors, only computed again if the intrinsics change.
+        self.x_over_z_map, self.y_over_z_map = get_back_projection_maps(
+            msg.K, msg.width, msg.height
+        )
 
     def pause(self):
         self.is_paused = True
@@ -181,12 +202,14 @@ class VisionState:
             self.theta_z = self.theta_z_while_paused
         if self.q_auv_while_paused is not None:
             self.q_auv = self.q_auv_while_paused
-        if self.point_cloud_while_paused is not None:
-            self.point_cloud = self.point_cloud_while_paused
+        if self.depth_while_paused is not None:
+            self.set_depth(self.depth_while_paused)
+        # The next frame has another image (and bboxes), even if the depth did not change.
+        self.object_point_clouds = {}
 
         self.position_while_paused = None
         self.theta_z_while_paused = None
         self.q_auv_while_paused = None
-        self.point_cloud_while_paused = None
+        self.depth_while_paused = None
 
         self.is_paused = False
\ No newline at end of file
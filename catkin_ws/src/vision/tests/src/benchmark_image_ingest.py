@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+# Standalone benchmark of the memory allocated per frame between an image message and the
+# model input (no ROS master needed): the old path (cv_bridge conversion, copies for the
+# debug image and the vision state, letterbox and blob allocated per frame) against the
+# ingest path of object_detection (read-only view of the message, lazy debug image copy,
+# preallocated letterbox and blob buffers), e.g.:
+#   ./benchmark_image_ingest.py --size 1920 1080 --output image_ingest.json
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+import types
+
+import cv2
+import numpy as np
+
+current_dir = os.path.dirname(os.path.realpath(__file__))
+SRC_DIR = os.path.abspath(os.path.join(current_dir, "../../src"))
+sys.path.append(current_dir)
+from benchmark_lane_marker_measure import distribution, get_commit, stub_ros  # noqa: E402
+
+
+def make_message(width, height, encoding, channels):
+    # Real messages are the same size, the content does not matter.
+    data = np.random.default_rng(0).integers(0, 256, height * width * channels, dtype=np.uint8)
+    return types.SimpleNamespace(
+        width=width,
+        height=height,
+        step=width * channels,
+        encoding=encoding,
+        data=data.tobytes(),
+    )
+
+
+# cv_bridge's imgmsg_to_cv2(msg, "bgr8"), or the same conversion without ROS (cv_bridge
+# copies the image even when it already is bgr8).
+def imgmsg_to_cv2(msg):
+    if bridge is not None:
+        return bridge.imgmsg_to_cv2(msg, "bgr8")
+    image = np.ascontiguousarray(image_ingest.image_view(msg))
+    _, conversion = image_ingest.ENCODINGS[msg.encoding]
+    return np.copy(image) if conversion is None else cv2.cvtColor(image, conversion)
+
+
+def old_letterbox(image, input_h, input_w):
+    h, w = image.shape[:2]
+    scale = min(input_h / h, input_w / w)
+    new_w, new_h = int(round(w * scale)), int(round(h * scale))
+    image = cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+    top = int(round((input_h - new_h) / 2 - 0.1))
+    left = int(round((input_w - new_w) / 2 - 0.1))
+    return cv2.copyMakeBorder(
+        image,
+        top,
+        input_h - new_h - top,
+        left,
+        input_w - new_w - left,
+        cv2.BORDER_CONSTANT,
+        value=(114, 114, 114),
+    )
+
+
+def old_ingest(msg, input_size, subscribed):
+    image = imgmsg_to_cv2(msg)
+    debug_image = np.copy(image)
+    bgr_image = np.copy(image)
+    blob = cv2.dnn.blobFromImages([old_letterbox(image, *input_size)], 1 / 255.0, swapRB=True)
+    return image, debug_image, bgr_image, blob
+
+
+def make_new_ingest(input_size):
+    ingest = image_ingest.ImageIngest()
+    padded = np.empty((1,) + tuple(input_size) + (3,), dtype=np.uint8)
+    blob = np.empty((1, 3) + tuple(input_size), dtype=np.float32)
+
+    def new_ingest(msg, input_size, subscribed):
+        image = ingest.to_bgr(msg)
+        debug_image = np.copy(image) if subscribed else None
+        bgr_image = image
+        inference_backends.letterbox(image, padded[0])
+        inference_backends.to_blob(padded, blob)
+        return image, debug_image, bgr_image, blob
+
+    return new_ingest
+
+
+# Peak memory traced while ingesting a frame (so what the frame allocates, even if it is
+# freed before the next one) and time per frame (measured without tracing).
+def benchmark_path(ingest, msg, input_size, subscribed, frames):
+    ingest(msg, input_size, subscribed)  # Warm up, e.g. for the preallocated buffers.
+    allocated = []
+    for _ in range(frames):
+        tracemalloc.start()
+        result = ingest(msg, input_size, subscribed)
+        allocated.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        del result
+    times_ms = []
+    for _ in range(frames):
+        start_time = time.perf_counter()
+        ingest(msg, input_size, subscribed)
+        times_ms.append((time.perf_counter() - start_time) * 1000)
+    return {"allocated_bytes": distribution(allocated), "ms": distribution(times_ms)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark image ingest allocations")
+    parser.add_argument("--frames", type=int, default=50)
+    parser.add_argument("--size", type=int, nargs=2, default=[1920, 1080], metavar=("W", "H"))
+    parser.add_argument(
+        "--input-size",
+        type=int,
+        nargs=2,
+        default=[480, 640],
+        metavar=("H", "W"),
+        help="model input size (onnx_input_size)",
+    )
+    parser.add_argument(
+        "--encoding",
+        action="append",
+        default=None,
+        help="image encoding (default: bgr8 for the down camera and bgra8 for the ZED)",
+    )
+    parser.add_argument("--output", default="image_ingest_benchmark.json")
+    args = parser.parse_args()
+
+    try:
+        from cv_bridge import CvBridge
+
+        bridge = CvBridge()
+    except ImportError:
+        bridge = None
+    stub_ros({})
+    sys.path.append(SRC_DIR)
+    import image_ingest
+    import inference_backends
+
+    results = {"commit": get_commit(), "frames": args.frames, "size": args.size, "encodings": {}}
+    for encoding in args.encoding or ["bgr8", "bgra8"]:
+        channels, _ = image_ingest.ENCODINGS[encoding]
+        msg = make_message(*args.size, encoding, channels)
+        results["encodings"][encoding] = {
+            subscription: {
+                "before": benchmark_path(
+                    old_ingest, msg, args.input_size, subscribed, args.frames
+                ),
+                "after": benchmark_path(
+                    make_new_ingest(args.input_size), msg, args.input_size, subscribed, args.frames
+                ),
+            }
+            for subscription, subscribed in (("no subscriber", False), ("subscriber", True))
+        }
+
+    for encoding, result in results["encodings"].items():
+        for subscription, paths in result.items():
+            before, after = paths["before"], paths["after"]
+            print(
+                "{} {}x{}, {}: {:.1f}MB -> {:.1f}MB allocated per frame, {:.2f}ms -> {:.2f}ms".format(
+                    encoding,
+                    *args.size,
+                    subscription,
+                    before["allocated_bytes"]["median"] / 1024**2,
+                    after["allocated_bytes"]["median"] / 1024**2,
+                    before["ms"]["median"],
+                    after["ms"]["median"],
+                )
+            )
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2, sort_keys=True)
+    print("\nResults written to " + args.output)
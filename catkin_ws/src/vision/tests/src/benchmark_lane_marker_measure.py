@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+
+# Standalone accuracy and latency benchmark of lane_marker_measure (no ROS master needed).
+# Runs every image of lane_marker_data.txt several times and writes a JSON result
+# file which can be diffed between commits, e.g.:
+#   ./benchmark_lane_marker_measure.py --runs 50 --output before.json
+#   ./benchmark_lane_marker_measure.py --runs 50 --output after.json
+
+import argparse
+import ast
+import json
+import os
+import subprocess
+import sys
+import time
+import types
+import xml.etree.ElementTree as ET
+
+import cv2
+import numpy as np
+
+current_dir = os.path.dirname(os.path.realpath(__file__))
+SRC_DIR = os.path.abspath(os.path.join(current_dir, "../../src"))
+DEFAULT_LAUNCH_FILE = os.path.abspath(
+    os.path.join(current_dir, "../launch/test_lane_marker_measure.test")
+)
+DEFAULT_IMAGE_DIR = os.path.abspath(os.path.join(current_dir, "../images/lane_marker"))
+ENGINES = ("hough", "moments")
+
+
+# Reads the <param> values of a launch file (same type conversion as roslaunch).
+def read_launch_params(launch_file):
+    params = {}
+    for param in ET.parse(launch_file).getroot().iter("param"):
+        value = param.get("value")
+        if value is None or "$(" in value:
+            continue
+        if value.lower() in ("true", "false"):
+            params[param.get("name")] = value.lower() == "true"
+            continue
+        try:
+            params[param.get("name")] = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            params[param.get("name")] = value
+    return params
+
+
+# Makes lane_marker_measure importable without a ROS master: parameters are
+# read from the given dictionary and publishers do nothing.
+def stub_ros(params):
+    class Publisher:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def publish(self, *args, **kwargs):
+            pass
+
+        def get_num_connections(self):
+            return 0
+
+    def get_param(name, *default):
+        name = name.lstrip("~/")
+        if name in params:
+            return params[name]
+        if len(default) > 0:
+            return default[0]
+        raise KeyError(name)
+
+    try:
+        import rospy
+    except ImportError:
+        rospy = types.ModuleType("rospy")
+        sys.modules["rospy"] = rospy
+    rospy.get_param = get_param
+    rospy.Publisher = Publisher
+    try:
+        import cv_bridge  # noqa: F401
+        import sensor_msgs.msg  # noqa: F401
+    except ImportError:
+        # Only needed to publish debug images, which the benchmark never does.
+        cv_bridge = types.ModuleType("cv_bridge")
+        cv_bridge.CvBridge = lambda: None
+        sensor_msgs = types.ModuleType("sensor_msgs")
+        sensor_msgs.msg = types.ModuleType("sensor_msgs.msg")
+        sensor_msgs.msg.Image = sensor_msgs.msg.CompressedImage = None
+        sensor_msgs.msg.CameraInfo = None
+        sensor_msgs.msg.PointCloud2 = sensor_msgs.msg.PointField = None
+        sensor_msgs.point_cloud2 = types.ModuleType("sensor_msgs.point_cloud2")
+        std_msgs = types.ModuleType("std_msgs")
+        std_msgs.msg = types.ModuleType("std_msgs.msg")
+        std_msgs.msg.Header = None
+        sys.modules.update(
+            {
+                "cv_bridge": cv_bridge,
+                "sensor_msgs": sensor_msgs,
+                "sensor_msgs.msg": sensor_msgs.msg,
+                "sensor_msgs.point_cloud2": sensor_msgs.point_cloud2,
+                "std_msgs": std_msgs,
+                "std_msgs.msg": std_msgs.msg,
+            }
+        )
+
+
+def read_lane_marker_data(image_dir):
+    samples = []
+    with open(os.path.join(image_dir, "lane_marker_data.txt"), "r") as file:
+        header = file.readline().strip().split(",")
+        for line in file:
+            if line.strip() == "":
+                continue
+            row = dict(zip(header, line.strip().split(",")))
+            samples.append(
+                {
+                    "name": row["raw_image_file"],
+                    "image": cv2.imread(
+                        os.path.join(image_dir, row["raw_image_file"]), cv2.IMREAD_COLOR
+                    ),
+                    "bbox": [
+                        float(row["x"]),
+                        float(row["y"]),
+                        float(row["width"]),
+                        float(row["height"]),
+                    ],
+                    "angles_goal": [
+                        float(row["angles_goal_1"]),
+                        float(row["angles_goal_2"]),
+                    ],
+                    "center_point_goal": [
+                        float(row["center_point_goal_1"]),
+                        float(row["center_point_goal_2"]),
+                    ],
+                }
+            )
+    return samples
+
+
+def angle_error(angle, angle_goal):
+    return abs((angle - angle_goal + 180) % 360 - 180)
+
+
+# Summary of a distribution (latencies in ms or errors).
+def distribution(values):
+    if len(values) == 0:
+        return None
+    values = np.asarray(values, dtype=float)
+    return {
+        "mean": float(np.mean(values)),
+        "median": float(np.median(values)),
+        "p90": float(np.percentile(values, 90)),
+        "max": float(np.max(values)),
+    }
+
+
+def benchmark_engine(lane_marker_measure, samples, engine, runs):
+    stage_ms = {}
+    total_ms = []
+    angle_errors = []
+    center_errors = []
+    images = {}
+    for sample in samples:
+        image_total_ms = []
+        for _ in range(runs):
+            lane_marker_measure.stage_times = {}
+            start_time = time.perf_counter()
+            angles, center_point, _ = lane_marker_measure.measure_lane_marker(
+                sample["image"], sample["bbox"], sample["image"].copy(), engine=engine
+            )
+            image_total_ms.append((time.perf_counter() - start_time) * 1000)
+            for stage, seconds in lane_marker_measure.stage_times.items():
+                stage_ms.setdefault(stage, []).append(seconds * 1000)
+        lane_marker_measure.stage_times = None
+        total_ms += image_total_ms
+        # Measurements are deterministic, only the last run is used for errors.
+        if None in angles or None in center_point:
+            images[sample["name"]] = {"failed": True, "total_ms": distribution(image_total_ms)}
+            continue
+        image_angle_errors = [
+            angle_error(angles[i], sample["angles_goal"][i]) for i in range(2)
+        ]
+        image_center_error = float(
+            np.linalg.norm(np.subtract(center_point, sample["center_point_goal"]))
+        )
+        angle_errors += image_angle_errors
+        center_errors.append(image_center_error)
+        images[sample["name"]] = {
+            "failed": False,
+            "angles": [float(angle) for angle in angles],
+            "center_point": [int(coordinate) for coordinate in center_point],
+            "angle_errors": image_angle_errors,
+            "center_error": image_center_error,
+            "total_ms": distribution(image_total_ms),
+        }
+    return {
+        "failures": sum(image["failed"] for image in images.values()),
+        "total_ms": distribution(total_ms),
+        "stages_ms": {stage: distribution(ms) for stage, ms in stage_ms.items()},
+        "angle_error_deg": distribution(angle_errors),
+        "center_error_px": distribution(center_errors),
+        "images": images,
+    }
+
+
+def get_commit():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"], cwd=current_dir, stderr=subprocess.DEVNULL
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(results):
+    for engine, result in results["engines"].items():
+        print(
+            "\n{} engine: {} images, {} failed, total {:.2f}ms median".format(
+                engine,
+                len(result["images"]),
+                result["failures"],
+                result["total_ms"]["median"],
+            )
+        )
+        print("  {:>10} {:>9} {:>9} {:>9}".format("stage", "mean ms", "p90 ms", "max ms"))
+        for stage, ms in result["stages_ms"].items():
+            print(
+                "  {:>10} {:9.3f} {:9.3f} {:9.3f}".format(
+                    stage, ms["mean"], ms["p90"], ms["max"]
+                )
+            )
+        for name, error in (
+            ("angle deg", result["angle_error_deg"]),
+            ("center px", result["center_error_px"]),
+        ):
+            if error is not None:
+                print(
+                    "  {} error: mean {:.2f}, median {:.2f}, p90 {:.2f}, max {:.2f}".format(
+                        name, error["mean"], error["median"], error["p90"], error["max"]
+                    )
+                )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark lane marker measurement")
+    parser.add_argument("--runs", type=int, default=20, help="runs per image")
+    parser.add_argument("--engine", choices=ENGINES + ("all",), default="all")
+    parser.add_argument("--images", default=DEFAULT_IMAGE_DIR, help="folder with lane_marker_data.txt")
+    parser.add_argument("--launch", default=DEFAULT_LAUNCH_FILE, help="launch file to read params from")
+    parser.add_argument(
+        "--param",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="override a parameter, e.g. --param lane_marker_downscaling_size=200",
+    )
+    parser.add_argument("--output", default="lane_marker_benchmark.json")
+    args = parser.parse_args()
+
+    params = read_launch_params(args.launch)
+    for param in args.param:
+        name, value = param.split("=", 1)
+        try:
+            params[name] = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            params[name] = value
+    params["testing"] = True
+
+    stub_ros(params)
+    sys.path.append(SRC_DIR)
+    import lane_marker_measure
+
+    samples = read_lane_marker_data(args.images)
+    engines = ENGINES if args.engine == "all" else (args.engine,)
+    results = {
+        "commit": get_commit(),
+        "runs": args.runs,
+        "params": params,
+        "engines": {
+            engine: benchmark_engine(lane_marker_measure, samples, engine, args.runs)
+            for engine in engines
+        },
+    }
+    print_report(results)
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2, sort_keys=True)
+    print("\nResults written to " + args.output)
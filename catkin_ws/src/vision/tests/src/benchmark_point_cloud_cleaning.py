@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+# Standalone benchmark of the point cloud cleaning methods of point_cloud.py (no ROS master
+# needed): time of every method and agreement of its object mask with DBSCAN's (the method
+# used before region growing), on crops of ZED depth images recorded in a bag, e.g.:
+#   ./benchmark_point_cloud_cleaning.py --bag pool.bag --bbox 640 360 120 160 --output cleaning.json
+# or on synthetic scenes (objects in front of a sloped pool floor) when no bag is given.
+# DBSCAN takes seconds on crops of more than ~100x100 pixels, use --max-frames on long bags.
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+current_dir = os.path.dirname(os.path.realpath(__file__))
+SRC_DIR = os.path.abspath(os.path.join(current_dir, "../../src"))
+sys.path.append(current_dir)
+from benchmark_lane_marker_measure import distribution, get_commit, stub_ros  # noqa: E402
+
+DEPTH_TOPIC = "/zed/zed_node/depth/depth_registered"
+CAMERA_INFO_TOPIC = "/zed/zed_node/depth/camera_info"
+
+
+# Yields (name, depth image in meters, K) for the depth images of the bag.
+def read_bag(bag_file, depth_scale_factor, max_frames):
+    import rosbag
+    from cv_bridge import CvBridge
+
+    bridge = CvBridge()
+    K = None
+    frames = 0
+    with rosbag.Bag(bag_file) as bag:
+        for topic, msg, stamp in bag.read_messages(topics=[DEPTH_TOPIC, CAMERA_INFO_TOPIC]):
+            if topic == CAMERA_INFO_TOPIC:
+                K = msg.K
+                continue
+            if K is None:
+                continue
+            depth = bridge.imgmsg_to_cv2(msg).astype(np.float32) / depth_scale_factor
+            yield "{:.3f}".format(stamp.to_sec()), depth, K
+            frames += 1
+            if frames == max_frames:
+                return
+
+
+# Depth images in meters of boxes (the objects) in front of the pool floor, with sensor
+# noise, holes (NaN, as the ZED publishes) and points too close to the camera.
+def make_synthetic_frames(size, frames):
+    width, height = size
+    K = [width / 2, 0, width / 2, 0, width / 2, height / 2, 0, 0, 1]
+    rng = np.random.default_rng(0)
+    rows = np.arange(height, dtype=np.float32)[:, None]
+    for frame in range(frames):
+        floor_depth = 3 + 6 * (1 - rows / height) * rng.uniform(0.5, 1)
+        depth = np.broadcast_to(floor_depth, (height, width)).copy()
+        for _ in range(rng.integers(1, 4)):
+            w, h = rng.integers(width // 8, width // 2), rng.integers(height // 8, height // 2)
+            x, y = rng.integers(0, width - w), rng.integers(0, height - h)
+            depth[y : y + h, x : x + w] = rng.uniform(1, floor_depth[y + h - 1, 0] - 0.5)
+        depth += rng.normal(0, 0.01, depth.shape) * depth
+        depth[rng.random(depth.shape) < 0.02] = np.nan
+        depth[rng.random(depth.shape) < 0.005] = 0.2
+        yield "synthetic_{}".format(frame), depth.astype(np.float32), K
+
+
+def mask_agreement(mask, reference):
+    if mask is None or reference is None:
+        return {"iou": float(mask is None and reference is None), "pixels": None}
+    union = np.count_nonzero(mask | reference)
+    return {
+        "iou": np.count_nonzero(mask & reference) / union if union > 0 else 1.0,
+        "pixels": float(np.mean(mask == reference)),
+    }
+
+
+def benchmark_crop(xyz_image, methods, min_distance, eps, runs):
+    masks = {}
+    results = {}
+    for method in methods:
+        get_object_mask = point_cloud.get_cleaning_method(method)
+        times_ms = []
+        for _ in range(runs):
+            start_time = time.perf_counter()
+            masks[method] = get_object_mask(xyz_image, min_distance, eps)
+            times_ms.append((time.perf_counter() - start_time) * 1000)
+        results[method] = {"ms": distribution(times_ms)}
+    for method in methods:
+        results[method].update(mask_agreement(masks[method], masks.get("dbscan")))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark point cloud cleaning")
+    parser.add_argument("--bag", help="bag with the ZED depth images and camera info")
+    parser.add_argument(
+        "--bbox",
+        type=float,
+        nargs=4,
+        action="append",
+        metavar=("X", "Y", "W", "H"),
+        help="crop (center and size, in pixels) to clean in every frame (default: centered 100x100)",
+    )
+    parser.add_argument("--depth-scale-factor", type=float, default=1000)
+    parser.add_argument("--max-frames", type=int, default=20)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--size", type=int, nargs=2, default=[1280, 720], metavar=("W", "H"))
+    parser.add_argument("--eps", type=float, default=0.5)
+    parser.add_argument("--min-distance", type=float, default=0.5)
+    parser.add_argument("--output", default="point_cloud_cleaning_benchmark.json")
+    args = parser.parse_args()
+
+    stub_ros({})
+    sys.path.append(SRC_DIR)
+    import point_cloud
+    from common_utils import get_bbox_bounds
+
+    if args.bag is None:
+        frames = make_synthetic_frames(args.size, args.max_frames)
+    else:
+        frames = read_bag(args.bag, args.depth_scale_factor, args.max_frames)
+    methods = list(point_cloud.CLEANING_METHODS)
+    results = {"commit": get_commit(), "bag": args.bag, "eps": args.eps, "crops": {}}
+    for name, depth, K in frames:
+        height, width = depth.shape
+        x_over_z_map, y_over_z_map = point_cloud.get_back_projection_maps(K, width, height)
+        for bbox in args.bbox or [[width / 2, height / 2, 100, 100]]:
+            x_min, x_max, y_min, y_max = get_bbox_bounds(bbox)
+            xyz_image = point_cloud.get_xyz_image(
+                depth[y_min:y_max, x_min:x_max],
+                x_over_z_map[:, x_min:x_max],
+                y_over_z_map[y_min:y_max],
+                np.zeros(3, dtype=np.float32),
+            )
+            results["crops"]["{} {}".format(name, bbox)] = benchmark_crop(
+                xyz_image, methods, args.min_distance, args.eps, args.runs
+            )
+
+    crops = list(results["crops"].values())
+    results["summary"] = {
+        method: {
+            "ms": distribution([crop[method]["ms"]["median"] for crop in crops]),
+            "iou": distribution([crop[method]["iou"] for crop in crops]),
+        }
+        for method in methods
+    }
+    for method, summary in results["summary"].items():
+        print(
+            "{}: {:.2f}ms median, IoU with dbscan {:.3f} median, {:.3f} min ({} crops)".format(
+                method,
+                summary["ms"]["median"],
+                summary["iou"]["median"],
+                min(crop[method]["iou"] for crop in crops),
+                len(crops),
+            )
+        )
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2, sort_keys=True)
+    print("\nResults written to " + args.output)
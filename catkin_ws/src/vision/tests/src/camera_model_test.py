@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+
+import rostest
+import unittest
+import types
+import numpy as np
+from camera_model import CameraModel
+
+
+class camera_model_test(unittest.TestCase):
+    # Without a CameraInfo, the angle of a ray should grow linearly with its pixel's
+    # distance to the center (half the FOV at the edge of the image).
+    def test__FovRays(self):
+        camera_model = CameraModel("camera_info", 90, 60, use_camera_info=False)
+        rays = camera_model.get_rays([[320, 240], [480, 240], [320, 0]], 480, 640)
+        angle = np.radians(22.5)
+        np.testing.assert_allclose(rays[0], [0, 0, 1], atol=1e-6)
+        np.testing.assert_allclose(rays[1], [np.sin(angle), 0, np.cos(angle)], atol=1e-6)
+        np.testing.assert_allclose(rays[2], [0, -0.5, np.sqrt(0.75)], atol=1e-6)
+
+    # With a CameraInfo (calibrated at twice the image resolution), rays should go through
+    # the pixels according to the scaled intrinsics.
+    def test__CameraInfoRays(self):
+        camera_model = CameraModel("camera_info", 90, 60, use_camera_info=False)
+        camera_model.update_camera_info(
+            types.SimpleNamespace(
+                K=[800, 0, 640, 0, 800, 480, 0, 0, 1],
+                D=[0, 0, 0, 0, 0],
+                distortion_model="plumb_bob",
+                width=1280,
+                height=960,
+            )
+        )
+        ray = camera_model.get_rays([[520, 240]], 480, 640)[0]
+        np.testing.assert_allclose(ray, np.array([0.5, 0, 1]) / np.sqrt(1.25), atol=1e-5)
+
+
+if __name__ == "__main__":
+    rostest.rosrun("vision", "camera_model_test", camera_model_test)
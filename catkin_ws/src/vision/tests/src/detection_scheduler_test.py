@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+
+import rostest
+import unittest
+from detection_scheduler import allocate_rates
+
+
+class detection_scheduler_test(unittest.TestCase):
+    # When the budget is large enough, every camera should run at its target rate.
+    def test__BudgetCoversTargets(self):
+        rates = allocate_rates([0.05, 0.1], [10, 5], [1, 1], 1.0)
+        self.assertAlmostEqual(rates[0], 10)
+        self.assertAlmostEqual(rates[1], 5)
+
+    # When the budget is too small, it should be shared proportionally to the priorities.
+    def test__BudgetSharedByPriority(self):
+        rates = allocate_rates([0.1, 0.1], [10, 10], [3, 1], 0.8)
+        self.assertAlmostEqual(rates[0], 6)
+        self.assertAlmostEqual(rates[1], 2)
+
+    # The part of the budget a camera does not need should go to the other camera.
+    def test__UnusedBudgetRedistributed(self):
+        rates = allocate_rates([0.1, 0.1], [1, 10], [1, 1], 0.8)
+        self.assertAlmostEqual(rates[0], 1)
+        self.assertAlmostEqual(rates[1], 7)
+
+    # A camera with a target rate of 0 should be disabled and leave its budget to the other.
+    def test__DisabledCamera(self):
+        rates = allocate_rates([0.1, 0.2], [0, 10], [1, 1], 0.8)
+        self.assertEqual(rates[0], 0)
+        self.assertAlmostEqual(rates[1], 4)
+
+    # Before any inference time is measured, cameras should run at their target rate.
+    def test__NoLatencyMeasuredYet(self):
+        rates = allocate_rates([0, 0], [10, 5], [1, 1], 0.8)
+        self.assertEqual(rates, [10, 5])
+
+
+if __name__ == "__main__":
+    rostest.rosrun("vision", "detection_scheduler_test", detection_scheduler_test)
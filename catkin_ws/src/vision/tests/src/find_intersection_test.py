@@ -4,7 +4,7 @@ import rospy
 import rostest
 import unittest
 import numpy as np
-from object_detection_utils import find_intersection
+from object_detection_utils import find_intersection, find_intersections
 
 
 class find_intersection_test(unittest.TestCase):
@@ -30,6 +30,14 @@ class find_intersection_test(unittest.TestCase):
         result = find_intersection(vector, plane_z_pos)
         self.assertIsNone(result)
 
+    # Several vectors at once should give one point per vector, NaN when there is none.
+    def test__SeveralVectorsIntersectPlanes(self):
+        starting_point = np.array([1, 1, 0])
+        vectors = np.array([[1, 2, 3], [1, 2, 0], [1, 2, -3]])
+        result = find_intersections(starting_point, vectors, [6, 6, 3])
+        np.testing.assert_array_equal(result[0], [3, 5, 6])
+        self.assertTrue(np.all(np.isnan(result[1:])))
+
 
 if __name__ == "__main__":
     # rospy.init_node("find_intersection_test") - Already initialized in object_detection_utils.py
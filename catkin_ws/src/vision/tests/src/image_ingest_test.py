@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+
+import rostest
+import unittest
+import types
+import numpy as np
+from image_ingest import ImageIngest, image_view
+
+
+def make_message(image, encoding, padding=0):
+    height, width, channels = image.shape
+    rows = np.zeros((height, width * channels + padding), dtype=np.uint8)
+    rows[:, : width * channels] = image.reshape(height, -1)
+    return types.SimpleNamespace(
+        height=height,
+        width=width,
+        step=width * channels + padding,
+        encoding=encoding,
+        data=rows.tobytes(),
+    )
+
+
+class image_ingest_test(unittest.TestCase):
+    # Rows padded to the step of the message should be skipped, without copying the data.
+    def test__ViewSkipsRowPadding(self):
+        image = np.random.default_rng(0).integers(0, 256, (4, 5, 3), dtype=np.uint8)
+        view = image_view(make_message(image, "bgr8", padding=3))
+        np.testing.assert_array_equal(view, image)
+        self.assertFalse(view.flags.writeable)
+
+    # Other encodings should be converted to BGR into the same buffer every frame.
+    def test__ConversionReusesBuffer(self):
+        ingest = ImageIngest()
+        bgra = np.zeros((4, 5, 4), dtype=np.uint8)
+        bgra[..., 0] = 10
+        bgra[..., 2] = 30
+        first = ingest.to_bgr(make_message(bgra, "bgra8"))
+        np.testing.assert_array_equal(first[0, 0], [10, 0, 30])
+        second = ingest.to_bgr(make_message(bgra, "bgra8"))
+        self.assertIs(first, second)
+
+
+if __name__ == "__main__":
+    rostest.rosrun("vision", "image_ingest_test", image_ingest_test)
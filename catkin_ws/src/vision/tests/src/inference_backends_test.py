@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+import rostest
+import unittest
+import numpy as np
+from inference_backends import decode_predictions, letterbox, non_max_suppression
+
+
+class inference_backends_test(unittest.TestCase):
+    # Overlapping boxes should be suppressed, keeping the most confident one first.
+    def test__NmsSuppressesOverlaps(self):
+        boxes = np.array(
+            [[0, 0, 10, 10], [1, 1, 11, 11], [20, 20, 30, 30]], dtype=np.float32
+        )
+        scores = np.array([0.8, 0.9, 0.5], dtype=np.float32)
+        keep = non_max_suppression(boxes, scores, 0.5)
+        np.testing.assert_array_equal(keep, [1, 2])
+
+    # Boxes should be mapped back from the letterboxed model input to the original image,
+    # boxes of different classes should not suppress each other and boxes less confident
+    # than the threshold should be dropped.
+    def test__DecodeUndoesLetterbox(self):
+        # 2 classes, 3 anchors (columns): x, y, w, h, score of class 0, score of class 1.
+        output = np.array(
+            [
+                [100, 100, 300],
+                [120, 120, 200],
+                [40, 40, 20],
+                [20, 20, 20],
+                [0.9, 0.1, 0.1],
+                [0.1, 0.8, 0.1],
+            ],
+            dtype=np.float32,
+        )
+        # 640x480 image letterboxed into 640x640 (padded by 80 pixels on top).
+        boxes = decode_predictions(output, (480, 640), 1.0, 0, 80)
+        np.testing.assert_allclose(
+            boxes,
+            [[100, 40, 40, 20, 0.9, 0], [100, 40, 40, 20, 0.8, 1]],
+            rtol=1e-6,
+        )
+        self.assertEqual(len(decode_predictions(output, (480, 640), 1.0, 0, 80, 0.05)), 3)
+
+    # The image should be resized into the middle of the reused buffer and the rest of it
+    # padded, whatever the buffer held before.
+    def test__LetterboxFillsBuffer(self):
+        image = np.full((240, 320, 3), 7, dtype=np.uint8)
+        out = np.zeros((640, 640, 3), dtype=np.uint8)
+        scale, left, top = letterbox(image, out)
+        self.assertEqual((scale, left, top), (2.0, 0, 80))
+        self.assertTrue(np.all(out[80:560] == 7))
+        self.assertTrue(np.all(out[:80] == 114) and np.all(out[560:] == 114))
+
+
+if __name__ == "__main__":
+    rostest.rosrun("vision", "inference_backends_test", inference_backends_test)
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+
+import rostest
+import unittest
+import numpy as np
+from line_fit import MAX_POINTS, fit_line_ransac
+
+
+class line_fit_test(unittest.TestCase):
+    # The slope should be found despite the outliers, which should not be inliers. Fitting
+    # the same points again should give the same result.
+    def test__LineWithOutliers(self):
+        rng = np.random.default_rng(1)
+        u = rng.uniform(-1, 1, 10 * MAX_POINTS)
+        v = 0.5 * u + 2 + rng.normal(0, 0.005, len(u))
+        outliers = rng.random(len(u)) < 0.3
+        v[outliers] += rng.choice([-1, 1], np.count_nonzero(outliers)) * rng.uniform(
+            0.5, 1, np.count_nonzero(outliers)
+        )
+        points = np.column_stack((u, v))
+        slope, inlier_ratio = fit_line_ransac(points, residual_threshold=0.02)
+        self.assertAlmostEqual(slope, 0.5, delta=0.01)
+        self.assertAlmostEqual(inlier_ratio, 0.7, delta=0.05)
+        self.assertEqual(fit_line_ransac(points, residual_threshold=0.02), (slope, inlier_ratio))
+
+    # Lines along v have an infinite slope, and there is no line without 2 different points.
+    def test__DegenerateLines(self):
+        self.assertEqual(fit_line_ransac([[1, 0], [1, 1], [1, 2]]), (np.inf, 1.0))
+        self.assertEqual(fit_line_ransac([[1, 1]]), (None, 0.0))
+        self.assertEqual(fit_line_ransac([[1, 1], [1, 1]]), (None, 0.0))
+
+
+if __name__ == "__main__":
+    rostest.rosrun("vision", "line_fit_test", line_fit_test)
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+
+import rostest
+import unittest
+import numpy as np
+from point_cloud import get_dbscan_mask, get_region_growing_mask
+
+
+# XYZ image of a box at 2m in front of a wall at 4m, with a speckle point at 1m in the wall.
+def make_scene():
+    xyz_image = np.zeros((40, 40, 3), dtype=np.float32)
+    xyz_image[:, :, 0] = 4
+    xyz_image[10:30, 5:20, 0] = 2
+    xyz_image[35, 35, 0] = 1
+    xyz_image[:, :, 1] = np.arange(40)[None, :] * 0.01
+    xyz_image[:, :, 2] = np.arange(40)[:, None] * 0.01
+    return xyz_image
+
+
+class point_cloud_test(unittest.TestCase):
+    # The region should be grown from the closest point which is not noise: the box, not the
+    # speckle point (DBSCAN keeps the noise points instead) or the points too close to the
+    # camera.
+    def test__RegionGrowingMask(self):
+        xyz_image = make_scene()
+        xyz_image[0, 0, 0] = 0.2
+        xyz_image[20, 10] = np.nan
+        expected_mask = np.zeros((40, 40), dtype=bool)
+        expected_mask[10:30, 5:20] = True
+        expected_mask[20, 10] = False
+        mask = get_region_growing_mask(xyz_image, 0.5, 0.5)
+        np.testing.assert_array_equal(mask, expected_mask)
+        xyz_image[35, 35, 0] = 4
+        np.testing.assert_array_equal(get_dbscan_mask(xyz_image, 0.5, 0.5), expected_mask)
+
+    def test__NoValidPoint(self):
+        xyz_image = make_scene()
+        xyz_image[:, :, 0] = 0.2
+        self.assertIsNone(get_region_growing_mask(xyz_image, 0.5, 0.5))
+        self.assertIsNone(get_dbscan_mask(xyz_image, 0.5, 0.5))
+
+
+if __name__ == "__main__":
+    rostest.rosrun("vision", "point_cloud_test", point_cloud_test)
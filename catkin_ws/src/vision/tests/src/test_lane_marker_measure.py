@@ -5,6 +5,7 @@ import rostest
 import unittest
 import cv2
 import os
+import time
 
 import sys
 
@@ -12,7 +13,8 @@ import sys
 current_dir = os.path.dirname(os.path.realpath(__file__))
 lane_marker_file = os.path.abspath(os.path.join(current_dir, '../../src'))
 sys.path.append(lane_marker_file)
-from lane_marker_measure import measure_lane_marker
+from lane_marker_measure import measure_lane_marker, measure_headings
+from common_utils import crop_to_bbox
 
 
 # Naming convention for test functions:
@@ -82,6 +84,43 @@ class TestLaneMarkerMeasure(unittest.TestCase):
                          self.fail(f"Error: measure_lane_marker returned None for {self.raw_image_names[i]}")
                     self.assertTrue(self.is_measure_correct(angles, self.angles_goals[i], center_point, self.center_point_goals[i]))
 
+     def angle_error(self, angle, angle_goal):
+          return abs((angle - angle_goal + 180) % 360 - 180)
+
+     def test_heading_engines(self):
+          report = []
+          for engine in ("hough", "moments"):
+               for i in range(len(self.raw_image_names)):
+                    with self.subTest(msg=f"{engine} {self.raw_image_names[i]}"):
+                         image = self.load_image(self.raw_image_names[i])
+                         debug_image = self.load_image(self.debug_image_names[i])
+                         if image is None:
+                              self.fail(f"Error: {self.raw_image_names[i]} could not be loaded.")
+                         start_time = time.perf_counter()
+                         angles, center_point, _ = measure_lane_marker(image, self.bboxes[i], debug_image, engine=engine)
+                         latency = (time.perf_counter() - start_time) * 1000
+                         if None in angles or None in center_point:
+                              report.append(f"{engine:>8} {self.raw_image_names[i]:>28} {latency:8.2f}ms        failed")
+                              self.fail(f"Error: {engine} engine returned None for {self.raw_image_names[i]}")
+                         angle_error = max(self.angle_error(angles[j], self.angles_goals[i][j]) for j in range(2))
+                         report.append(f"{engine:>8} {self.raw_image_names[i]:>28} {latency:8.2f}ms {angle_error:8.2f}deg")
+                         self.assertTrue(self.is_measure_correct(angles, self.angles_goals[i], center_point, self.center_point_goals[i]))
+          print("\n  engine                        image  latency  max angle error")
+          print("\n".join(report))
+
+     def test_hough_modes_agree(self):
+          for i in range(len(self.raw_image_names)):
+               with self.subTest(msg=self.raw_image_names[i]):
+                    image = self.load_image(self.raw_image_names[i])
+                    if image is None:
+                         self.fail(f"Error: {self.raw_image_names[i]} could not be loaded.")
+                    cropped_image = crop_to_bbox(image, self.bboxes[i])
+                    iterative_angles, iterative_center_point = measure_headings(cropped_image, debug_image=cropped_image.copy(), hough_mode="iterative")
+                    clustered_angles, clustered_center_point = measure_headings(cropped_image, debug_image=cropped_image.copy(), hough_mode="clustered")
+                    if iterative_angles is None or clustered_angles is None:
+                         self.fail(f"Error: measure_headings returned None for {self.raw_image_names[i]}")
+                    self.assertTrue(self.is_measure_correct(clustered_angles, iterative_angles, clustered_center_point, iterative_center_point))
+
 
 if __name__ == "__main__":
      rostest.rosrun("vision", "test_lane_marker_measure", TestLaneMarkerMeasure)
\ No newline at end of file
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+import rostest
+import unittest
+import numpy as np
+from tracker import BoxTracker, iou_matrix
+
+
+class tracker_test(unittest.TestCase):
+    # Identical boxes should have an IoU of 1, disjoint boxes an IoU of 0.
+    def test__IouMatrix(self):
+        ious = iou_matrix([[10, 10, 4, 4]], [[10, 10, 4, 4], [20, 20, 4, 4], [12, 10, 4, 4]])
+        np.testing.assert_allclose(ious, [[1, 0, 1 / 3]])
+
+    # A box moving between model runs should keep its track id, and be predicted in between.
+    def test__TrackKeptAndPredicted(self):
+        tracker = BoxTracker(iou_threshold=0.3, max_age=1.0)
+        ids = []
+        for i in range(5):
+            boxes = np.array([[100 + 10 * i, 50, 40, 40, 0.9, 1]])
+            ids.append(tracker.update(boxes, 0.1 * i)[0])
+        self.assertEqual(len(set(ids)), 1)
+        (track_id, cls, box), = tracker.predict(0.45)
+        self.assertEqual(track_id, ids[0])
+        self.assertEqual(cls, 1)
+        self.assertAlmostEqual(box[0], 145, delta=2)
+
+    # Boxes of another class should not be associated with a track, and lost tracks should be dropped.
+    def test__ClassMismatchAndMaxAge(self):
+        tracker = BoxTracker(iou_threshold=0.3, max_age=1.0)
+        first_id = tracker.update(np.array([[100, 50, 40, 40, 0.9, 1]]), 0)[0]
+        second_id = tracker.update(np.array([[100, 50, 40, 40, 0.9, 2]]), 0.1)[0]
+        self.assertNotEqual(first_id, second_id)
+        self.assertEqual(len(tracker.predict(2.0)), 0)
+
+    # A single track should only be predicted while the last update matched it, without
+    # changing it.
+    def test__PredictTrackOnlyWhenMatched(self):
+        tracker = BoxTracker(iou_threshold=0.3, max_age=1.0)
+        for i in range(5):
+            track_id = tracker.update(np.array([[100 + 10 * i, 50, 40, 40, 0.9, 1]]), 0.1 * i)[0]
+        box = tracker.predict_track(track_id, 0.45)
+        self.assertAlmostEqual(box[0], 145, delta=2)
+        np.testing.assert_array_equal(tracker.predict_track(track_id, 0.45), box)
+        tracker.update(np.array([[300, 50, 40, 40, 0.9, 1]]), 0.5)
+        self.assertIsNone(tracker.predict_track(track_id, 0.55))
+
+
+if __name__ == "__main__":
+    rostest.rosrun("vision", "tracker_test", tracker_test)